@@ -0,0 +1,137 @@
+"""Audit the fMRIPrep func outputs of a campaign for missing files.
+
+The expected outputs are derived from the bold runs of the BIDS dataset
+(shared pybids index) by expected_outputs.py, as for the fmriprep.py skips: the
+preprocessed bold in each of `OUTPUT_TEMPLATES`, the fsLR 91k dtseries and
+the confounds of each run, and the report of each session. They are looked up
+in the trees of the main branch and of every job branch, listed in parallel
+with `git ls-tree` so that no annexed content is needed. The report of a
+session is looked up on its own job branches or under its merged name only,
+as `sub-XX.html` is also the anat report of every session.
+
+    python3 audit.py <bids_path> <derivatives_path> [--all] [--tsv out.tsv]
+"""
+import os
+import sys
+import csv
+import fnmatch
+import argparse
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+import fmriprep
+import expected_outputs
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from mri.utils import git_tree, git_merge, bids_index
+
+REPORT = "report"
+
+
+def report_exists(subject, session, reports):
+    """Session report, under its merged name on the main branch (see git_merge.py)
+    or as `sub-XX.html` on a job branch of the session.
+
+    `reports` maps each ref to the reports at the root of its tree.
+    """
+    job_prefix = f"sub-{subject}" + (f"_ses-{session}" if session else "")
+    for ref, ref_reports in reports.items():
+        match = git_merge.FMRIPREP_BRANCH_RE.match(ref.rsplit("/", 1)[-1])
+        if match is None:
+            merged = [f"{job_prefix}.html", f"{job_prefix}_*.html"]
+            if any(fnmatch.fnmatch(r, p) for r in ref_reports for p in merged):
+                return True
+        elif match.group(1) == job_prefix or match.group(1).startswith(f"{job_prefix}_"):
+            if f"sub-{subject}.html" in ref_reports:
+                return True
+    return False
+
+
+def audit(layout, derivatives_path, participant_label=None, refs=None):
+    """Rows (subject, session, task, run, output -> present) for all bold runs."""
+    if refs is None:
+        refs = ["HEAD"] + git_tree.list_refs(derivatives_path, fmriprep.JOB_BRANCHES_PATTERNS)
+    with ThreadPoolExecutor(max_workers=git_tree.LS_TREE_WORKERS) as executor:
+        trees = dict(
+            zip(refs, executor.map(lambda ref: git_tree.ls_tree(derivatives_path, ref), refs))
+        )
+    existing = set().union(*trees.values())
+    reports = {
+        ref: {p for p in paths if "/" not in p and p.endswith(".html")}
+        for ref, paths in trees.items()
+    }
+
+    filters = dict(subject=participant_label) if participant_label else {}
+    bold_runs = layout.get(suffix="bold", extension=[".nii", ".nii.gz"], **filters)
+    # only the magnitude of runs with phase data is processed
+    sessions_with_phase = {
+        (b.entities["subject"], b.entities.get("session"))
+        for b in bold_runs
+        if b.entities.get("part") == "phase"
+    }
+    rows = []
+    for bold_run in bold_runs:
+        entities = bold_run.entities
+        subject, session = entities["subject"], entities.get("session")
+        if (subject, session) in sessions_with_phase and entities.get("part") != "mag":
+            continue
+        row = collections.OrderedDict(
+            subject=subject,
+            session=session or "",
+            task=entities.get("task", ""),
+            run=entities.get("run", ""),
+        )
+        row.update(expected_outputs.run_outputs_present(bold_run, existing.__contains__))
+        row[REPORT] = report_exists(subject, session, reports)
+        rows.append(row)
+    return rows
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        description="matrix of the missing fMRIPrep func outputs across the main and job branches",
+    )
+    parser.add_argument("bids_path", help="BIDS dataset processed")
+    parser.add_argument("derivatives_path", help="fmriprep derivatives dataset")
+    parser.add_argument(
+        "--participant-label",
+        nargs="+",
+        help="a space delimited list of participant identifiers to audit",
+    )
+    parser.add_argument(
+        "--all", action="store_true", help="list all runs, not only those with missing outputs"
+    )
+    parser.add_argument("--tsv", help="write the matrix to this file instead of stdout")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    layout = bids_index.get_layout(args.bids_path)
+    rows = audit(layout, os.path.realpath(args.derivatives_path), args.participant_label)
+    if not rows:
+        sys.exit("no bold runs found")
+    outputs = list(rows[0].keys())[4:]
+
+    listed = [r for r in rows if args.all or not all(r[o] for o in outputs)]
+    fd = open(args.tsv, "w") if args.tsv else sys.stdout
+    writer = csv.writer(fd, delimiter="\t", lineterminator="\n")
+    writer.writerow(list(rows[0].keys()))
+    for row in listed:
+        writer.writerow(
+            [v if k not in outputs else ("ok" if v else "MISSING") for k, v in row.items()]
+        )
+    if args.tsv:
+        fd.close()
+
+    complete = sum(all(r[o] for o in outputs) for r in rows)
+    print(
+        f"# {complete}/{len(rows)} runs complete, missing: "
+        + ", ".join(f"{o}: {sum(not r[o] for r in rows)}" for o in outputs),
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+"""Quantitative QC metrics of the fMRIPrep preprocessed BOLD runs.
+
+Each run is read once, in chunks of volumes (see mri/utils/nifti.py):
+uncompressed NIfTI and CIFTI dtseries are memory-mapped, .nii.gz are
+decompressed as a stream instead of being loaded whole. In the same pass are accumulated the voxelwise sums
+for the tSNR, the DVARS and global signal of each volume and a carpet of
+a regular sample of voxels/grayordinates. Runs are processed in a process
+pool and the results written in the derivatives dataset as:
+
+- `bold_metrics.tsv`: one row per run and space, loaded by qc.py
+- `bold_metrics_timeseries.npz`: global signal, DVARS and carpet of each run
+
+Runs already in the table are skipped unless `--force`.
+
+    python3 bold_qc.py <derivatives_path> [--space fsLR_den-91k] [--jobs 8]
+"""
+import os
+import sys
+import csv
+import glob
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import nibabel as nb
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from mri.utils import nifti
+
+CIFTI_SPACE = "fsLR_den-91k"
+METRICS_FILENAME = "bold_metrics.tsv"
+TIMESERIES_FILENAME = "bold_metrics_timeseries.npz"
+CARPET_ROWS = 400
+COLUMNS = [
+    "run",
+    "space",
+    "n_volumes",
+    "n_voxels",
+    "tsnr_median",
+    "tsnr_p5",
+    "dvars_mean",
+    "dvars_max",
+    "gs_mean",
+    "gs_std",
+]
+
+
+def bold_paths(derivatives_path, space):
+    if space == CIFTI_SPACE:
+        pattern = f"*_space-{space}_bold.dtseries.nii"
+    else:
+        pattern = f"*_space-{space}_desc-preproc_bold.nii*"
+    return sorted(
+        glob.glob(os.path.join(derivatives_path, "sub-*", "**", "func", pattern), recursive=True)
+    )
+
+
+def run_name(bold_path):
+    return os.path.basename(bold_path).split("_space-")[0]
+
+
+def brain_mask(bold_path):
+    """Flattened (file order) brain mask of a volume run, None if not found."""
+    mask_path = bold_path.split("_desc-preproc_bold")[0] + "_desc-brain_mask.nii.gz"
+    if not os.path.exists(mask_path):
+        return None
+    return np.asanyarray(nb.load(mask_path).dataobj).ravel(order="F") > 0
+
+
+def run_metrics(
+    bold_path, space, chunk_volumes=nifti.CHUNK_VOLUMES, carpet_rows=CARPET_ROWS
+):
+    """Metrics row and timeseries of a run, in a single pass over the data."""
+    mask = None if bold_path.endswith(".dtseries.nii") else brain_mask(bold_path)
+    shift = sums = sumsqs = previous = carpet_idx = None
+    global_signal, dvars, carpet = [], [], []
+    n_volumes = 0
+    for chunk in nifti.iter_volume_chunks(bold_path, chunk_volumes):
+        if shift is None:
+            if mask is None:
+                mask = chunk[0] != 0
+            chunk = chunk[:, mask]
+            # sums of the deviations to the first volume, for numerical stability
+            shift = chunk[0].astype(np.float64)
+            sums = np.zeros_like(shift)
+            sumsqs = np.zeros_like(shift)
+            carpet_idx = np.linspace(0, chunk.shape[1] - 1, min(carpet_rows, chunk.shape[1]))
+            carpet_idx = carpet_idx.astype(int)
+            previous = chunk[:1]
+        else:
+            chunk = chunk[:, mask]
+        deviations = chunk - shift
+        sums += deviations.sum(axis=0)
+        sumsqs += np.einsum("ij,ij->j", deviations, deviations)
+        global_signal.append(chunk.mean(axis=1))
+        diffs = np.diff(np.concatenate([previous, chunk]), axis=0)
+        dvars.append(np.sqrt(np.einsum("ij,ij->i", diffs, diffs) / chunk.shape[1]))
+        carpet.append(chunk[:, carpet_idx].T)
+        previous = chunk[-1:]
+        n_volumes += chunk.shape[0]
+
+    mean = shift + sums / n_volumes
+    std = np.sqrt(np.maximum(sumsqs / n_volumes - (sums / n_volumes) ** 2, 0))
+    valid = (mean > 0) & (std > 0)
+    tsnr = mean[valid] / std[valid]
+    global_signal = np.concatenate(global_signal)
+    # first volume has no DVARS, expressed in % of the mean intensity as the global signal
+    dvars = np.concatenate([[np.nan], np.concatenate(dvars)[1:]])
+    gs_mean = float(global_signal.mean())
+    dvars_pct = 100 * dvars / gs_mean
+
+    carpet = np.concatenate(carpet, axis=1)
+    carpet = carpet - carpet.mean(axis=1, keepdims=True)
+    carpet_std = carpet.std(axis=1, keepdims=True)
+    carpet = carpet / np.where(carpet_std > 0, carpet_std, 1)
+
+    row = dict(
+        run=run_name(bold_path),
+        space=space,
+        n_volumes=n_volumes,
+        n_voxels=int(mask.sum()),
+        tsnr_median=float(np.median(tsnr)) if tsnr.size else np.nan,
+        tsnr_p5=float(np.percentile(tsnr, 5)) if tsnr.size else np.nan,
+        dvars_mean=float(np.nanmean(dvars_pct)),
+        dvars_max=float(np.nanmax(dvars_pct)),
+        gs_mean=gs_mean,
+        gs_std=float(100 * global_signal.std() / gs_mean),
+    )
+    timeseries = dict(
+        global_signal=global_signal.astype(np.float32),
+        dvars=dvars_pct.astype(np.float32),
+        carpet=carpet.astype(np.float16),
+    )
+    return row, timeseries
+
+
+def load_metrics(derivatives_path):
+    """Metrics rows by (run, space), empty if not computed yet."""
+    metrics_path = os.path.join(derivatives_path, METRICS_FILENAME)
+    if not os.path.exists(metrics_path):
+        return {}
+    with open(metrics_path) as fd:
+        return {(r["run"], r["space"]): r for r in csv.DictReader(fd, delimiter="\t")}
+
+
+def write_metrics(derivatives_path, rows, timeseries):
+    """Atomically write the table and add the new runs to the timeseries store."""
+    metrics_path = os.path.join(derivatives_path, METRICS_FILENAME)
+    with open(f"{metrics_path}.tmp", "w") as fd:
+        writer = csv.DictWriter(fd, COLUMNS, delimiter="\t", lineterminator="\n")
+        writer.writeheader()
+        for key in sorted(rows):
+            writer.writerow(
+                {k: f"{v:.4g}" if isinstance(v, float) else v for k, v in rows[key].items()}
+            )
+    os.replace(f"{metrics_path}.tmp", metrics_path)
+
+    store_path = os.path.join(derivatives_path, TIMESERIES_FILENAME)
+    arrays = {}
+    if os.path.exists(store_path):
+        with np.load(store_path) as store:
+            arrays = {k: store[k] for k in store.files}
+    arrays.update(timeseries)
+    np.savez_compressed(f"{store_path}.tmp.npz", **arrays)
+    os.replace(f"{store_path}.tmp.npz", store_path)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        description="compute tSNR, DVARS, global signal and carpets of the fMRIPrep bold runs",
+    )
+    parser.add_argument("derivatives_path", help="fmriprep derivatives dataset")
+    parser.add_argument(
+        "--space",
+        nargs="+",
+        default=[CIFTI_SPACE],
+        help="output spaces to process, fsLR_den-91k (dtseries) or volume templates",
+    )
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="runs processed in parallel")
+    parser.add_argument(
+        "--chunk-volumes", type=int, default=nifti.CHUNK_VOLUMES, help="volumes read at once"
+    )
+    parser.add_argument("--force", action="store_true", help="recompute runs already in the table")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    rows = {} if args.force else load_metrics(args.derivatives_path)
+    runs = [
+        (path, space)
+        for space in args.space
+        for path in bold_paths(args.derivatives_path, space)
+        if (run_name(path), space) not in rows
+    ]
+    timeseries = {}
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        results = executor.map(
+            run_metrics,
+            [path for path, _ in runs],
+            [space for _, space in runs],
+            [args.chunk_volumes] * len(runs),
+        )
+        for (path, _), (row, run_timeseries) in zip(runs, results):
+            print(path)
+            rows[(row["run"], row["space"])] = row
+            timeseries.update(
+                {f"{row['run']}_space-{row['space']}/{k}": v for k, v in run_timeseries.items()}
+            )
+    write_metrics(args.derivatives_path, rows, timeseries)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+"""Columnar compressed store of the fMRIPrep confounds timeseries.
+
+Each `*_desc-confounds_timeseries.tsv` is converted to a `.npz` next to it,
+with one deflate-compressed array per column, so that reading a few columns
+only decompresses those. A dataset-wide `confounds_index.json` lists the
+runs with their entities, number of volumes and columns, and
+`load_confounds` reads selected columns of many runs in a thread pool (zlib
+releases the GIL).
+
+    python3 confounds.py convert <derivatives_path> [--jobs N] [--drop-tsv]
+    python3 confounds.py index <derivatives_path>
+
+    import confounds
+    motion = confounds.load_confounds(deriv_path, ["trans_*", "rot_*"], task="rest")
+"""
+import os
+import re
+import csv
+import glob
+import json
+import fnmatch
+import zipfile
+import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
+
+CONFOUNDS_SUFFIX = "_desc-confounds_timeseries"
+INDEX_FILENAME = "confounds_index.json"
+LOAD_THREADS = 8
+# pybids entity names of the filename keys that differ
+ENTITY_KEYS = {"subject": "sub", "session": "ses", "acquisition": "acq", "direction": "dir"}
+# entities that pybids parses as integers, run=1 is run-01
+INT_ENTITIES = ["run", "echo"]
+
+
+def store_path(tsv_path):
+    return re.sub(r"\.tsv$", ".npz", tsv_path)
+
+
+def convert_run(tsv_path, dtype="float64", drop_tsv=False):
+    """Write the columnar store of a confounds TSV, returns its path."""
+    with open(tsv_path) as fd:
+        reader = csv.reader(fd, delimiter="\t")
+        columns = next(reader)
+        rows = [[np.nan if v in ("n/a", "") else float(v) for v in row] for row in reader]
+    data = np.asarray(rows, dtype=dtype).reshape(-1, len(columns))
+
+    out_path = store_path(tsv_path)
+    tmp_path = f"{out_path}.{os.getpid()}.tmp.npz"
+    np.savez_compressed(tmp_path, **{col: data[:, i] for i, col in enumerate(columns)})
+    os.replace(tmp_path, out_path)
+    if drop_tsv:
+        os.remove(tsv_path)
+    return out_path
+
+
+def run_entities(path):
+    name = os.path.basename(path).split(CONFOUNDS_SUFFIX)[0]
+    return dict(ent.split("-", 1) for ent in name.split("_") if "-" in ent)
+
+
+def store_columns(npz_path):
+    """Columns and number of volumes of a store, from the zip directory only."""
+    with zipfile.ZipFile(npz_path) as zf:
+        columns = [n[: -len(".npy")] for n in zf.namelist()]
+        with zf.open(zf.namelist()[0]) as fd:
+            version = np.lib.format.read_magic(fd)
+            if version == (1, 0):
+                shape = np.lib.format.read_array_header_1_0(fd)[0]
+            else:
+                shape = np.lib.format.read_array_header_2_0(fd)[0]
+    return columns, shape[0]
+
+
+def find_stores(derivatives_path):
+    return sorted(
+        glob.glob(
+            os.path.join(derivatives_path, "sub-*", "**", f"*{CONFOUNDS_SUFFIX}.npz"),
+            recursive=True,
+        )
+    )
+
+
+def build_index(derivatives_path):
+    """Write the index of the runs and columns of all the stores."""
+    runs = {}
+    for npz_path in find_stores(derivatives_path):
+        columns, n_volumes = store_columns(npz_path)
+        runs[os.path.relpath(npz_path, derivatives_path)] = dict(
+            entities=run_entities(npz_path), n_volumes=n_volumes, columns=columns
+        )
+    index_path = os.path.join(derivatives_path, INDEX_FILENAME)
+    with open(index_path, "w") as fd:
+        json.dump(dict(runs=runs), fd, indent=1)
+    return index_path
+
+
+def load_index(derivatives_path):
+    with open(os.path.join(derivatives_path, INDEX_FILENAME)) as fd:
+        return json.load(fd)["runs"]
+
+
+def select_columns(columns, patterns):
+    """Columns matching any of the patterns (fnmatch), in the patterns order."""
+    selected = []
+    for pattern in patterns:
+        selected += [c for c in columns if fnmatch.fnmatch(c, pattern) and c not in selected]
+    return selected
+
+
+def _load_run(npz_path, columns):
+    with np.load(npz_path) as store:
+        return np.stack([store[c] for c in columns], axis=1) if columns else None
+
+
+def entity_matches(key, stored, value):
+    """Whether a filename entity value matches a pybids filter value (or list of)."""
+    values = value if isinstance(value, (list, tuple, set)) else [value]
+    if stored is None:
+        return False
+    if key in INT_ENTITIES and stored.isdigit():
+        return any(str(v).isdigit() and int(v) == int(stored) for v in values)
+    return stored in [str(v) for v in values]
+
+
+def load_confounds(derivatives_path, patterns, max_workers=LOAD_THREADS, **entities):
+    """Selected columns of the runs matching `entities` (eg. subject="01", task="rest").
+
+    Returns a dict run path -> (columns, array of shape (n_volumes, n_columns)).
+    """
+    index = load_index(derivatives_path)
+    runs = {
+        path: select_columns(run["columns"], patterns)
+        for path, run in index.items()
+        if all(
+            entity_matches(
+                ENTITY_KEYS.get(ent, ent),
+                run["entities"].get(ENTITY_KEYS.get(ent, ent)),
+                value,
+            )
+            for ent, value in entities.items()
+        )
+    }
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        arrays = executor.map(
+            lambda item: _load_run(os.path.join(derivatives_path, item[0]), item[1]),
+            runs.items(),
+        )
+        return {
+            path: (columns, array)
+            for (path, columns), array in zip(runs.items(), arrays)
+        }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        description="convert fMRIPrep confounds to a columnar compressed store and index them",
+    )
+    parser.add_argument("action", choices=["convert", "index"])
+    parser.add_argument("derivatives_path", help="fmriprep derivatives dataset")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="conversion processes")
+    parser.add_argument(
+        "--float32",
+        action="store_true",
+        help="store single precision values, halves the size",
+    )
+    parser.add_argument(
+        "--drop-tsv",
+        action="store_true",
+        help="remove the TSV once converted (datalad save to drop them from the dataset)",
+    )
+    parser.add_argument(
+        "--force", action="store_true", help="convert runs that already have a store"
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.action == "convert":
+        tsv_paths = sorted(
+            glob.glob(
+                os.path.join(args.derivatives_path, "sub-*", "**", f"*{CONFOUNDS_SUFFIX}.tsv"),
+                recursive=True,
+            )
+        )
+        tsv_paths = [
+            p for p in tsv_paths if args.force or not os.path.exists(store_path(p))
+        ]
+        dtype = "float32" if args.float32 else "float64"
+        with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            for out_path in executor.map(
+                convert_run,
+                tsv_paths,
+                [dtype] * len(tsv_paths),
+                [args.drop_tsv] * len(tsv_paths),
+                chunksize=8,
+            ):
+                print(out_path)
+    print(build_index(args.derivatives_path))
+
+
+if __name__ == "__main__":
+    main()
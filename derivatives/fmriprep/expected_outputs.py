@@ -0,0 +1,55 @@
+"""Expected fMRIPrep func outputs of a bold run.
+
+Shared by fmriprep.py, to skip the runs already processed, and audit.py, to
+report the missing outputs, so that both agree on what a processed run is:
+the preprocessed bold in each of `OUTPUT_TEMPLATES`, the fsLR 91k dtseries
+and the confounds, as TSV or as its columnar store once converted by
+confounds.py (`--drop-tsv`). Output names keep all the entities of the bold
+run (acq, dir, part-mag, ...).
+"""
+import os
+
+import confounds
+
+OUTPUT_TEMPLATES = ["MNI152NLin2009cAsym", "T1w:res-iso2mm"]
+# spaces that are not templates, where fMRIPrep ignores resolution modifiers
+NONSTANDARD_SPACES = ["T1w", "anat", "func", "run", "sbref", "boldref", "fsnative"]
+
+
+def space_entities(space):
+    """Filename entities of an fMRIPrep --output-spaces spec, eg. MNI152NLin6Asym:res-2."""
+    template, *modifiers = space.split(":")
+    entities = f"space-{template}"
+    if template not in NONSTANDARD_SPACES:
+        entities += "".join(
+            f"_{mod}" for mod in modifiers if mod.startswith("res-") or mod.startswith("cohort-")
+        )
+    return entities
+
+
+def expected_run_outputs(bold_run):
+    """Expected outputs of a bold run: output name -> path in the derivatives."""
+    entities = bold_run.entities
+    prefix = os.path.basename(bold_run.path).split("_bold.nii")[0]
+    func_dir = os.path.join(
+        f"sub-{entities['subject']}",
+        *([f"ses-{entities['session']}"] if "session" in entities else []),
+        "func",
+    )
+    outputs = {
+        f"preproc_{space.split(':')[0]}": f"{prefix}_{space_entities(space)}_desc-preproc_bold.nii.gz"
+        for space in OUTPUT_TEMPLATES
+    }
+    outputs["dtseries_fsLR_91k"] = f"{prefix}_space-fsLR_den-91k_bold.dtseries.nii"
+    outputs["confounds"] = f"{prefix}_desc-confounds_timeseries.tsv"
+    return {name: os.path.join(func_dir, path) for name, path in outputs.items()}
+
+
+def run_outputs_present(bold_run, exists):
+    """Output name -> whether present, `exists(path)` tests a path relative to the derivatives."""
+    outputs = expected_run_outputs(bold_run)
+    present = {name: exists(path) for name, path in outputs.items()}
+    present["confounds"] = present["confounds"] or exists(
+        confounds.store_path(outputs["confounds"])
+    )
+    return present
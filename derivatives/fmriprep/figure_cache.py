@@ -0,0 +1,213 @@
+"""Precompressed variants and thumbnails of the fMRIPrep report figures, served by qc.py.
+
+The figure SVGs embed several MB of rasters. For each figure a process pool
+writes, in a cache folder, a gzip variant, a brotli variant (if the `brotli`
+module is installed) and a low-resolution PNG thumbnail (if `cairosvg` is
+installed). qc.py serves the variants with strong ETags, so that a figure
+is transferred once and then revalidated or served from the browser cache.
+
+Cache entries are named after the strong ETag of the figure: the annex key
+when annexed (the MD5 of the content), the sha1 of the content otherwise.
+
+    python3 figure_cache.py <derivatives_path> [--jobs N]
+"""
+import os
+import re
+import sys
+import gzip
+import hashlib
+import argparse
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import cairosvg
+except ImportError:
+    cairosvg = None
+
+FIGURE_CACHE_DIR = os.environ.get(
+    "DS_PREP_QC_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "ds_prep", "qc"),
+)
+# in order of preference
+ENCODINGS = [("br", ".br"), ("gzip", ".gz")]
+THUMBNAIL_WIDTH = 320
+PREPARE_WORKERS = 4
+
+_etags = {}
+
+
+def etag(path):
+    """Strong ETag of a figure, the sha1 of non-annexed content is memoized by mtime."""
+    real_path = os.path.realpath(path)
+    if f"{os.sep}annex{os.sep}objects{os.sep}" in real_path:
+        return os.path.basename(real_path)
+    st = os.stat(real_path)
+    key = (real_path, st.st_size, st.st_mtime_ns)
+    if key not in _etags:
+        sha1 = hashlib.sha1()
+        with open(real_path, "rb") as fd:
+            for block in iter(lambda: fd.read(1 << 20), b""):
+                sha1.update(block)
+        _etags[key] = sha1.hexdigest()
+    return _etags[key]
+
+
+def variant_path(cache_dir, tag, extension):
+    # annex keys are safe filenames, but keep the cache flat whatever the tag
+    return os.path.join(cache_dir, re.sub(r"[^\w.-]", "_", tag) + extension)
+
+
+def thumbnail_path(cache_dir, tag):
+    return variant_path(cache_dir, tag, "_thumbnail.png")
+
+
+def _write_atomic(path, data):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as fd:
+        fd.write(data)
+    os.replace(tmp_path, path)
+
+
+def missing(path, cache_dir=FIGURE_CACHE_DIR):
+    """Cache entries of a figure that are not written yet."""
+    tag = etag(path)
+    paths = [variant_path(cache_dir, tag, ".gz")]
+    if brotli is not None:
+        paths.append(variant_path(cache_dir, tag, ".br"))
+    if cairosvg is not None:
+        paths.append(thumbnail_path(cache_dir, tag))
+    return [p for p in paths if not os.path.exists(p)]
+
+
+def prepare(path, cache_dir=FIGURE_CACHE_DIR, thumbnail_width=THUMBNAIL_WIDTH):
+    """Write the missing compressed variants and thumbnail of a figure."""
+    todo = missing(path, cache_dir)
+    if not todo:
+        return path
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(path, "rb") as fd:
+        content = fd.read()
+    for out_path in todo:
+        if out_path.endswith(".gz"):
+            # no filename nor timestamp in the header, variants are reproducible
+            data = gzip.compress(content, compresslevel=9, mtime=0)
+        elif out_path.endswith(".br"):
+            data = brotli.compress(content, mode=brotli.MODE_TEXT, quality=11)
+        else:
+            data = cairosvg.svg2png(bytestring=content, output_width=thumbnail_width)
+        _write_atomic(out_path, data)
+    return path
+
+
+class FigureCache:
+    """Background preparation and lookup of the cached variants of figures.
+
+    Figures are prepared in a process pool, a figure requested before its
+    variants are written is served as is and queued.
+    """
+
+    def __init__(
+        self,
+        cache_dir=FIGURE_CACHE_DIR,
+        workers=PREPARE_WORKERS,
+        thumbnail_width=THUMBNAIL_WIDTH,
+    ):
+        self.cache_dir = cache_dir
+        self.thumbnail_width = thumbnail_width
+        self._executor = ProcessPoolExecutor(max_workers=workers)
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def _done(self, path, future):
+        with self._lock:
+            self._pending.discard(path)
+        if future.exception() is not None:
+            print(f"figure cache: failed to prepare {path}: {future.exception()}")
+
+    def schedule(self, paths):
+        """Queue the figures with missing variants that are not queued already."""
+        for path in paths:
+            with self._lock:
+                if path in self._pending:
+                    continue
+            try:
+                if not missing(path, self.cache_dir):
+                    continue
+            except FileNotFoundError:
+                continue
+            with self._lock:
+                self._pending.add(path)
+            future = self._executor.submit(
+                prepare, path, self.cache_dir, self.thumbnail_width
+            )
+            future.add_done_callback(lambda f, path=path: self._done(path, f))
+
+    def variant(self, path, accept_encoding=""):
+        """(file, content encoding or None, strong ETag) to serve for a figure."""
+        tag = etag(path)
+        accepted = {e.split(";")[0].strip() for e in accept_encoding.split(",")}
+        for encoding, extension in ENCODINGS:
+            cached = variant_path(self.cache_dir, tag, extension)
+            if encoding in accepted and os.path.exists(cached):
+                # a strong ETag identifies the representation, not the resource
+                return cached, encoding, f"{tag}-{encoding}"
+        self.schedule([path])
+        return path, None, tag
+
+    def thumbnail(self, path):
+        """(thumbnail file, strong ETag), None if not rendered (yet)."""
+        tag = etag(path)
+        cached = thumbnail_path(self.cache_dir, tag)
+        if os.path.exists(cached):
+            return cached, f"{tag}-thumbnail"
+        if cairosvg is not None:
+            self.schedule([path])
+        return None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        description="precompress and thumbnail the fMRIPrep report figures for qc.py",
+    )
+    parser.add_argument("derivatives_path", help="fmriprep derivatives dataset")
+    parser.add_argument(
+        "--cache-dir", default=FIGURE_CACHE_DIR, help="cache folder ($DS_PREP_QC_CACHE)"
+    )
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="figures prepared in parallel")
+    parser.add_argument(
+        "--thumbnail-width", type=int, default=THUMBNAIL_WIDTH, help="thumbnail width in pixels"
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if cairosvg is None:
+        print("cairosvg is not installed, thumbnails are not rendered", file=sys.stderr)
+    paths = sorted(
+        entry.path
+        for subject in os.scandir(args.derivatives_path)
+        if subject.name.startswith("sub-") and subject.is_dir()
+        and os.path.isdir(os.path.join(subject.path, "figures"))
+        for entry in os.scandir(os.path.join(subject.path, "figures"))
+        if entry.name.endswith(".svg")
+    )
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        for path in executor.map(
+            prepare,
+            paths,
+            [args.cache_dir] * len(paths),
+            [args.thumbnail_width] * len(paths),
+            chunksize=16,
+        ):
+            print(path)
+
+
+if __name__ == "__main__":
+    main()
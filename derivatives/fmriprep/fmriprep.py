@@ -5,32 +5,62 @@ import argparse
 import bids
 import subprocess
 import json
+import math
 import re
 import pathlib
 import shutil
 import datalad.api
 
+import resources
+import expected_outputs
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from mri.utils import slurm, git_tree, bids_index
+
 script_dir = os.path.dirname(__file__)
 
-PYBIDS_CACHE_PATH = ".pybids_cache"
 SLURM_JOB_DIR = "code"
+# snapshots of the pybids index read by the queued jobs
+BIDS_INDEX_DIR = "bids_index"
 
 SMRIPREP_REQ = {"cpus": 8, "mem_per_cpu": 4096, "time": "24:00:00", "omp_nthreads": 8}
 FMRIPREP_REQ = {"cpus": 12, "mem_per_cpu": 4096, "time": "12:00:00", "omp_nthreads": 8}
 
+# branches pushed by func jobs, scanned for outputs not merged yet
+JOB_BRANCHES_PATTERNS = ["fmriprep_study-*"]
+
+# whole node budget split between the jobs packed in a single allocation
+NODE_REQ = {"cpus": 40, "mem_per_cpu": 4608, "omp_nthreads": 8}
+
+# entities (pybids name, filename key) of the bold series split in separate jobs
+RUN_GROUP_ENTITIES = [("acquisition", "acq"), ("direction", "dir")]
+
+# job specs varying across the tasks of a job array
+ARRAY_TASK_FIELDS = ["jobname", "subject", "session", "subject_session", "bids_filters_path"]
+
 BIDS_FILTERS_FILE = os.path.join(script_dir, "bids_filters.json")
+# copy of the shared pybids index relocated in the job clone
+BIDS_DATABASE_DIR = "./workdir/bids_db"
 
 TEMPLATEFLOW_HOME = os.path.join(
     os.environ.get("SCRATCH", os.path.join(os.environ["HOME"], ".cache")),
     "templateflow",
 )
-OUTPUT_TEMPLATES = ["MNI152NLin2009cAsym", "T1w:res-iso2mm"]
+FMRIPREP_CONTAINER = "bids-fmriprep"
+# path of the job clone as seen by fMRIPrep in the container
+CONTAINER_DATASET_PATH = "/ds"
+# failed jobs copy their clone here, to be resumed with --retry
+FAILED_JOBS_DIR = os.path.join("/scratch", os.environ.get("USER", ""))
+NODE_CACHE_SCRIPT = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "..", "mri", "utils", "node_cache.py"
+)
+OUTPUT_TEMPLATES = expected_outputs.OUTPUT_TEMPLATES
 REQUIRED_TEMPLATES = ["MNI152NLin2009cAsym", "OASIS30ANTs", "fsLR", "fsaverage", "MNI152NLin6Asym"]
 SINGULARITY_CMD_BASE = " ".join(
     [
         "datalad containers-run "
-        "-m 'fMRIPrep_{subject_session}'",
-        "-n bids-fmriprep",
+        "-m \"fMRIPrep_{subject_session}\"",
+        "-n %s" % FMRIPREP_CONTAINER,
     ] + [
         "--input sourcedata/templateflow/tpl-%s/"% tpl for tpl in REQUIRED_TEMPLATES
     ] + [
@@ -60,11 +90,16 @@ set -e -u -x
 
 datalad_pre = """
 export LOCAL_DATASET=$SLURM_TMPDIR/${{SLURM_JOB_NAME//-/}}/
-export SINGULARITYENV_TEMPLATEFLOW_HOME="${{LOCAL_DATASET}}/sourcedata/templateflow/"
+# run fMRIPrep with the dataset at a fixed path, so that the paths hashed by
+# nipype are the same across jobs and a saved workdir can be reused
+export SINGULARITY_BIND="${{LOCAL_DATASET}}:{container_dataset_path}" APPTAINER_BIND="${{LOCAL_DATASET}}:{container_dataset_path}"
+export SINGULARITY_PWD={container_dataset_path} APPTAINER_PWD={container_dataset_path}
+export SINGULARITYENV_TEMPLATEFLOW_HOME="{container_dataset_path}/sourcedata/templateflow/"
 flock --verbose {ds_lockfile} datalad clone {output_repo} $LOCAL_DATASET
 cd $LOCAL_DATASET
 datalad get -s ria-beluga-storage -J 4 -n -r -R1 . # get sourcedata/* containers
-datalad get -s ria-beluga-storage -J 4 -r sourcedata/templateflow/tpl-{{{templates}}}
+# templates and container image through the node-local cache shared by jobs
+python3 {node_cache_script} get -s ria-beluga-storage -J 4 --container {container} -- sourcedata/templateflow/tpl-{{{templates}}}
 if [ -d sourcedata/smriprep ] ; then
     datalad get -n sourcedata/smriprep sourcedata/smriprep/sourcedata/freesurfer
 fi
@@ -84,50 +119,42 @@ if [ -d sourcedata/freesurfer ] ; then
     flock --verbose {ds_lockfile} datalad push -J 4 -d sourcedata/freesurfer --to origin
 fi 
 """
-def load_bidsignore(bids_root, mode="python"):
-    """Load .bidsignore file from a BIDS dataset, returns list of regexps"""
-    bids_ignore_path = bids_root / ".bidsignore"
-    if bids_ignore_path.exists():
-        bids_ignores = bids_ignore_path.read_text().splitlines()
-        if mode == 'python':
-            import re
-            import fnmatch
-            
-            return tuple(
-                [
-                    re.compile(fnmatch.translate(bi))
-                    for bi in bids_ignores
-                    if len(bi) and bi.strip()[0] != "#"
-                ]
-            )
-        elif mode == 'bash':
-            return [
-                f"m/{bi}/"
-                for bi in bids_ignores
-                if len(bi) and bi.strip()[0] != "#"
-            ]
-    return tuple()
-
-
 def write_job_footer(fd, jobname):
-    # TODO: copy resource monitor output
+    failed_job_path = os.path.join(FAILED_JOBS_DIR, jobname)
+    # resource monitor output is used by resources.py to fit the resource model
+    fd.write(
+        f"if [ -e $LOCAL_DATASET/workdir/fmriprep_wf/resource_monitor.json ] ; then cp $LOCAL_DATASET/workdir/fmriprep_wf/resource_monitor.json {FAILED_JOBS_DIR}/{jobname}_resource_monitor.json ; fi \n"
+    )
+    # keep the clone with its nipype workdir for --retry, drop it once the job succeeded
     fd.write(
-        f"if [ -e $LOCAL_DATASET/workdir/fmriprep_wf/resource_monitor.json ] ; then cp $LOCAL_DATASET/workdir/fmriprep_wf/resource_monitor.json /scratch/{os.environ['USER']}/{jobname}_resource_monitor.json ; fi \n"
+        f"if [ -d {failed_job_path} ] ; then chmod -R u+w {failed_job_path} ; rm -rf {failed_job_path} ; fi \n"
     )
     fd.write(
-        f"if [ $fmriprep_exitcode -ne 0 ] ; then cp -R $LOCAL_DATASET /scratch/{os.environ['USER']}/{jobname} ; fi \n"
+        f"if [ $fmriprep_exitcode -ne 0 ] ; then cp -R $LOCAL_DATASET {failed_job_path} ; fi \n"
+    )
+    slurm.write_job_exit(fd, "fmriprep_exitcode")
+
+
+def write_restore_workdir(fd, jobname):
+    """Restore the nipype workdir saved by a failed run of the job, if any."""
+    failed_workdir = os.path.join(FAILED_JOBS_DIR, jobname, "workdir")
+    fd.write(
+        f"if [ -d {failed_workdir} ] ; then cp -a {failed_workdir} ./ ; fi\n"
     )
-    fd.write("exit $fmriprep_exitcode \n")
 
 
-def write_fmriprep_job(layout, subject, args, anat_only=True, longitudinal=False):
+def fmriprep_job_specs(layout, subject, args, anat_only=True, longitudinal=False):
     derivatives_path = os.path.realpath(os.path.abspath(args.output_path))
 
     study = os.path.basename(layout.root)
     
     job_specs = dict(
+        pipe="anat" if anat_only else "all",
+        anat_only=anat_only,
+        longitudinal=longitudinal,
         study=study,
         subject=subject,
+        session=None,
         subject_session=f"sub-{subject}" + (f"/ses-{args.session_label}" if args.session_label else "/ses-*"),
         slurm_account=args.slurm_account,
         jobname=f"{'s' if anat_only else 'f'}mriprep_sub-{subject}",
@@ -138,78 +165,64 @@ def write_fmriprep_job(layout, subject, args, anat_only=True, longitudinal=False
         ds_lockfile=os.path.join(args.output_repo.replace('ria+file://','').replace('#~','/alias/').split('@')[0], '.datalad_lock'),
         TEMPLATEFLOW_HOME=TEMPLATEFLOW_HOME,
         templates=",".join(REQUIRED_TEMPLATES),
+        container=FMRIPREP_CONTAINER,
+        container_dataset_path=CONTAINER_DATASET_PATH,
+        node_cache_script=os.path.realpath(NODE_CACHE_SCRIPT),
     )
     job_specs.update(SMRIPREP_REQ)
     if args.longitudinal:
         job_specs['time'] = '72:0:0'
 
-    job_path = os.path.join(derivatives_path, SLURM_JOB_DIR, f"{job_specs['jobname']}.sh")
+    job_specs["job_path"] = os.path.join(derivatives_path, SLURM_JOB_DIR, f"{job_specs['jobname']}.sh")
 
     # use json load/dump to copy filters (and validate json in the meantime)
-    bids_filters_path = os.path.join(
+    job_specs["bids_filters_path"] = os.path.join(
         SLURM_JOB_DIR,
         "bids_filters.json")
     bids_filters = json.load(open(BIDS_FILTERS_FILE))
-    with open(bids_filters_path, 'w') as f:
+    with open(job_specs["bids_filters_path"], 'w') as f:
         json.dump(bids_filters, f)
 
-    pybids_cache_path = os.path.join(layout.root, PYBIDS_CACHE_PATH)
+    return job_specs
 
-    with open(job_path, "w") as f:
-        f.write(slurm_preamble.format(**job_specs))
-        f.write(datalad_pre.format(**job_specs))
 
-        
-        f.write(
-            " ".join(
-                [
-                    SINGULARITY_CMD_BASE.format(**job_specs),
-                    # too large scope, but only a few MB unnecessary pulled
-                    "--input 'sourcedata/{study}/{subject_session}/anat/*_T1w.nii.gz'".format(**job_specs),
-                    "--input 'sourcedata/{study}/{subject_session}/anat/*_T2w.nii.gz'".format(**job_specs),
-                    "--input 'sourcedata/{study}/{subject_session}/anat/*_FLAIR.nii.gz'".format(**job_specs),
-                    "--",
-                    "-w ./workdir",
-                    f"--participant-label {subject}",
-                    "--anat-only" if anat_only else "",
-#                    f"--bids-database-dir {pybids_cache_path}",
-                    f"--bids-filter-file {bids_filters_path}",
-                    "--output-layout bids",
-                    "--output-spaces",
-                    " ".join(OUTPUT_TEMPLATES), "MNI152NLin6Asym",
-                    "--cifti-output 91k",
-                    "--skip_bids_validation",
-                    "--write-graph",
-                    f"--omp-nthreads {job_specs['omp_nthreads']}",
-                    f"--nprocs {job_specs['cpus']}",
-                    f"--mem_mb {job_specs['mem_per_cpu']*job_specs['cpus']}",
-                    "--fs-license-file", 'code/freesurfer.license',
-                    "--longitudinal" if longitudinal else "",
-                    str(args.bids_path.relative_to(args.output_path)),
-                    "./",
-                    "participant",
-                    "\n",
-                ]
-            )
+def write_fmriprep_command(fd, job_specs, args):
+    fd.write(
+        " ".join(
+            [
+                SINGULARITY_CMD_BASE.format(**job_specs),
+                # too large scope, but only a few MB unnecessary pulled
+                "--input \"sourcedata/{study}/{subject_session}/anat/*_T1w.nii.gz\"".format(**job_specs),
+                "--input \"sourcedata/{study}/{subject_session}/anat/*_T2w.nii.gz\"".format(**job_specs),
+                "--input \"sourcedata/{study}/{subject_session}/anat/*_FLAIR.nii.gz\"".format(**job_specs),
+                "--",
+                "-w ./workdir",
+                f"--participant-label {job_specs['subject']}",
+                "--anat-only" if job_specs["anat_only"] else "",
+                f"--bids-database-dir {BIDS_DATABASE_DIR}",
+                f"--bids-filter-file {job_specs['bids_filters_path']}",
+                "--output-layout bids",
+                "--output-spaces",
+                " ".join(OUTPUT_TEMPLATES), "MNI152NLin6Asym",
+                "--cifti-output 91k",
+                "--skip_bids_validation",
+                "--write-graph",
+                f"--omp-nthreads {job_specs['omp_nthreads']}",
+                f"--nprocs {job_specs['cpus']}",
+                f"--mem_mb {job_specs['mem_per_cpu']*job_specs['cpus']}",
+                "--fs-license-file", 'code/freesurfer.license',
+                "--longitudinal" if job_specs["longitudinal"] else "",
+                str(args.bids_path.relative_to(args.output_path)),
+                "./",
+                "participant",
+                "\n",
+            ]
         )
-        f.write("fmriprep_exitcode=$?\n")
-        f.write(datalad_post.format(**job_specs))
-        write_job_footer(f, job_specs["jobname"])
-
-        return job_path
-
-
-def write_func_job(layout, subject, session, args):
-    outputs_exist = False
-    study = os.path.basename(layout.root)
-
-    derivatives_path = os.path.realpath(args.output_path)
-    anat_path = os.path.join(
-        derivatives_path,
-        "sourcedata",
-        "smriprep",
     )
 
+
+def session_bold_runs(layout, subject, session):
+    """Bold runs of a session, only the magnitude if it contains phase data."""
     bold_runs = layout.get(
         subject=subject,
         session=session if session else bids.layout.Query.NONE,
@@ -227,71 +240,130 @@ def write_func_job(layout, subject, session, args):
             suffix="bold",
             part='mag',
         )
+    return bold_runs, contains_phase_data
+
+
+def bold_outputs_exist(bold_run, subject, session, derivatives_path, existing_outputs=None):
+    """Whether all the expected outputs of a run (see expected_outputs.py) exist."""
+    if existing_outputs is not None:
+        exists = existing_outputs.__contains__
+    else:
+        # test if file or symlink (even broken if git-annex and not pulled)
+        exists = lambda path: os.path.lexists(os.path.join(derivatives_path, path))
+    present = expected_outputs.run_outputs_present(bold_run, exists)
+    bold_deriv = all(present.values())
+    if bold_deriv:
+        print(f"found existing derivatives for {bold_run.path}")
+    return bold_deriv
+
+
+def func_job_specs(layout, subject, session, args, existing_outputs=None):
+    """Job specs of the func job of a session.
+
+    `existing_outputs` is the set of paths, relative to the derivatives
+    dataset, committed on the main or job branches (see `list_existing_outputs`),
+    the local checkout is tested if not provided.
+    """
+    derivatives_path = os.path.realpath(args.output_path)
+    bold_runs, contains_phase_data = session_bold_runs(layout, subject, session)
     if len(bold_runs) == 0:
         print(f"No bold runs found for {subject} {session}")
 
-    bold_derivatives = []
-    for bold_run in bold_runs:
-        entities = bold_run.entities
-        entities = [
-            (ent, entities[ent])
-            for ent in ["subject", "session", "task", "run"]
-            if ent in entities
-        ]
-        preproc_entities = entities + [
-            ("space", OUTPUT_TEMPLATES[0]),
-            ("desc", "preproc"),
+    outputs_exist = all(
+        [
+            bold_outputs_exist(bold_run, subject, session, derivatives_path, existing_outputs)
+            for bold_run in bold_runs
         ]
-        dtseries_entities = entities + [("space", "fsLR"), ("den", "91k")]
-        func_path = os.path.join(
-            derivatives_path,
-            "fmriprep",
-            f"sub-{subject}",
-            f"ses-{session}",
-            "func",
-        )
+    )
+    job_specs = _func_job_specs(
+        layout, subject, session, bold_runs, contains_phase_data, args
+    )
+    return job_specs, outputs_exist
 
-        
-        preproc_path = os.path.join(
-            func_path,
-            "_".join(
-                [
-                    "%s-%s" % (k[:3] if k in ["subject", "session"] else k, v)
-                    for k, v in preproc_entities
-                ]
-            )
-            + "_bold.nii.gz",
-        )
-        dtseries_path = os.path.join(
-            func_path,
-            "_".join(
-                [
-                    "%s-%s" % (k[:3] if k in ["subject", "session"] else k, v)
-                    for k, v in dtseries_entities
-                ]
-            )
-            + "_bold.dtseries.nii",
+
+def func_run_group_job_specs(layout, subject, session, args, existing_outputs=None):
+    """Job specs of the func jobs of a session split in groups of runs.
+
+    Runs without outputs are grouped by task, acquisition and direction in
+    chunks of `args.runs_per_job` runs (with all their echoes), each job
+    restricting its bids filters to its series and runs. Jobs are named after
+    their series and runs, so that regenerating the jobs of a partially
+    processed session does not reuse the branch name of a previous group.
+    """
+    derivatives_path = os.path.realpath(args.output_path)
+    bold_runs, contains_phase_data = session_bold_runs(layout, subject, session)
+    bold_runs = [
+        bold_run
+        for bold_run in bold_runs
+        if not bold_outputs_exist(bold_run, subject, session, derivatives_path, existing_outputs)
+    ]
+
+    series_runs = {}
+    for bold_run in bold_runs:
+        key = (bold_run.entities.get("task"),) + tuple(
+            bold_run.entities.get(ent) for ent, _ in RUN_GROUP_ENTITIES
         )
-        # test if file or symlink (even broken if git-annex and not pulled)
-        bold_deriv = os.path.lexists(preproc_path) and os.path.lexists(dtseries_path)
-        if bold_deriv:
-            print(
-                f"found existing derivatives for {bold_run.path} : {preproc_path}, {dtseries_path}"
+        # echoes of a run stay in the same job, to be combined by fMRIPrep
+        series_runs.setdefault(key, {}).setdefault(
+            bold_run.entities.get("run"), []
+        ).append(bold_run)
+
+    jobs = []
+    for (task, *values), runs_echoes in sorted(
+        series_runs.items(), key=lambda item: [str(v) for v in item[0]]
+    ):
+        runs = sorted(runs_echoes, key=lambda r: r or 0)
+        for group_start in range(0, len(runs), args.runs_per_job):
+            group_runs = runs[group_start : group_start + args.runs_per_job]
+            group = [b for run in group_runs for b in runs_echoes[run]]
+            run_filters = {"task": task}
+            jobname_suffix = f"_task-{task}"
+            for (ent, short), value in zip(RUN_GROUP_ENTITIES, values):
+                # null (Query.NONE in fMRIPrep) excludes the series with this entity
+                run_filters[ent] = value
+                if value is not None:
+                    jobname_suffix += f"_{short}-{value}"
+            run_numbers = [run for run in group_runs if run is not None]
+            if run_numbers:
+                run_filters["run"] = run_numbers
+                jobname_suffix += f"_runs-{run_numbers[0]}-{run_numbers[-1]}"
+            jobs.append(
+                _func_job_specs(
+                    layout,
+                    subject,
+                    session,
+                    group,
+                    contains_phase_data,
+                    args,
+                    run_filters=run_filters,
+                    jobname_suffix=jobname_suffix,
+                )
             )
-        bold_derivatives.append(bold_deriv)
-    outputs_exist = all(bold_derivatives)
-    # n_runs = len(bold_runs)
-    # run_shapes = [run.get_image().shape for run in bold_runs]
-    # run_lengths = [rs[-1] for rs in run_shapes]
+    return jobs
+
+
+def _func_job_specs(
+    layout,
+    subject,
+    session,
+    bold_runs,
+    contains_phase_data,
+    args,
+    run_filters=None,
+    jobname_suffix="",
+):
+    study = os.path.basename(layout.root)
+    derivatives_path = os.path.realpath(args.output_path)
 
     subject_session = f"sub-{subject}" + (f"/ses-{session}" if session not in [None,'*'] else "")
     job_specs = dict(
+        pipe="func",
         study=study,
         subject=subject,
         session=session,
         subject_session=subject_session,
         slurm_account=args.slurm_account,
-        jobname=f"fmriprep_study-{study}_sub-{subject}"+ (f"_ses-{session}" if session not in [None, '*'] else ""),
+        jobname=f"fmriprep_study-{study}_sub-{subject}"+ (f"_ses-{session}" if session not in [None, '*'] else "") + jobname_suffix,
         email=args.email,
         bids_root=layout.root,
         derivatives_path=derivatives_path,
@@ -299,21 +371,46 @@ def write_func_job(layout, subject, session, args):
         ds_lockfile=os.path.join(args.output_repo.replace('ria+file://','').replace('#~','/alias/').split('@')[0], '.datalad_lock'),
         TEMPLATEFLOW_HOME=TEMPLATEFLOW_HOME,
         templates=",".join(REQUIRED_TEMPLATES),
+        container=FMRIPREP_CONTAINER,
+        container_dataset_path=CONTAINER_DATASET_PATH,
+        node_cache_script=os.path.realpath(NODE_CACHE_SCRIPT),
     )
-    job_specs.update(FMRIPREP_REQ)
+    job_features = resources.job_features(bold_runs)
+    if args.resource_model:
+        job_specs.update(
+            resources.predict_job_specs(
+                resources.load_resource_model(args.resource_model),
+                job_features,
+                FMRIPREP_REQ,
+            )
+        )
+    else:
+        job_specs.update(FMRIPREP_REQ)
 
-    job_path = os.path.join(derivatives_path, SLURM_JOB_DIR, f"{job_specs['jobname']}.sh")
-    bids_filters_path = os.path.join(
+    job_specs["job_path"] = os.path.join(derivatives_path, SLURM_JOB_DIR, f"{job_specs['jobname']}.sh")
+    job_specs["bids_filters_path"] = bids_filters_path = os.path.join(
         SLURM_JOB_DIR,
         f"{job_specs['jobname']}_bids_filters.json"
     )
-
-    pybids_cache_path = os.path.join(layout.root, PYBIDS_CACHE_PATH)
+    # keep track of job size and request to fit resources model
+    with open(os.path.join(SLURM_JOB_DIR, f"{job_specs['jobname']}_resources.json"), "w") as f:
+        json.dump(
+            dict(
+                jobname=job_specs["jobname"],
+                features=job_features,
+                request={k: job_specs[k] for k in FMRIPREP_REQ},
+            ),
+            f,
+        )
 
     # filter for session
     bids_filters = json.load(open(BIDS_FILTERS_FILE))
     for acq in ["bold","sbref","fmap"]:
         bids_filters[acq].update({"session": [session]})
+    if run_filters:
+        # fmaps of the whole session stay available for distortion correction
+        for acq in ["bold","sbref"]:
+            bids_filters[acq].update(run_filters)
     if contains_phase_data:
         for acq in ["bold","sbref"]:
             bids_filters[acq].update({"part": "mag"})
@@ -321,55 +418,146 @@ def write_func_job(layout, subject, session, args):
         json.dump(bids_filters, f)
 
 
-    with open(job_path, "w") as f:
+    return job_specs
+
+
+def write_func_command(fd, job_specs, args):
+    study, subject, subject_session = (
+        job_specs["study"], job_specs["subject"], job_specs["subject_session"]
+    )
+
+    fd.write(
+        " ".join(
+            [
+                SINGULARITY_CMD_BASE.format(**job_specs),
+                f"--input \"sourcedata/{study}/{subject_session}/fmap/\"",
+                f"--input \"sourcedata/{study}/{subject_session}/func/\"",
+                
+                f"--input \"sourcedata/smriprep/sub-{subject}/anat/\"",
+                f"--input sourcedata/smriprep/sourcedata/freesurfer/fsaverage/",
+                f"--input sourcedata/smriprep/sourcedata/freesurfer/sub-{subject}/",
+                "--",
+                "-w ./workdir",
+                f"--participant-label {subject}",
+                "--anat-derivatives ./sourcedata/smriprep",
+                "--fs-subjects-dir ./sourcedata/smriprep/sourcedata/freesurfer",
+                f"--bids-database-dir {BIDS_DATABASE_DIR}",
+                f"--bids-filter-file {job_specs['bids_filters_path']}",
+                "--output-layout bids",
+                "--ignore slicetiming" if not args.slicetiming else "",
+                "--use-syn-sdc",
+                "--output-spaces",
+                *OUTPUT_TEMPLATES,
+                "--cifti-output 91k",
+                "--notrack",
+                "--write-graph",
+                "--skip_bids_validation",
+                f"--omp-nthreads {job_specs['omp_nthreads']}",
+                f"--nprocs {job_specs['cpus']}",
+                f"--mem_mb {job_specs['mem_per_cpu']*job_specs['cpus']}",
+                "--fs-license-file", 'code/freesurfer.license',
+                # monitor resources to fit the model of runtime/cpu/ram of func data
+                "--resource-monitor",
+                str(args.bids_path.relative_to(args.output_path)),
+                "./",
+                "participant",
+                "\n",
+            ]
+        )
+    )
+
+
+def write_job_body(fd, job_specs, args):
+    fd.write(datalad_pre.format(**job_specs))
+    if args.retry:
+        write_restore_workdir(fd, job_specs["jobname"])
+    fd.write(
+        bids_index.job_index_cmd(
+            job_specs["bids_root"],
+            str(args.bids_path.relative_to(args.output_path)),
+            BIDS_DATABASE_DIR,
+            job_root=CONTAINER_DATASET_PATH,
+            snapshot_dir=os.path.join(job_specs["derivatives_path"], SLURM_JOB_DIR, BIDS_INDEX_DIR),
+        )
+    )
+    # do not exit on fMRIPrep failure, the footer saves the clone for --retry
+    fd.write("set +e\n")
+    if job_specs["pipe"] == "func":
+        write_func_command(fd, job_specs, args)
+    else:
+        write_fmriprep_command(fd, job_specs, args)
+    fd.write("fmriprep_exitcode=$?\nset -e\n")
+    # a failed job only keeps its scratch copy: a pushed branch would be taken
+    # for outputs and reject the push of the --retry job of the same name
+    fd.write("if [ $fmriprep_exitcode -eq 0 ] ; then\n")
+    fd.write(datalad_post.format(**job_specs))
+    fd.write("fi\n")
+    write_job_footer(fd, job_specs["jobname"])
+
+
+def write_job(job_specs, args):
+    with open(job_specs["job_path"], "w") as f:
         f.write(slurm_preamble.format(**job_specs))
-        f.write(datalad_pre.format(**job_specs))
+        write_job_body(f, job_specs, args)
+    return job_specs["job_path"]
 
-        f.write(
-            " ".join(
-                [
-                    SINGULARITY_CMD_BASE.format(**job_specs),
-                    f"--input 'sourcedata/{study}/{subject_session}/fmap/'",
-                    f"--input 'sourcedata/{study}/{subject_session}/func/'",
-                    
-                    f"--input 'sourcedata/smriprep/sub-{subject}/anat/'",
-                    f"--input sourcedata/smriprep/sourcedata/freesurfer/fsaverage/",
-                    f"--input sourcedata/smriprep/sourcedata/freesurfer/sub-{subject}/",
-                    "--",
-                    "-w ./workdir",
-                    f"--participant-label {subject}",
-                    "--anat-derivatives ./sourcedata/smriprep",
-                    "--fs-subjects-dir ./sourcedata/smriprep/sourcedata/freesurfer",
-#                    f"--bids-database-dir {pybids_cache_path}",
-                    f"--bids-filter-file {bids_filters_path}",
-                    "--output-layout bids",
-                    "--ignore slicetiming" if not args.slicetiming else "",
-                    "--use-syn-sdc",
-                    "--output-spaces",
-                    *OUTPUT_TEMPLATES,
-                    "--cifti-output 91k",
-                    "--notrack",
-                    "--write-graph",
-                    "--skip_bids_validation",
-                    f"--omp-nthreads {job_specs['omp_nthreads']}",
-                    f"--nprocs {job_specs['cpus']}",
-                    f"--mem_mb {job_specs['mem_per_cpu']*job_specs['cpus']}",
-                    "--fs-license-file", 'code/freesurfer.license',
-                    # monitor resources to design a heuristic for runtime/cpu/ram of func data
-                    #"--resource-monitor",
-                    str(args.bids_path.relative_to(args.output_path)),
-                    "./",
-                    "participant",
-                    "\n",
-                ]
+
+def write_array_job(jobs, args):
+    """Write a single job array script running `jobs`, with its TSV manifest."""
+    array_name = f"{jobs[0]['pipe']}_fmriprep_study-{jobs[0]['study']}_array"
+    job_dir = os.path.join(jobs[0]["derivatives_path"], SLURM_JOB_DIR)
+    job_path = os.path.join(job_dir, f"{array_name}.sh")
+    manifest_path = os.path.join(job_dir, f"{array_name}_manifest.tsv")
+    slurm.write_array_manifest(manifest_path, jobs, ARRAY_TASK_FIELDS)
+
+    job_specs = slurm.array_job_specs(jobs, ARRAY_TASK_FIELDS)
+    with open(job_path, "w") as f:
+        f.write(slurm_preamble.format(**dict(job_specs, jobname=array_name)))
+        slurm.write_array_task_header(f, manifest_path, ARRAY_TASK_FIELDS)
+        write_job_body(f, job_specs, args)
+    return job_path
+
+
+def write_packed_job(jobs, pack_idx, args):
+    """Write a whole-node job running `jobs` concurrently.
+
+    The node cpus and memory are split evenly between the jobs, each one
+    runs in a subshell named after the job it replaces, so that it gets its
+    own local clone, datalad branch, logs and scratch copy on failure.
+    """
+    pack_name = f"{jobs[0]['pipe']}_fmriprep_study-{jobs[0]['study']}_pack-{pack_idx:03d}"
+    job_dir = os.path.join(jobs[0]["derivatives_path"], SLURM_JOB_DIR)
+    job_path = os.path.join(job_dir, f"{pack_name}.sh")
+    cpus = args.node_cpus // len(jobs)
+    task_req = dict(
+        cpus=cpus,
+        mem_per_cpu=args.node_mem_per_cpu,
+        omp_nthreads=min(cpus, NODE_REQ["omp_nthreads"]),
+    )
+    pack_specs = dict(
+        jobs[0],
+        jobname=pack_name,
+        cpus=args.node_cpus,
+        mem_per_cpu=args.node_mem_per_cpu,
+        time=slurm.format_walltime(max(slurm.parse_walltime(j["time"]) for j in jobs)),
+    )
+
+    with open(job_path, "w") as f:
+        f.write(slurm_preamble.format(**pack_specs))
+        f.write("pids=()\n")
+        for job_specs in jobs:
+            f.write(f"(\nexport SLURM_JOB_NAME={job_specs['jobname']}.job\n")
+            write_job_body(f, dict(job_specs, **task_req), args)
+            f.write(
+                f") > {job_dir}/{job_specs['jobname']}.out 2> {job_dir}/{job_specs['jobname']}.err &\n"
+                "pids+=($!)\n"
             )
+        f.write(
+            "pack_exitcode=0\n"
+            'for pid in "${pids[@]}" ; do wait $pid || pack_exitcode=$? ; done\n'
+            "exit $pack_exitcode\n"
         )
-        f.write("fmriprep_exitcode=$?\n")
-        f.write(datalad_post.format(**job_specs))
-        write_job_footer(f, job_specs["jobname"])
-
-        
-    return job_path, outputs_exist
+    return job_path
 
 
 def submit_slurm_job(job_path):
@@ -433,11 +621,70 @@ def parse_args():
     )
 
     
+    parser.add_argument(
+        "--resource-model",
+        action="store",
+        help="resource model fitted by resources.py to size func jobs requests,"
+        " default to fixed FMRIPREP_REQ",
+    )
     parser.add_argument(
         "--force-reindex",
         action="store_true",
         help="Force pyBIDS reset_database and reindexing",
     )
+    parser.add_argument(
+        "--runs-per-job",
+        action="store",
+        type=int,
+        help="Split the func jobs of a session in jobs of at most this number of"
+        " runs of a task, default to a single job per session",
+    )
+    parser.add_argument(
+        "--array",
+        action="store_true",
+        help="Generate a single SLURM job array with a manifest instead of one job per session",
+    )
+    parser.add_argument(
+        "--array-max-concurrent",
+        action="store",
+        type=int,
+        default=slurm.ARRAY_MAX_CONCURRENT,
+        help="Maximum number of array tasks running at once",
+    )
+    parser.add_argument(
+        "--pack",
+        action="store",
+        type=int,
+        default=1,
+        help="Number of jobs run concurrently in a single whole-node allocation",
+    )
+    parser.add_argument(
+        "--node-cpus",
+        action="store",
+        type=int,
+        default=NODE_REQ["cpus"],
+        help="Number of cpus of a node, split between packed jobs",
+    )
+    parser.add_argument(
+        "--node-mem-per-cpu",
+        action="store",
+        type=int,
+        default=NODE_REQ["mem_per_cpu"],
+        help="Memory per cpu (MB) of a node, split between packed jobs",
+    )
+    parser.add_argument(
+        "--retry",
+        action="store_true",
+        help="Only resubmit the jobs that failed, resuming from the workdir they saved"
+        f" in {FAILED_JOBS_DIR}",
+    )
+    parser.add_argument(
+        "--retry-scale",
+        action="store",
+        type=float,
+        default=1.0,
+        help="Factor applied to the memory and walltime requests of retried jobs",
+    )
     parser.add_argument(
         "--no-submit",
         action="store_true",
@@ -446,12 +693,34 @@ def parse_args():
     return parser.parse_args()
 
 
+def list_existing_outputs(derivatives_path):
+    """Outputs committed on the main branch or on any (unmerged) job branch."""
+    refs = ["HEAD"] + git_tree.list_refs(derivatives_path, JOB_BRANCHES_PATTERNS)
+    return git_tree.existing_paths(derivatives_path, refs)
+
+
+def retry_job_specs(job_specs, scale=1.0):
+    """Job specs of the retry of a failed job, None if it did not save its workdir."""
+    if not os.path.isdir(os.path.join(FAILED_JOBS_DIR, job_specs["jobname"], "workdir")):
+        return None
+    job_specs = dict(job_specs)
+    job_specs["mem_per_cpu"] = int(math.ceil(job_specs["mem_per_cpu"] * scale))
+    job_specs["time"] = slurm.format_walltime(
+        int(math.ceil(slurm.parse_walltime(job_specs["time"]) * scale))
+    )
+    return job_specs
+
+
 def run_fmriprep(layout, args, pipe="all"):
 
     subjects = args.participant_label
     if not subjects:
         subjects = layout.get_subjects()
 
+    existing_outputs = None
+    if pipe == "func":
+        existing_outputs = list_existing_outputs(os.path.realpath(args.output_path))
+
     for subject in subjects:
         if args.session_label:
             sessions = args.session_label
@@ -460,65 +729,33 @@ def run_fmriprep(layout, args, pipe="all"):
         if len(sessions) == 0:
             sessions = [None]
 
-        if pipe == "func":
+        if pipe == "func" and args.runs_per_job:
+            for session in sessions:
+                yield from func_run_group_job_specs(
+                    layout, subject, session, args, existing_outputs
+                )
+        elif pipe == "func":
             for session in sessions:
-                # if TODO: check if derivative already exists for that subject
-                job_path, outputs_exist = write_func_job(layout, subject, session, args)
+                job_specs, outputs_exist = func_job_specs(
+                    layout, subject, session, args, existing_outputs
+                )
                 if outputs_exist:
                     print(
                         f"all output already exists for sub-{subject} ses-{session}, not rerunning"
                     )
                     continue
-                yield job_path
+                yield job_specs
         elif pipe == "anat":
-            yield write_fmriprep_job(layout, subject, args, anat_only=True, longitudinal=args.longitudinal)
+            yield fmriprep_job_specs(layout, subject, args, anat_only=True, longitudinal=args.longitudinal)
         elif pipe == "all":
-            yield write_fmriprep_job(layout, subject, args, anat_only=False, longitudinal=args.longitudinal)
+            yield fmriprep_job_specs(layout, subject, args, anat_only=False, longitudinal=args.longitudinal)
 
 
 def main():
 
     args = parse_args()
 
-    pybids_cache_path = os.path.join(args.bids_path, PYBIDS_CACHE_PATH)
-
-    """
-    if not os.path.exists(pybids_cache_path):
-        os.mkdir(pybids_cache_path)
-        
-    from datalad_container.containers_run import ContainersRun
-    bids_root_container = pathlib.Path('/data').joinpath(args.bids_path.relative_to(args.output_path))
-    
-    pybids_cache_path_container = bids_root_container.joinpath(PYBIDS_CACHE_PATH)
-    pybids_cache_cmd = [
-        f"pybids layout",
-        "--reset-db" if args.force_reindex else None ] + \
-        [f"--ignore {p}" for p in ("code","stimuli","sourcedata","models","m/^\./") + load_bidsignore(args.bids_path, mode='bash')] + \
-        [
-            str(bids_root_container),
-            str(pybids_cache_path_container),
-        ]
-    print(" ".join(filter(bool, pybids_cache_cmd)))
-    ContainersRun()(
-        " ".join(filter(bool, pybids_cache_cmd)),
-        container_name='containers/fmriprep-lts',
-        )
-    """
-
-    layout = bids.BIDSLayout(
-        args.bids_path,
-        database_path=pybids_cache_path,
-        reset_database=args.force_reindex,
-        validate=False,
-        ignore=(
-            "code",
-            "stimuli",
-            "sourcedata",
-            "models",
-            re.compile(r"^\."),
-        )
-        + load_bidsignore(args.bids_path),
-    )
+    layout = bids_index.get_layout(args.bids_path, force_reindex=args.force_reindex)
 
     job_path = os.path.join(args.output_path, SLURM_JOB_DIR)
     if not os.path.exists(job_path):
@@ -532,11 +769,34 @@ def main():
     if not os.path.exists(license_path):
         shutil.copyfile(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'freesurfer.license'), license_path)
 
-    for job_file in run_fmriprep(layout, args, args.preproc):
+    jobs = list(run_fmriprep(layout, args, args.preproc))
+    if args.retry:
+        retry_jobs = [retry_job_specs(job_specs, args.retry_scale) for job_specs in jobs]
+        for job_specs, retry_specs in zip(jobs, retry_jobs):
+            if retry_specs is None:
+                print(f"no saved workdir for {job_specs['jobname']}, not retrying")
+        jobs = [job_specs for job_specs in retry_jobs if job_specs]
+    if args.array and jobs:
+        job_file = write_array_job(jobs, args)
         if not args.no_submit:
-            submit_slurm_job(job_file)
-
-    datalad.api.save(glob.glob('code/*mriprep*.sh')+glob.glob('code/*bids_filters.json'))
+            slurm.submit_array_job(
+                job_file,
+                len(jobs),
+                os.path.join(jobs[0]["derivatives_path"], SLURM_JOB_DIR),
+                max_concurrent=args.array_max_concurrent,
+            )
+    elif args.pack > 1:
+        for pack_idx, pack_start in enumerate(range(0, len(jobs), args.pack)):
+            job_file = write_packed_job(jobs[pack_start : pack_start + args.pack], pack_idx, args)
+            if not args.no_submit:
+                submit_slurm_job(job_file)
+    else:
+        for job_specs in jobs:
+            job_file = write_job(job_specs, args)
+            if not args.no_submit:
+                submit_slurm_job(job_file)
+
+    datalad.api.save(glob.glob('code/*mriprep*.sh')+glob.glob('code/*bids_filters.json')+glob.glob('code/*_resources.json')+glob.glob('code/*_manifest.tsv'))
     datalad.api.push(to='ria-beluga')
 
 if __name__ == "__main__":
@@ -0,0 +1,381 @@
+"""First-level GLM contrasts of task runs from the fMRIPrep outputs.
+
+For each run with an `events.tsv` in the BIDS dataset (eg. converted by
+stimuli/hcptrt/extract_hcptrt.py), the design matrix is built from the
+events convolved with the SPM canonical HRF, the confounds selected by
+`--confounds` and a constant. All the grayordinates (fsLR 91k dtseries) or
+brain mask voxels (volume space) are fitted at once with ordinary least
+squares: the pseudo-inverse of the design is computed once per run and
+applied to blocks of the percent signal change data. Runs are fitted in a
+process pool and the effect size and t-statistic of each contrast are
+written as BIDS derivatives statistical maps.
+
+Contrasts are given per task in a JSON file, eg.
+`{"motor": {"leftVsRight": {"left_hand": 1, "right_hand": -1}}}`, by default
+each condition is contrasted against the baseline.
+
+    python3 glm.py <bids_path> <fmriprep_path> <output_path> --task motor wm [--jobs 16]
+"""
+import os
+import re
+import sys
+import csv
+import glob
+import json
+import math
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import nibabel as nb
+
+import confounds
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from mri.utils import bids_index, nifti
+
+CIFTI_SPACE = "fsLR_den-91k"
+DEFAULT_CONFOUNDS = ["trans_?", "rot_?", "cosine*", "csf", "white_matter"]
+# fMRIPrep slice-timing correction references the middle of each volume
+SLICE_TIME_REF = 0.5
+# oversampling of the frame times to convolve the events with the HRF
+HRF_OVERSAMPLING = 16
+HRF_LENGTH = 32.0  # seconds
+# grayordinates/voxels fitted per matrix product, bounds the residuals memory
+BLOCK_SIZE = 1 << 15
+STATS = ["effect", "t"]
+
+
+def spm_hrf(dt, length=HRF_LENGTH):
+    """SPM canonical HRF (difference of gammas, peak 6s, undershoot 16s) sampled every dt."""
+    t = np.arange(0, length, dt)
+
+    def gamma_pdf(t, shape):
+        with np.errstate(divide="ignore"):
+            return np.exp((shape - 1) * np.log(t) - t - math.lgamma(shape))
+
+    hrf = gamma_pdf(t, 6) - gamma_pdf(t, 16) / 6
+    return hrf / hrf.sum()
+
+
+def read_events(events_path, condition_column=None):
+    """(condition, onset, duration) of the events with a valid onset and duration."""
+    with open(events_path) as fd:
+        rows = list(csv.DictReader(fd, delimiter="\t"))
+    if not rows:
+        return []
+    if condition_column is None:
+        # extract_hcptrt.py names the condition column `type`
+        condition_column = "trial_type" if "trial_type" in rows[0] else "type"
+    events = []
+    for row in rows:
+        try:
+            onset, duration = float(row["onset"]), float(row["duration"])
+        except (KeyError, ValueError):
+            continue
+        if math.isfinite(onset) and math.isfinite(duration):
+            events.append((row[condition_column], onset, duration))
+    return events
+
+
+def task_regressors(events, conditions, n_volumes, tr):
+    """Events convolved with the HRF at the frame times, shape (n_volumes, n_conditions)."""
+    dt = tr / HRF_OVERSAMPLING
+    n_hires = (n_volumes + 1) * HRF_OVERSAMPLING
+    boxcars = np.zeros((n_hires, len(conditions)))
+    for condition, onset, duration in events:
+        if condition not in conditions:
+            continue
+        start = int(round(onset / dt))
+        # events shorter than the oversampled frame are impulses
+        stop = max(int(round((onset + duration) / dt)), start + 1)
+        boxcars[max(start, 0) : max(stop, 0), conditions.index(condition)] = 1
+    hrf = spm_hrf(dt)
+    convolved = np.stack(
+        [np.convolve(boxcars[:, i], hrf)[:n_hires] for i in range(len(conditions))], axis=1
+    )
+    frame_idx = ((np.arange(n_volumes) + SLICE_TIME_REF) * HRF_OVERSAMPLING).astype(int)
+    return convolved[frame_idx]
+
+
+def confound_regressors(confounds_path, patterns):
+    """Selected confounds, from the columnar store if converted, demeaned, n/a as 0."""
+    npz_path = confounds.store_path(confounds_path)
+    if os.path.exists(npz_path):
+        columns, _ = confounds.store_columns(npz_path)
+        selected = confounds.select_columns(columns, patterns)
+        data = confounds._load_run(npz_path, selected)
+    else:
+        with open(confounds_path) as fd:
+            columns = fd.readline().rstrip("\n").split("\t")
+        selected = confounds.select_columns(columns, patterns)
+        data = np.genfromtxt(
+            confounds_path,
+            delimiter="\t",
+            skip_header=1,
+            usecols=[columns.index(c) for c in selected],
+            missing_values="n/a",
+            filling_values=np.nan,
+            ndmin=2,
+        )
+    if not selected:
+        return [], None
+    data = data - np.nanmean(data, axis=0)
+    return selected, np.nan_to_num(data)
+
+
+def design_matrix(events, conditions, confounds_data, n_volumes, tr):
+    columns = list(conditions)
+    blocks = [task_regressors(events, conditions, n_volumes, tr)]
+    if confounds_data is not None:
+        columns += [f"confound_{i}" for i in range(confounds_data.shape[1])]
+        blocks.append(confounds_data)
+    columns.append("constant")
+    blocks.append(np.ones((n_volumes, 1)))
+    return columns, np.hstack(blocks)
+
+
+def fit_contrasts(data, design, contrasts, block_size=BLOCK_SIZE):
+    """OLS fit of `data` (n_volumes, n_features) and contrasts effects and t-statistics.
+
+    `contrasts` maps names to weight vectors over the design columns, returns
+    name -> {stat: array of n_features}.
+    """
+    pinv = np.linalg.pinv(design)
+    dof = design.shape[0] - np.linalg.matrix_rank(design)
+    xtx_inv = pinv @ pinv.T
+    weights = np.array(list(contrasts.values()))
+    # variance of each contrast for a unit residual variance
+    contrast_var = np.einsum("ij,jk,ik->i", weights, xtx_inv, weights)
+
+    n_features = data.shape[1]
+    effects = np.empty((len(contrasts), n_features), dtype=np.float32)
+    tstats = np.empty((len(contrasts), n_features), dtype=np.float32)
+    for start in range(0, n_features, block_size):
+        block = slice(start, start + block_size)
+        betas = pinv @ data[:, block]
+        residuals = data[:, block] - design @ betas
+        sigma2 = np.einsum("ij,ij->j", residuals, residuals) / dof
+        effects[:, block] = weights @ betas
+        with np.errstate(divide="ignore", invalid="ignore"):
+            tstats[:, block] = np.nan_to_num(
+                effects[:, block] / np.sqrt(np.outer(contrast_var, sigma2))
+            )
+    return {
+        name: dict(effect=effects[i], t=tstats[i]) for i, name in enumerate(contrasts)
+    }
+
+
+def percent_signal_change(data):
+    mean = data.mean(axis=0)
+    mean[mean <= 0] = np.inf
+    return 100 * (data / mean - 1)
+
+
+def contrast_label(name):
+    """BIDS labels are alphanumeric."""
+    return re.sub(r"[^a-zA-Z0-9]", "", name)
+
+
+def run_contrasts(conditions, task_contrasts, columns):
+    """Weight vectors of the contrasts estimable from the run conditions."""
+    if not task_contrasts:
+        task_contrasts = {c: {c: 1} for c in conditions}
+    contrasts = {}
+    for name, condition_weights in task_contrasts.items():
+        if not all(c in conditions for c in condition_weights):
+            continue
+        weights = np.zeros(len(columns))
+        for condition, weight in condition_weights.items():
+            weights[columns.index(condition)] = weight
+        contrasts[contrast_label(name)] = weights
+    return contrasts
+
+
+def load_data(bold_path, mask_path):
+    """Timeseries (n_volumes, n_features), repetition time and an output writer."""
+    img = nb.load(bold_path)
+    if bold_path.endswith(".dtseries.nii"):
+        series_axis, brain_models = img.header.get_axis(0), img.header.get_axis(1)
+        data = img.get_fdata(dtype=np.float32)
+
+        def write(values, out_path):
+            header = nb.cifti2.Cifti2Header.from_axes(
+                (nb.cifti2.ScalarAxis([os.path.basename(out_path)]), brain_models)
+            )
+            nifti.save(nb.Cifti2Image(values[np.newaxis], header), out_path)
+
+        return data, series_axis.step, write
+
+    mask = np.asanyarray(nb.load(mask_path).dataobj) > 0
+    data = img.get_fdata(dtype=np.float32)[mask].T
+
+    def write(values, out_path):
+        volume = np.zeros(mask.shape, dtype=np.float32)
+        volume[mask] = values
+        nifti.save(nb.Nifti1Image(volume, img.affine), out_path)
+
+    return data, float(img.header.get_zooms()[3]), write
+
+
+def fit_run(run):
+    """Fit a run and write its statistical maps, returns their paths."""
+    events = read_events(run["events"], run["condition_column"])
+    conditions = sorted({e[0] for e in events})
+    data, tr, write = load_data(run["bold"], run.get("mask"))
+    n_volumes = data.shape[0]
+    _, confounds_data = confound_regressors(run["confounds"], run["confound_patterns"])
+    columns, design = design_matrix(events, conditions, confounds_data, n_volumes, tr)
+    contrasts = run_contrasts(conditions, run["contrasts"], columns)
+    if not contrasts:
+        return []
+    maps = fit_contrasts(percent_signal_change(data), design, contrasts)
+
+    os.makedirs(os.path.dirname(run["output_prefix"]), exist_ok=True)
+    out_paths = []
+    for name, stats in maps.items():
+        for stat in STATS:
+            out_path = f"{run['output_prefix']}_contrast-{name}_stat-{stat}_statmap{run['extension']}"
+            write(stats[stat], out_path)
+            out_paths.append(out_path)
+    return out_paths
+
+
+def find_runs(layout, fmriprep_path, output_path, args):
+    """Runs to fit: events, fMRIPrep outputs and the output prefix."""
+    filters = dict(suffix="events", extension=".tsv")
+    if args.participant_label:
+        filters["subject"] = args.participant_label
+    if args.task:
+        filters["task"] = args.task
+    contrasts = {}
+    if args.contrasts:
+        with open(args.contrasts) as fd:
+            contrasts = json.load(fd)
+
+    if args.space == CIFTI_SPACE:
+        bold_suffix, extension = f"_space-{CIFTI_SPACE}_bold.dtseries.nii", ".dscalar.nii"
+    else:
+        bold_suffix, extension = f"_space-{args.space}_desc-preproc_bold.nii.gz", ".nii.gz"
+
+    runs = []
+    for events_file in layout.get(**filters):
+        prefix = os.path.basename(events_file.path).split("_events.tsv")[0]
+        func_dir = os.path.relpath(os.path.dirname(events_file.path), layout.root)
+        # runs with phase data are processed as part-mag by fMRIPrep
+        for bold_prefix in [prefix, f"{prefix}_part-mag"]:
+            bold_path = os.path.join(fmriprep_path, func_dir, bold_prefix + bold_suffix)
+            if os.path.exists(bold_path):
+                break
+        else:
+            print(f"no fMRIPrep output for {events_file.path}", file=sys.stderr)
+            continue
+        output_prefix = os.path.join(
+            output_path, func_dir, f"{bold_prefix}_space-{args.space}"
+        )
+        if not args.force and glob.glob(f"{output_prefix}_contrast-*_statmap{extension}"):
+            continue
+        runs.append(
+            dict(
+                events=events_file.path,
+                condition_column=args.condition_column,
+                bold=bold_path,
+                mask=os.path.join(
+                    fmriprep_path,
+                    func_dir,
+                    f"{bold_prefix}_space-{args.space}_desc-brain_mask.nii.gz",
+                ),
+                confounds=os.path.join(
+                    fmriprep_path, func_dir, f"{bold_prefix}_desc-confounds_timeseries.tsv"
+                ),
+                confound_patterns=args.confounds,
+                contrasts=contrasts.get(events_file.entities["task"]),
+                output_prefix=output_prefix,
+                extension=extension,
+            )
+        )
+    return runs
+
+
+def write_dataset_description(output_path, fmriprep_path):
+    path = os.path.join(output_path, "dataset_description.json")
+    if os.path.exists(path):
+        return
+    os.makedirs(output_path, exist_ok=True)
+    with open(path, "w") as fd:
+        json.dump(
+            {
+                "Name": "First-level GLM contrasts",
+                "BIDSVersion": "1.6.0",
+                "DatasetType": "derivative",
+                "GeneratedBy": [{"Name": "ds_prep glm.py"}],
+                "SourceDatasets": [{"URL": os.path.relpath(fmriprep_path, output_path)}],
+            },
+            fd,
+            indent=2,
+        )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        description="fit first-level GLM contrasts of task runs from fMRIPrep outputs",
+    )
+    parser.add_argument("bids_path", help="BIDS dataset with the events.tsv")
+    parser.add_argument("fmriprep_path", help="fmriprep derivatives dataset")
+    parser.add_argument("output_path", help="derivatives folder for the statistical maps")
+    parser.add_argument(
+        "--participant-label",
+        nargs="+",
+        help="a space delimited list of participant identifiers to process",
+    )
+    parser.add_argument("--task", nargs="+", help="tasks to process, default to all")
+    parser.add_argument(
+        "--space",
+        default=CIFTI_SPACE,
+        help="fMRIPrep output space: fsLR_den-91k (dtseries) or a volume template",
+    )
+    parser.add_argument("--contrasts", help="JSON file of the contrasts per task")
+    parser.add_argument(
+        "--condition-column",
+        help="events column of the conditions, default to trial_type, or type if absent",
+    )
+    parser.add_argument(
+        "--confounds",
+        nargs="+",
+        default=DEFAULT_CONFOUNDS,
+        help="confounds columns patterns added to the design",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=nifti.available_cpus(),
+        help="number of runs fitted in parallel",
+    )
+    parser.add_argument(
+        "--force", action="store_true", help="fit runs that already have statistical maps"
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    layout = bids_index.get_layout(args.bids_path)
+    fmriprep_path = os.path.realpath(args.fmriprep_path)
+    runs = find_runs(layout, fmriprep_path, args.output_path, args)
+    write_dataset_description(args.output_path, fmriprep_path)
+
+    if args.jobs > 1:
+        # one BLAS thread per process, set before the workers import numpy
+        for var in ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"]:
+            os.environ.setdefault(var, "1")
+    with ProcessPoolExecutor(
+        max_workers=args.jobs, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        for out_paths in executor.map(fit_run, runs):
+            for out_path in out_paths:
+                print(out_path)
+
+
+if __name__ == "__main__":
+    main()
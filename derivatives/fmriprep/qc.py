@@ -4,14 +4,160 @@ import dash_core_components as dcc
 import dash_html_components as html
 
 import flask
-import glob
 import os
+import re
+import sys
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
+import bold_qc
+import figure_cache
 
-def build_app(derivatives_path):
+FIGURE_RE = re.compile(r"^(sub-.+)_desc-([a-zA-Z0-9]+)_bold\.svg$")
+RUN_ENTITIES = ["ses", "task", "run"]
+SCAN_WORKERS = 16
+WATCH_INTERVAL = 30  # seconds
+# figure URLs carry their ETag, a given URL never changes content
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+
+class FigureIndex:
+    """In-memory index subject -> run -> step -> figure of the fMRIPrep reports.
+
+    Built with a parallel scan of the `sub-*/figures` folders, then kept
+    current by a thread polling their mtime and rescanning only the folders
+    that changed (inotify does not see the files written by other nodes of a
+    network filesystem). A refresh replaces the index at once, readers are
+    never blocked.
+    """
+
+    def __init__(self, derivatives_path, scan_workers=SCAN_WORKERS):
+        self.derivatives_path = derivatives_path
+        self.scan_workers = scan_workers
+        self._mtimes = {}
+        self._runs = {}
+        self._options = {}
+        self.subjects = []
+        self.refresh()
+
+    def _figures_dir(self, subject):
+        return os.path.join(self.derivatives_path, f"sub-{subject}", "figures")
+
+    def _scan_subject(self, subject):
+        """run prefix -> {step: figure filename} of a subject."""
+        runs = {}
+        try:
+            entries = list(os.scandir(self._figures_dir(subject)))
+        except FileNotFoundError:
+            return runs
+        for entry in entries:
+            match = FIGURE_RE.match(entry.name)
+            if match:
+                runs.setdefault(match.group(1), {})[match.group(2)] = entry.name
+        return runs
+
+    def _mtime(self, subject):
+        try:
+            return os.stat(self._figures_dir(subject)).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def refresh(self):
+        """Rescan the subjects whose figures folder changed since the last refresh."""
+        subjects = sorted(
+            entry.name[len("sub-") :]
+            for entry in os.scandir(self.derivatives_path)
+            if entry.name.startswith("sub-") and entry.is_dir()
+        )
+        with ThreadPoolExecutor(max_workers=self.scan_workers) as executor:
+            mtimes = dict(zip(subjects, executor.map(self._mtime, subjects)))
+            changed = [s for s in subjects if mtimes[s] != self._mtimes.get(s)]
+            scanned = dict(zip(changed, executor.map(self._scan_subject, changed)))
+
+        runs = {s: scanned.get(s, self._runs.get(s, {})) for s in subjects}
+        options = {
+            s: [
+                {
+                    "label": "_".join(
+                        ent for ent in prefix.split("_") if ent.split("-")[0] in RUN_ENTITIES
+                    ),
+                    "value": prefix,
+                }
+                for prefix in sorted(runs[s])
+            ]
+            for s in subjects
+        }
+        # single assignments, a concurrent callback sees the old or the new index
+        self._runs, self._options, self._mtimes = runs, options, mtimes
+        self.subjects = [s for s in subjects if runs[s]]
+        return changed
+
+    def watch(self, interval=WATCH_INTERVAL, on_change=None):
+        """Refresh the index every `interval` seconds in a daemon thread.
+
+        `on_change` is called with the rescanned subjects.
+        """
+
+        def poll():
+            while True:
+                time.sleep(interval)
+                changed = self.refresh()
+                if changed:
+                    print(f"figure index: rescanned {len(changed)} subjects")
+                    if on_change:
+                        on_change(changed)
+
+        threading.Thread(target=poll, daemon=True).start()
+
+    def run_options(self, subject):
+        return self._options.get(subject, [])
+
+    def figure(self, subject, run, step):
+        return self._runs.get(subject, {}).get(run, {}).get(step)
+
+    def figure_path(self, subject, figure):
+        """Path of an indexed figure, None for any other filename."""
+        match = FIGURE_RE.match(figure)
+        if match and self.figure(subject, match.group(1), match.group(2)) == figure:
+            return os.path.join(self._figures_dir(subject), figure)
+
+    def figure_paths(self, subjects=None):
+        return [
+            os.path.join(self._figures_dir(subject), figure)
+            for subject in (self.subjects if subjects is None else subjects)
+            for steps in self._runs.get(subject, {}).values()
+            for figure in steps.values()
+        ]
+
+
+def cached_response(path, mimetype, etag, encoding=None, immutable=False):
+    """Response with a strong ETag, 304 if the client already has this representation."""
+    headers = {
+        "ETag": f'"{etag}"',
+        "Vary": "Accept-Encoding",
+        # without the ETag in the URL the client revalidates on each use
+        "Cache-Control": f"public, max-age={IMMUTABLE_MAX_AGE}, immutable"
+        if immutable
+        else "no-cache",
+    }
+    if flask.request.if_none_match.contains(etag):
+        return flask.Response(status=304, headers=headers)
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    with open(path, "rb") as fd:
+        return flask.Response(fd.read(), mimetype=mimetype, headers=headers)
+
+
+def build_app(
+    derivatives_path,
+    watch_interval=WATCH_INTERVAL,
+    cache_dir=figure_cache.FIGURE_CACHE_DIR,
+    prepare_workers=figure_cache.PREPARE_WORKERS,
+):
 
     static_image_route = "/images/"
-    image_directory = os.getcwd()
+    thumbnail_route = "/thumbnails/"
     preproc_steps = [
         ("Susceptibility distortion correction", "sdc"),
         ("Alignment of functional and anatomical MRI data", "bbregister"),
@@ -20,78 +166,71 @@ def build_app(derivatives_path):
         ("Correlations among nuisance regressors", "confoundcorr"),
     ]
 
-    def list_runs(subject):
-        paths = sorted(
-            [
-                os.path.basename(p)
-                for p in glob.glob(
-                    f"{derivatives_path}/sub-{subject}/figures/*desc-sdc_bold.svg"
-                )
-            ]
-        )
-        print(paths)
-        runs = [
-            "_".join(
-                [
-                    ent
-                    for ent in p.split("_")
-                    if ent.split("-")[0] in ["ses", "task", "run"]
-                ]
-            )
-            for p in paths
-        ]
-        return runs, paths
+    figure_index = FigureIndex(derivatives_path)
+    figures = figure_cache.FigureCache(cache_dir, prepare_workers)
 
-    subjects = sorted(
-        [
-            os.path.basename(p[:-1]).split("-")[1]
-            for p in glob.glob(f"{derivatives_path}/sub-*/")
-        ]
-    )
-    default_runs = [
-        {"label": run, "value": path} for run, path in zip(*list_runs(subjects[0]))
-    ]
+    def prepare_subjects(subjects=None):
+        # hashes the non-annexed figures, off the request threads
+        threading.Thread(
+            target=figures.schedule,
+            args=(figure_index.figure_paths(subjects),),
+            daemon=True,
+        ).start()
+
+    prepare_subjects()
+    if watch_interval:
+        figure_index.watch(watch_interval, on_change=prepare_subjects)
+
+    # loaded once, computed beforehand by bold_qc.py
+    bold_metrics = bold_qc.load_metrics(derivatives_path)
 
     app = dash.Dash()
 
-    app.layout = html.Div(
-        [
-            dcc.Dropdown(
-                id="subject-dropdown",
-                options=[
-                    {"label": f"sub-{subject}", "value": subject}
-                    for subject in subjects
-                ],
-                value=subjects[0],
-            ),
-            dcc.Dropdown(
-                id="run-dropdown", options=default_runs, value=default_runs[0]["value"]
-            ),
-            dcc.Tabs(
-                id="step-tabs",
-                children=[
-                    dcc.Tab(label=step_name, value=step)
-                    for step_name, step in preproc_steps
-                ],
-                value=preproc_steps[0][1],
-            ),
-            html.ObjectEl(id="image", width="100%"),
-        ]
-    )
+    def serve_layout():
+        # evaluated on each page load, lists the subjects added since startup
+        subjects = figure_index.subjects
+        default_runs = figure_index.run_options(subjects[0]) if subjects else []
+        return html.Div(
+            [
+                dcc.Dropdown(
+                    id="subject-dropdown",
+                    options=[
+                        {"label": f"sub-{subject}", "value": subject}
+                        for subject in subjects
+                    ],
+                    value=subjects[0] if subjects else None,
+                ),
+                dcc.Dropdown(
+                    id="run-dropdown",
+                    options=default_runs,
+                    value=default_runs[0]["value"] if default_runs else None,
+                ),
+                dcc.Tabs(
+                    id="step-tabs",
+                    children=[
+                        dcc.Tab(label=step_name, value=step)
+                        for step_name, step in preproc_steps
+                    ],
+                    value=preproc_steps[0][1],
+                ),
+                html.Div(id="metrics"),
+                html.Div(id="thumbnails"),
+                html.ObjectEl(id="image", width="100%"),
+            ]
+        )
 
-    @app.callback(
-        dash.dependencies.Output("run-dropdown", "options"),
-        [dash.dependencies.Input("subject-dropdown", "value")],
-    )
-    def update_runs_list(subject):
-        return [{"label": run, "value": path} for run, path in zip(*list_runs(subject))]
+    app.layout = serve_layout
 
     @app.callback(
-        dash.dependencies.Output("run-dropdown", "value"),
+        [
+            dash.dependencies.Output("run-dropdown", "options"),
+            dash.dependencies.Output("run-dropdown", "value"),
+        ],
         [dash.dependencies.Input("subject-dropdown", "value")],
     )
-    def update_runs_value(subject):
-        return list_runs(subject)[1][0]
+    def update_runs(subject):
+        options = figure_index.run_options(subject)
+        return options, options[0]["value"] if options else None
 
     @app.callback(
         dash.dependencies.Output("image", "data"),
@@ -101,21 +240,78 @@ def build_app(derivatives_path):
             dash.dependencies.Input("step-tabs", "value"),
         ],
     )
-    def update_image_src(subject, fname, step):
-        if fname:
-            return os.path.join(
-                static_image_route, subject, fname.replace("-sdc_", "-%s_" % step)
+    def update_image_src(subject, run, step):
+        figure = figure_index.figure(subject, run, step)
+        if figure:
+            etag = figure_cache.etag(figure_index.figure_path(subject, figure))
+            return f"{os.path.join(static_image_route, subject, figure)}?v={etag}"
+
+    @app.callback(
+        dash.dependencies.Output("thumbnails", "children"),
+        [
+            dash.dependencies.Input("subject-dropdown", "value"),
+            dash.dependencies.Input("run-dropdown", "value"),
+        ],
+    )
+    def update_thumbnails(subject, run):
+        # an overview of the run while the full figures load
+        thumbnails = []
+        for step_name, step in preproc_steps:
+            figure = figure_index.figure(subject, run, step)
+            if figure:
+                thumbnails.append(
+                    html.Img(
+                        src=os.path.join(thumbnail_route, subject, figure),
+                        title=step_name,
+                        alt="",
+                        style={"height": "80px", "marginRight": "4px"},
+                    )
+                )
+        return thumbnails
+
+    @app.callback(
+        dash.dependencies.Output("metrics", "children"),
+        [dash.dependencies.Input("run-dropdown", "value")],
+    )
+    def update_metrics(run):
+        if not run:
+            return ""
+        return [
+            html.Pre(
+                f"{space}: "
+                + "  ".join(
+                    f"{k}={v}" for k, v in row.items() if k not in ["run", "space"]
+                )
             )
+            for (row_run, space), row in sorted(bold_metrics.items())
+            if row_run == run
+        ]
 
     @app.server.route("/images/<subject>/<image_path>")
     def serve_image(subject, image_path):
-        print(subject, image_path)
-        image_directory = os.path.abspath(
-            os.path.join(derivatives_path, "sub-%s" % subject, "figures")
+        path = figure_index.figure_path(subject, image_path)
+        if path is None or not os.path.exists(path):
+            flask.abort(404)
+        served_path, encoding, etag = figures.variant(
+            path, flask.request.headers.get("Accept-Encoding", "")
+        )
+        return cached_response(
+            served_path,
+            "image/svg+xml",
+            etag,
+            encoding,
+            immutable=flask.request.args.get("v") == figure_cache.etag(path),
         )
-        if not os.path.exists(os.path.join(image_directory, image_path)):
-            raise RuntimeError("image_path not found")
-        return flask.send_from_directory(image_directory, image_path)
+
+    @app.server.route("/thumbnails/<subject>/<image_path>")
+    def serve_thumbnail(subject, image_path):
+        path = figure_index.figure_path(subject, image_path)
+        if path is None or not os.path.exists(path):
+            flask.abort(404)
+        thumbnail = figures.thumbnail(path)
+        if thumbnail is None:
+            flask.abort(404)
+        return cached_response(thumbnail[0], "image/png", thumbnail[1])
 
     return app
 
@@ -127,10 +323,64 @@ def parse_args():
     )
     parser.add_argument("derivatives_path", help="fmriprep derivative folder")
     parser.add_argument("--port", action="store", default=8050, help="server port")
+    parser.add_argument(
+        "--watch-interval",
+        type=int,
+        default=WATCH_INTERVAL,
+        help="seconds between checks for new figures, 0 to disable",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=figure_cache.FIGURE_CACHE_DIR,
+        help="folder of the compressed figures and thumbnails ($DS_PREP_QC_CACHE)",
+    )
+    parser.add_argument(
+        "--prepare-workers",
+        type=int,
+        default=figure_cache.PREPARE_WORKERS,
+        help="processes compressing and thumbnailing figures in the background",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="serve with that many gunicorn workers instead of the debug server",
+    )
     return parser.parse_args()
 
 
+def serve_production(args):
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        sys.exit("--workers requires gunicorn")
+
+    class QCApplication(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", f"0.0.0.0:{args.port}")
+            self.cfg.set("workers", args.workers)
+            # one thread per request blocked on the filesystem
+            self.cfg.set("worker_class", "gthread")
+            self.cfg.set("threads", 8)
+
+        def load(self):
+            # built in each worker after the fork, with its own threads and pools
+            return build_app(
+                args.derivatives_path,
+                args.watch_interval,
+                args.cache_dir,
+                args.prepare_workers,
+            ).server
+
+    QCApplication().run()
+
+
 if __name__ == "__main__":
     args = parse_args()
-    app = build_app(args.derivatives_path)
-    app.run_server(debug=True, dev_tools_silence_routes_logging=False, port=args.port)
+    if args.workers:
+        serve_production(args)
+    else:
+        app = build_app(
+            args.derivatives_path, args.watch_interval, args.cache_dir, args.prepare_workers
+        )
+        app.run_server(debug=True, dev_tools_silence_routes_logging=False, port=args.port)
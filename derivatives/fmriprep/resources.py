@@ -0,0 +1,283 @@
+"""Data-driven SLURM resource requests for fMRIPrep func jobs.
+
+fmriprep.py writes a `code/<jobname>_resources.json` next to each job script
+with the size of the session (number of bold runs, volumes and voxels) and
+the resources requested. Once jobs have run, this script joins these files with the
+nipype `resource_monitor.json` copied to scratch by the job footer and with
+the SLURM accounting (a `sacct --parsable2` dump), and fits a linear model of
+the cpus, memory and walltime used, that fmriprep.py `--resource-model` uses
+to size new jobs. Array tasks and packed jobs, accounted under the name of
+their script, are resolved to their job through the array manifest and the
+exit line logged by each packed job.
+"""
+import os
+import re
+import sys
+import glob
+import json
+import math
+import argparse
+import collections
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from mri.utils import job_status
+
+FEATURES = ["n_runs", "n_volumes", "n_voxel_volumes"]
+TARGETS = ["cpus", "mem_gb", "hours"]
+# predictions are multiplied by this factor then clipped to these bounds
+SAFETY_MARGIN = 1.25
+MIN_REQ = {"cpus": 2, "mem_gb": 8, "hours": 1}
+MAX_REQ = {"cpus": 40, "mem_gb": 180, "hours": 72}
+MAX_OMP_NTHREADS = 8
+SACCT_FORMAT = "JobID,JobName,State,Elapsed,TotalCPU,MaxRSS,AllocCPUS"
+
+RESOURCE_MONITOR_BIN = 60  # seconds
+
+
+def job_features(bold_runs):
+    """Size of a fMRIPrep func job from its bold runs BIDSFile.
+
+    Volumes and voxels are read from the headers, they are left to None if
+    the content of a run is not available locally.
+    """
+    features = dict(n_runs=len(bold_runs), n_volumes=0, n_voxel_volumes=0)
+    for bold_run in bold_runs:
+        try:
+            shape = bold_run.get_image().shape
+        except Exception:
+            features["n_volumes"] = features["n_voxel_volumes"] = None
+            break
+        features["n_volumes"] += shape[-1]
+        features["n_voxel_volumes"] += int(np.prod(shape))
+    return features
+
+
+def _parse_duration(duration):
+    """SLURM [D-]HH:MM:SS or MM:SS.mmm durations to hours."""
+    days = 0
+    if "-" in duration:
+        days, duration = duration.split("-")
+    parts = [float(p) for p in duration.split(":")]
+    seconds = sum(p * 60 ** i for i, p in enumerate(reversed(parts)))
+    return int(days) * 24 + seconds / 3600
+
+
+def _parse_memory(memory):
+    """SLURM memory (eg. 1234K, 4.5G) to GB."""
+    match = re.match(r"([\d.]+)([KMGT]?)", memory)
+    if not match:
+        return None
+    units = {"": 1 / 1024 ** 3, "K": 1 / 1024 ** 2, "M": 1 / 1024, "G": 1, "T": 1024}
+    return float(match.group(1)) * units[match.group(2)]
+
+
+def format_walltime(hours):
+    minutes = int(math.ceil(hours * 60))
+    return f"{minutes // 60}:{minutes % 60:02d}:00"
+
+
+def parse_sacct(sacct_path, job_dir=None):
+    """Parse `sacct --parsable2 --format=SACCT_FORMAT` output.
+
+    Returns a dict jobname -> dict(state, hours, cpus, mem_gb), the last
+    submission of a job taking precedence. Array tasks and packed jobs are
+    only resolved with the `job_dir` where they were generated: a packed job
+    gets the state of its logged exit line, the elapsed time of the pack and
+    an even share of its cpus and memory.
+    """
+    with open(sacct_path) as fd:
+        lines = [l.rstrip("\n").split("|") for l in fd if l.strip()]
+    rows = [dict(zip(lines[0], l)) for l in lines[1:]]
+
+    jobs, names = {}, {}
+    for row in rows:
+        jobid, _, step = row["JobID"].partition(".")
+        task = jobid.partition("_")[2] or None
+        if task and not task.isdigit():
+            # pending tasks ranges, eg. 123_[4-9%50]
+            continue
+        job = jobs.setdefault(jobid, {"mem_gb": 0})
+        if not step:
+            names[jobid] = (re.sub(r"\.job$", "", row["JobName"]), task)
+            job["state"] = row["State"].split()[0]
+            job["hours"] = _parse_duration(row["Elapsed"])
+            job["cpu_hours"] = _parse_duration(row["TotalCPU"])
+        if row.get("MaxRSS"):
+            job["mem_gb"] = max(job["mem_gb"], _parse_memory(row["MaxRSS"]) or 0)
+
+    # (script name, array task) -> last submission
+    submissions = {}
+    for jobid in sorted(names, key=lambda j: [int(p) for p in j.split("_")]):
+        job = jobs[jobid]
+        job["cpus"] = job.pop("cpu_hours") / job["hours"] if job["hours"] else None
+        submissions[names[jobid]] = job
+    if job_dir is None:
+        return {name: job for (name, task), job in submissions.items() if task is None}
+
+    generated = job_status.list_jobs(job_dir)
+    pack_sizes = collections.Counter(script for script, _ in generated.values())
+    records = {}
+    for jobname, (script_name, task_idx) in generated.items():
+        if task_idx is not None:
+            job = submissions.get((script_name, str(task_idx)))
+        elif jobname != script_name:
+            job = submissions.get((script_name, None))
+            if job is not None:
+                job = dict(job)
+                n_jobs = pack_sizes[script_name]
+                job["mem_gb"] /= n_jobs
+                job["cpus"] = job["cpus"] / n_jobs if job["cpus"] else None
+                logs = job_status.read_logs(
+                    job_status.log_paths(job_dir, jobname, script_name, None)
+                )
+                exitcodes = job_status.EXITCODE_RE.findall(logs)
+                if exitcodes:
+                    job["state"] = "COMPLETED" if exitcodes[-1] == "0" else "FAILED"
+                elif job["state"] == "COMPLETED":
+                    # the pack completed without this job logging its exit
+                    job["state"] = "FAILED"
+        else:
+            job = submissions.get((jobname, None))
+        if job is not None:
+            records[jobname] = job
+    return records
+
+
+def parse_resource_monitor(monitor_path):
+    """Job-level usage from a nipype resource_monitor.json.
+
+    Node samples are binned in time, per-node peaks are summed in each bin
+    to get the concurrent memory and cpu usage of the workflow.
+    """
+    with open(monitor_path) as fd:
+        monitor = json.load(fd)
+    times = np.asarray(monitor["time"], dtype=float)
+    if not len(times):
+        return None
+    bins = ((times - times.min()) // RESOURCE_MONITOR_BIN).astype(int)
+    node_ids = np.unique(monitor["name"], return_inverse=True)[1]
+    mem, cpus = np.zeros((2, bins.max() + 1, node_ids.max() + 1))
+    np.maximum.at(mem, (bins, node_ids), np.asarray(monitor["rss_GiB"], dtype=float))
+    np.maximum.at(cpus, (bins, node_ids), np.asarray(monitor["cpus"], dtype=float) / 100)
+    return dict(
+        mem_gb=mem.sum(1).max(),
+        cpus=cpus.sum(1).max(),
+        hours=(times.max() - times.min()) / 3600,
+    )
+
+
+def collect_training_data(job_dir, sacct_path, monitor_dir):
+    """Join job features, SLURM accounting and resource monitor usage."""
+    sacct = parse_sacct(sacct_path, job_dir)
+    samples = []
+    for resources_path in sorted(glob.glob(os.path.join(job_dir, "*_resources.json"))):
+        with open(resources_path) as fd:
+            job = json.load(fd)
+        jobname = job["jobname"]
+        if jobname not in sacct or sacct[jobname]["state"] != "COMPLETED":
+            # failed/timed-out jobs usage is censored, do not fit on them
+            continue
+        if any(job["features"][f] is None for f in FEATURES):
+            continue
+        usage = dict(sacct[jobname])
+        monitor_path = os.path.join(monitor_dir, f"{jobname}_resource_monitor.json")
+        if os.path.exists(monitor_path):
+            monitor = parse_resource_monitor(monitor_path)
+            if monitor:
+                usage["mem_gb"] = max(usage["mem_gb"], monitor["mem_gb"])
+                usage["cpus"] = max(usage["cpus"] or 0, monitor["cpus"])
+        if any(usage.get(t) is None for t in TARGETS):
+            continue
+        samples.append(dict(jobname=jobname, features=job["features"], usage=usage))
+    return samples
+
+
+def fit_resource_model(samples):
+    """Least-squares linear model of each target from the job features."""
+    X = np.asarray(
+        [[1.0] + [s["features"][f] for f in FEATURES] for s in samples], dtype=float
+    )
+    # scale features to avoid ill-conditioning with voxel counts
+    scales = np.abs(X).max(0)
+    scales[scales == 0] = 1
+    model = {"features": FEATURES, "n_samples": len(samples), "targets": {}}
+    for target in TARGETS:
+        y = np.asarray([s["usage"][target] for s in samples], dtype=float)
+        coefs = np.linalg.lstsq(X / scales, y, rcond=None)[0] / scales
+        residuals = y - X.dot(coefs)
+        model["targets"][target] = dict(
+            coefs=coefs.tolist(),
+            # cover the worst under-estimation seen in training
+            max_residual=float(max(residuals.max(), 0)),
+        )
+    return model
+
+
+def predict_job_specs(model, features, default_specs):
+    """SLURM job specs (as in FMRIPREP_REQ) for a job of the given size.
+
+    Returns `default_specs` if the features needed by the model are unknown.
+    """
+    if any(features.get(f) is None for f in model["features"]):
+        return dict(default_specs)
+    x = np.asarray([1.0] + [features[f] for f in model["features"]])
+    pred = {}
+    for target, params in model["targets"].items():
+        value = (x.dot(params["coefs"]) + params["max_residual"]) * SAFETY_MARGIN
+        pred[target] = min(max(value, MIN_REQ[target]), MAX_REQ[target])
+    cpus = int(math.ceil(pred["cpus"]))
+    return dict(
+        cpus=cpus,
+        mem_per_cpu=int(math.ceil(pred["mem_gb"] * 1024 / cpus)),
+        time=format_walltime(pred["hours"]),
+        omp_nthreads=min(cpus, MAX_OMP_NTHREADS),
+    )
+
+
+def load_resource_model(model_path):
+    with open(model_path) as fd:
+        return json.load(fd)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        description="fit a resource model for fMRIPrep func jobs from past jobs usage",
+    )
+    parser.add_argument(
+        "derivatives_path", help="fmriprep derivatives dataset where jobs were generated"
+    )
+    parser.add_argument(
+        "--sacct",
+        required=True,
+        help=f"sacct accounting dump (sacct --parsable2 --format={SACCT_FORMAT})",
+    )
+    parser.add_argument(
+        "--monitor-dir",
+        default=os.path.join("/scratch", os.environ.get("USER", "")),
+        help="folder where jobs copied their resource_monitor.json",
+    )
+    parser.add_argument(
+        "--output",
+        default=os.path.join("code", "resource_model.json"),
+        help="path of the model to write, relative to derivatives_path",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    samples = collect_training_data(
+        os.path.join(args.derivatives_path, "code"), args.sacct, args.monitor_dir
+    )
+    if len(samples) <= len(FEATURES):
+        raise RuntimeError(f"not enough completed jobs to fit a model: {len(samples)}")
+    model = fit_resource_model(samples)
+    with open(os.path.join(args.derivatives_path, args.output), "w") as fd:
+        json.dump(model, fd, indent=2)
+    print(f"fitted resource model on {len(samples)} jobs: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,374 @@
+"""Incremental group table of the MRIQC IQMs with streaming outlier flags.
+
+The IQM JSON files are read from git objects, on the main branch and on the
+job branches as soon as they are pushed, so this can run on the RIA store
+repository without any checkout. Only the files whose blob was not seen
+before are read, in a single `git cat-file --batch`, and appended to a
+columnar table per modality (`iqms_<modality>.npz`, one array per column).
+
+Group statistics are kept per modality and protocol (ProtocolName and task
+of the bids_meta) and updated with each new run: Welford running mean and
+variance, and P² sketches of the quartiles. A new run is flagged on the IQMs
+outside the Tukey fences of its group, computed before adding it, once the
+group has `--min-group-size` runs. Flags are printed and appended to
+`iqms_outliers.tsv`.
+
+    python3 iqms.py <derivatives_path> [--state-dir dir] [--watch 300 --fetch origin]
+"""
+import os
+import re
+import sys
+import csv
+import json
+import time
+import fcntl
+import argparse
+import contextlib
+import subprocess
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from mri.utils import git_tree
+
+JOB_BRANCHES_PATTERNS = ["mriqc_study-*"]
+IQM_RE = re.compile(r"^sub-[^/]+/(?:ses-[^/]+/)?(?:anat|func)/[^/]+_(T1w|T2w|bold)\.json$")
+STATE_FILENAME = "iqms_state.json"
+OUTLIERS_FILENAME = "iqms_outliers.tsv"
+QUANTILES = [0.25, 0.5, 0.75]
+MIN_GROUP_SIZE = 20
+FENCE_FACTOR = 3.0  # Tukey "far out" fences
+
+
+class Welford:
+    """Running mean and variance."""
+
+    def __init__(self, n=0, mean=0.0, m2=0.0):
+        self.n, self.mean, self.m2 = n, mean, m2
+
+    def add(self, x):
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+
+    def remove(self, x):
+        if self.n <= 1:
+            self.n, self.mean, self.m2 = 0, 0.0, 0.0
+            return
+        mean = (self.n * self.mean - x) / (self.n - 1)
+        self.m2 -= (x - mean) * (x - self.mean)
+        self.n, self.mean = self.n - 1, mean
+
+    @property
+    def std(self):
+        return (self.m2 / (self.n - 1)) ** 0.5 if self.n > 1 else float("nan")
+
+    def to_dict(self):
+        return dict(n=self.n, mean=self.mean, m2=self.m2)
+
+
+class P2Quantile:
+    """P² streaming estimate of a quantile with 5 markers (Jain & Chlamtac, 1985)."""
+
+    def __init__(self, p, heights=None, positions=None, desired=None):
+        self.p = p
+        self.heights = heights or []
+        self.positions = positions or [0, 1, 2, 3, 4]
+        self.desired = desired or [0, 2 * p, 4 * p, 2 + 2 * p, 4]
+        self.increments = [0, p / 2, p, (1 + p) / 2, 1]
+
+    def add(self, x):
+        q, n = self.heights, self.positions
+        if len(q) < 5:
+            q.append(x)
+            q.sort()
+            return
+        if x < q[0]:
+            q[0], k = x, 0
+        elif x >= q[4]:
+            q[4], k = x, 3
+        else:
+            k = max(i for i in range(4) if q[i] <= x)
+        for i in range(k + 1, 5):
+            n[i] += 1
+        self.desired = [d + inc for d, inc in zip(self.desired, self.increments)]
+        for i in range(1, 4):
+            d = self.desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                parabolic = q[i] + d / (n[i + 1] - n[i - 1]) * (
+                    (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+                    + (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1])
+                )
+                if q[i - 1] < parabolic < q[i + 1]:
+                    q[i] = parabolic
+                else:
+                    q[i] += d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+                n[i] += d
+
+    @property
+    def value(self):
+        if len(self.heights) < 5:
+            if not self.heights:
+                return float("nan")
+            return float(np.percentile(self.heights, 100 * self.p))
+        return self.heights[2]
+
+    def to_dict(self):
+        return dict(
+            p=self.p, heights=self.heights, positions=self.positions, desired=self.desired
+        )
+
+
+class GroupStats:
+    """Running statistics of the IQMs of a modality and protocol."""
+
+    def __init__(self, moments=None, sketches=None):
+        self.moments = {k: Welford(**v) for k, v in (moments or {}).items()}
+        self.sketches = {
+            k: [P2Quantile(**q) for q in v] for k, v in (sketches or {}).items()
+        }
+
+    def add(self, iqms):
+        for name, value in iqms.items():
+            self.moments.setdefault(name, Welford()).add(value)
+            for sketch in self.sketches.setdefault(name, [P2Quantile(p) for p in QUANTILES]):
+                sketch.add(value)
+
+    def remove(self, iqms):
+        # quantile sketches cannot forget a value, only the moments are updated
+        for name, value in iqms.items():
+            if name in self.moments:
+                self.moments[name].remove(value)
+
+    def outliers(self, iqms, min_group_size=MIN_GROUP_SIZE, fence_factor=FENCE_FACTOR):
+        """IQM -> z-score of the values outside the group Tukey fences."""
+        flags = {}
+        for name, value in iqms.items():
+            moments = self.moments.get(name)
+            if moments is None or moments.n < min_group_size:
+                continue
+            q1, _, q3 = (s.value for s in self.sketches[name])
+            iqr = q3 - q1
+            if value < q1 - fence_factor * iqr or value > q3 + fence_factor * iqr:
+                std = moments.std
+                flags[name] = (value - moments.mean) / std if std else float("inf")
+        return flags
+
+    def to_dict(self):
+        return dict(
+            moments={k: v.to_dict() for k, v in self.moments.items()},
+            sketches={k: [q.to_dict() for q in v] for k, v in self.sketches.items()},
+        )
+
+
+def parse_iqms(content):
+    """Numeric IQMs and the protocol of a MRIQC JSON."""
+    data = json.loads(content)
+    bids_meta = data.get("bids_meta", {})
+    protocol = "_".join(
+        str(bids_meta[k]) for k in ["ProtocolName", "task_id"] if bids_meta.get(k)
+    )
+    iqms = {
+        k: float(v)
+        for k, v in data.items()
+        if isinstance(v, (int, float)) and not isinstance(v, bool)
+    }
+    return protocol, iqms
+
+
+@contextlib.contextmanager
+def locked(state_dir):
+    os.makedirs(state_dir, exist_ok=True)
+    with open(os.path.join(state_dir, ".lock"), "a") as fd:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+def load_state(state_dir):
+    state_path = os.path.join(state_dir, STATE_FILENAME)
+    if not os.path.exists(state_path):
+        return dict(refs={}, blobs={}, groups={})
+    with open(state_path) as fd:
+        return json.load(fd)
+
+
+def write_atomic(path, write):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_table(state_dir, modality):
+    """Columns of the table of a modality as lists."""
+    table_path = os.path.join(state_dir, f"iqms_{modality}.npz")
+    if not os.path.exists(table_path):
+        return {}
+    with np.load(table_path) as table:
+        return {k: table[k].tolist() for k in table.files}
+
+
+def write_table(state_dir, modality, columns):
+    table_path = os.path.join(state_dir, f"iqms_{modality}.npz")
+    arrays = {
+        k: np.asarray(v, dtype=str if k in ["run", "protocol", "outliers"] else np.float64)
+        for k, v in columns.items()
+    }
+
+    def save(tmp_path):
+        # through a file object, np.savez would append .npz to the path
+        with open(tmp_path, "wb") as fd:
+            np.savez_compressed(fd, **arrays)
+
+    write_atomic(table_path, save)
+
+
+def append_row(columns, run, protocol, iqms, outliers):
+    """Add or replace the row of `run`, new IQMs are NaN in the previous rows."""
+    n_rows = len(columns.get("run", []))
+    for name in iqms:
+        columns.setdefault(name, [float("nan")] * n_rows)
+    columns.setdefault("run", [])
+    columns.setdefault("protocol", [])
+    columns.setdefault("outliers", [])
+    columns.setdefault("collected", [])
+    values = dict(
+        iqms,
+        run=run,
+        protocol=protocol,
+        outliers=",".join(sorted(outliers)),
+        collected=time.time(),
+    )
+    row = columns["run"].index(run) if run in columns["run"] else None
+    for name, column in columns.items():
+        value = values.get(name, float("nan"))
+        if row is None:
+            column.append(value)
+        else:
+            column[row] = value
+
+
+def collect(
+    derivatives_path, state_dir, min_group_size=MIN_GROUP_SIZE, fence_factor=FENCE_FACTOR
+):
+    """Add the IQMs committed since the last collection, returns the flagged runs."""
+    state = load_state(state_dir)
+    refs = ["HEAD"] + git_tree.list_refs(derivatives_path, JOB_BRANCHES_PATTERNS)
+    shas = git_tree.ref_shas(derivatives_path, refs)
+    changed = [ref for ref, sha in shas.items() if state["refs"].get(ref) != sha]
+
+    new_blobs = {}
+    for ref in changed:
+        for path, blob in git_tree.tree_blobs(derivatives_path, ref).items():
+            if IQM_RE.match(path) and state["blobs"].get(path) != blob:
+                new_blobs[path] = blob
+    contents = git_tree.read_blobs(derivatives_path, sorted(set(new_blobs.values())))
+
+    groups = {k: GroupStats(**v) for k, v in state["groups"].items()}
+    tables = {}
+    flagged = []
+    for path, blob in sorted(new_blobs.items()):
+        modality = IQM_RE.match(path).group(1)
+        run = os.path.basename(path)[: -len(".json")]
+        protocol, iqms = parse_iqms(contents[blob])
+        group = groups.setdefault(f"{modality}/{protocol}", GroupStats())
+        columns = tables.setdefault(modality, load_table(state_dir, modality))
+        if run in columns.get("run", []):
+            # rerun: its previous IQMs leave the running moments
+            row = columns["run"].index(run)
+            group.remove(
+                {
+                    k: columns[k][row]
+                    for k in iqms
+                    if k in columns and not np.isnan(columns[k][row])
+                }
+            )
+        outliers = group.outliers(iqms, min_group_size, fence_factor)
+        group.add(iqms)
+        append_row(columns, run, protocol, iqms, outliers)
+        state["blobs"][path] = blob
+        if outliers:
+            flagged.append((run, protocol, outliers))
+
+    for modality, columns in tables.items():
+        write_table(state_dir, modality, columns)
+    if flagged:
+        with open(os.path.join(state_dir, OUTLIERS_FILENAME), "a") as fd:
+            writer = csv.writer(fd, delimiter="\t", lineterminator="\n")
+            for run, protocol, outliers in flagged:
+                for name, zscore in sorted(outliers.items()):
+                    writer.writerow(
+                        [time.strftime("%Y-%m-%dT%H:%M:%S"), run, protocol, name, f"{zscore:.2f}"]
+                    )
+    state["refs"] = shas
+    state["groups"] = {k: v.to_dict() for k, v in groups.items()}
+
+    def dump(tmp_path):
+        with open(tmp_path, "w") as fd:
+            json.dump(state, fd)
+
+    write_atomic(os.path.join(state_dir, STATE_FILENAME), dump)
+    return len(new_blobs), flagged
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        description="incrementally aggregate MRIQC IQMs and flag outlier runs",
+    )
+    parser.add_argument(
+        "derivatives_path", help="mriqc derivatives dataset (or its RIA repository)"
+    )
+    parser.add_argument(
+        "--state-dir",
+        help="folder of the tables and group statistics, default to <derivatives_path>/code/iqms",
+    )
+    parser.add_argument(
+        "--min-group-size",
+        type=int,
+        default=MIN_GROUP_SIZE,
+        help="runs in a modality/protocol group before flagging outliers",
+    )
+    parser.add_argument(
+        "--fence-factor",
+        type=float,
+        default=FENCE_FACTOR,
+        help="IQR multiple of the Tukey fences outside which an IQM is flagged",
+    )
+    parser.add_argument(
+        "--watch", type=int, metavar="SECONDS", help="collect again every SECONDS"
+    )
+    parser.add_argument(
+        "--fetch", metavar="REMOTE", help="fetch the job branches from REMOTE first"
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    state_dir = args.state_dir or os.path.join(args.derivatives_path, "code", "iqms")
+    while True:
+        if args.fetch:
+            subprocess.run(
+                ["git", "-C", args.derivatives_path, "fetch", "-q", args.fetch], check=True
+            )
+        with locked(state_dir):
+            n_new, flagged = collect(
+                args.derivatives_path, state_dir, args.min_group_size, args.fence_factor
+            )
+        print(f"# {n_new} new IQM files, {len(flagged)} runs flagged", file=sys.stderr)
+        for run, protocol, outliers in flagged:
+            print(
+                f"{run}\t{protocol}\t"
+                + ", ".join(f"{name} (z={z:.1f})" for name, z in sorted(outliers.items()))
+            )
+        if not args.watch:
+            break
+        time.sleep(args.watch)
+
+
+if __name__ == "__main__":
+    main()
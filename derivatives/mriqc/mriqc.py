@@ -2,21 +2,39 @@ import os
 import sys
 import glob
 import argparse
-import bids
 import subprocess
 import json
 import re
 import pathlib
 import datalad.api
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from mri.utils import slurm, bids_index, git_tree
+
 script_dir = os.path.dirname(__file__)
 
-PYBIDS_CACHE_PATH = ".pybids_cache"
+# copy of the shared pybids index relocated in the job clone
+BIDS_DATABASE_DIR = "workdir/bids_db"
 SLURM_JOB_DIR = "code"
+# snapshots of the pybids index read by the queued jobs
+BIDS_INDEX_DIR = "bids_index"
+JOB_BRANCHES_PATTERNS = ["mriqc_study-*"]
 
 MRIQC_REQ = {"cpus": 8, "mem_per_cpu": 4, "time": "8:00:00", "omp_nthreads": 8}
 
+# job specs varying across the tasks of a job array
+ARRAY_TASK_FIELDS = ["jobname", "subject", "session", "subject_session", "modalities"]
+
+# MRIQC modalities run by each preproc, "all" runs them in a single job
+PREPROC_MODALITIES = {"anat": ["T1w"], "func": ["bold"], "all": ["T1w", "bold"]}
+# input folders of each modality, got by containers-run
+MODALITY_INPUTS = {"T1w": ["anat"], "bold": ["fmap", "func"]}
+
 MRIQC_DEFAULT_VERSION = "mriqc-22.0.1"
+MRIQC_CONTAINER = "containers/bids-mriqc"
+NODE_CACHE_SCRIPT = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "..", "mri", "utils", "node_cache.py"
+)
 
 SINGULARITY_CMD_BASE = " ".join(
     [
@@ -30,10 +48,9 @@ SINGULARITY_CMD_BASE = " ".join(
 SINGULARITY_CMD_BASE = " ".join(
     [
         "datalad containers-run "
-        "-m 'mriqc_{subject_session}'",
-        "-n containers/bids-mriqc",
-        "--input sourcedata/{study}/{subject_session}/fmap/",
-        "--input sourcedata/{study}/{subject_session}/func/",
+        "-m \"mriqc_{subject_session}\"",
+        "-n %s" % MRIQC_CONTAINER,
+        "{inputs}",
         "--output .",
         "--",
     ]
@@ -62,6 +79,8 @@ flock --verbose {ds_lockfile} datalad clone {output_repo} $LOCAL_DATASET
 cd $LOCAL_DATASET
 git-annex enableremote ria-beluga-storage
 datalad get -s ria-beluga-storage -J 4 -n -r -R1 . # get sourcedata/* containers
+# container image through the node-local cache shared by jobs
+python3 {node_cache_script} get -s ria-beluga-storage --container {container}
 if [ -d sourcedata/smriprep ] ; then
     datalad get -n sourcedata/smriprep sourcedata/smriprep/sourcedata/freesurfer
 fi
@@ -79,76 +98,97 @@ fi
 """
 
 
-def load_bidsignore(bids_root):
-    """Load .bidsignore file from a BIDS dataset, returns list of regexps"""
-    bids_ignore_path = bids_root / ".bidsignore"
-    if bids_ignore_path.exists():
-        import re
-        import fnmatch
-
-        bids_ignores = bids_ignore_path.read_text().splitlines()
-        return tuple(
-            [
-                re.compile(fnmatch.translate(bi))
-                for bi in bids_ignores
-                if len(bi) and bi.strip()[0] != "#"
-            ]
-        )
-    return tuple()
-
-def write_mriqc_job(layout, subject, session, args, type='func'):
+def mriqc_job_specs(layout, subject, session, args, type='func', modalities=None):
     print(subject, session)
     study = os.path.basename(layout.root)
+    if modalities is None:
+        modalities = PREPROC_MODALITIES[type]
     job_specs = dict(
+        type=type,
         slurm_account=args.slurm_account,
         jobname=f"mriqc_study-{study}_sub-{subject}_ses-{session}",
         email=args.email,
         bids_root=layout.root,
         study=study,
         subject=subject,
+        session=session,
         subject_session=f"sub-{subject}" + (f"/ses-{session}" if session else ""),
         output_repo=args.output_repo,
         derivatives_path=args.output_path,
         ds_lockfile=os.path.join(args.output_repo.replace('ria+file://','').split('@')[0].replace('#~','/alias/'), '.datalad_lock'),
+        container=MRIQC_CONTAINER,
+        node_cache_script=os.path.realpath(NODE_CACHE_SCRIPT),
+        modalities=" ".join(modalities),
+    )
+    subject_session = job_specs["subject_session"]
+    # inputs of all the modalities of the preproc, the same for all the tasks of an array
+    job_specs["inputs"] = " ".join(
+        f"--input sourcedata/{study}/{subject_session}/{folder}/"
+        for modality in PREPROC_MODALITIES[type]
+        for folder in MODALITY_INPUTS[modality]
     )
     job_specs.update(MRIQC_REQ)
-    job_path = os.path.join(args.output_path, SLURM_JOB_DIR, f"{job_specs['jobname']}.sh")
-
+    job_specs["job_path"] = os.path.join(args.output_path, SLURM_JOB_DIR, f"{job_specs['jobname']}.sh")
+    return job_specs
+
+
+def write_job_body(fd, job_specs, args):
+    fd.write(datalad_pre.format(**job_specs))
+    fd.write(
+        bids_index.job_index_cmd(
+            job_specs["bids_root"],
+            str(args.bids_path.relative_to(args.output_path)),
+            BIDS_DATABASE_DIR,
+            snapshot_dir=os.path.join(job_specs["derivatives_path"], SLURM_JOB_DIR, BIDS_INDEX_DIR),
+        )
+    )
 
-    pybids_cache_path = os.path.join(layout.root, PYBIDS_CACHE_PATH)
+    fd.write(
+        " ".join(
+            [
+                SINGULARITY_CMD_BASE.format(**job_specs),
+                "-w workdir/",
+                f"--bids-database-dir {BIDS_DATABASE_DIR}",
+                f"--participant-label {job_specs['subject']}",
+                f"--session-id {job_specs['session']}",
+                f"--omp-nthreads {job_specs['omp_nthreads']}",
+                f"--nprocs {job_specs['cpus']}",
+                f"-m {job_specs['modalities']}",
+                f"--mem_gb {job_specs['mem_per_cpu']*job_specs['cpus']}",
+                "--no-sub", # no internet on compute nodes
+                str(args.bids_path.relative_to(args.output_path)),
+                './',
+                "participant",
+                "\n",
+            ]
+        )
+    )
+    fd.write("mriqc_exitcode=$?\n")
+    fd.write(datalad_post.format(**job_specs))
+    slurm.write_job_exit(fd, "mriqc_exitcode")
 
-    if type == 'anat':
-        acqs = ['T1w']
-    else:
-        acqs = ['bold']
 
-    with open(job_path, "w") as f:
+def write_mriqc_job(job_specs, args):
+    with open(job_specs["job_path"], "w") as f:
         f.write(slurm_preamble.format(**job_specs))
-        f.write(datalad_pre.format(**job_specs))
-
-        f.write(
-            " ".join(
-                [
-                    SINGULARITY_CMD_BASE.format(**job_specs),
-                    "-w workdir/",
-                    f"--participant-label {subject}",
-                    f"--session-id {session}",
-                    f"--omp-nthreads {job_specs['omp_nthreads']}",
-                    f"--nprocs {job_specs['cpus']}",
-                    f"-m {' '.join(acqs)}",
-                    f"--mem_gb {job_specs['mem_per_cpu']*job_specs['cpus']}",
-                    "--no-sub", # no internet on compute nodes
-                    str(args.bids_path.relative_to(args.output_path)),
-                    './',
-                    "participant",
-                    "\n",
-                ]
-            )
-        )
-        f.write("mriqc_exitcode=$?\n")
-        f.write(datalad_post.format(**job_specs))
-        f.write("exit $mriqc_exitcode \n")
+        write_job_body(f, job_specs, args)
+
+    return job_specs["job_path"]
+
 
+def write_array_job(jobs, args):
+    """Write a single job array script running `jobs`, with its TSV manifest."""
+    array_name = f"mriqc_{jobs[0]['type']}_study-{jobs[0]['study']}_array"
+    job_dir = os.path.join(args.output_path, SLURM_JOB_DIR)
+    job_path = os.path.join(job_dir, f"{array_name}.sh")
+    manifest_path = os.path.abspath(os.path.join(job_dir, f"{array_name}_manifest.tsv"))
+    slurm.write_array_manifest(manifest_path, jobs, ARRAY_TASK_FIELDS)
+
+    job_specs = slurm.array_job_specs(jobs, ARRAY_TASK_FIELDS)
+    with open(job_path, "w") as f:
+        f.write(slurm_preamble.format(**dict(job_specs, jobname=array_name)))
+        slurm.write_array_task_header(f, manifest_path, ARRAY_TASK_FIELDS)
+        write_job_body(f, job_specs, args)
     return job_path
 
 
@@ -175,7 +215,11 @@ def parse_args():
         help="path to the ria-store dataset.",
     )
     
-    parser.add_argument("preproc", help="anat or func")
+    parser.add_argument(
+        "preproc",
+        choices=PREPROC_MODALITIES,
+        help="anat, func or all (anat and func in the same job)",
+    )
     parser.add_argument(
         "--slurm-account",
         action="store",
@@ -202,6 +246,23 @@ def parse_args():
         action="store_true",
         help="Force pyBIDS reset_database and reindexing",
     )
+    parser.add_argument(
+        "--array",
+        action="store_true",
+        help="Generate a single SLURM job array with a manifest instead of one job per session",
+    )
+    parser.add_argument(
+        "--array-max-concurrent",
+        action="store",
+        type=int,
+        default=slurm.ARRAY_MAX_CONCURRENT,
+        help="Maximum number of array tasks running at once",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Submit all sessions, even those with existing IQMs on the main or job branches",
+    )
     parser.add_argument(
         "--no-submit",
         action="store_true",
@@ -210,12 +271,49 @@ def parse_args():
     return parser.parse_args()
 
 
+def list_existing_outputs(derivatives_path):
+    """Outputs committed on the main branch or on any (unmerged) job branch."""
+    refs = ["HEAD"] + git_tree.list_refs(derivatives_path, JOB_BRANCHES_PATTERNS)
+    return git_tree.existing_paths(derivatives_path, refs)
+
+
+def expected_iqms(layout, subject, session, modality):
+    """IQMs JSON paths, relative to the derivatives, of the inputs of a modality."""
+    inputs = layout.get(
+        subject=subject,
+        session=session,
+        suffix=modality,
+        extension=[".nii", ".nii.gz"],
+    )
+    return [
+        re.sub(r"\.nii(\.gz)?$", ".json", os.path.relpath(bids_file.path, layout.root))
+        for bids_file in inputs
+        # MRIQC only processes the magnitude of complex-valued runs
+        if bids_file.entities.get("part") != "phase"
+    ]
+
+
+def missing_modalities(layout, subject, session, modalities, existing_outputs):
+    return [
+        modality
+        for modality in modalities
+        if any(
+            iqm not in existing_outputs
+            for iqm in expected_iqms(layout, subject, session, modality)
+        )
+    ]
+
+
 def run_mriqc(layout, args, pipe="anat"):
 
     subjects = args.participant_label
     if not subjects:
         subjects = layout.get_subjects()
 
+    existing_outputs = None
+    if not args.force:
+        existing_outputs = list_existing_outputs(os.path.realpath(args.output_path))
+
     for subject in subjects:
         if args.session_label:
             sessions = args.session_label
@@ -223,27 +321,23 @@ def run_mriqc(layout, args, pipe="anat"):
             sessions = layout.get_sessions(subject=subject)
 
         for session in sessions:
-            yield write_mriqc_job(layout, subject, session, args, type=pipe)
+            modalities = PREPROC_MODALITIES[pipe]
+            if existing_outputs is not None:
+                modalities = missing_modalities(
+                    layout, subject, session, modalities, existing_outputs
+                )
+                if not modalities:
+                    print(
+                        f"all output already exists for sub-{subject} ses-{session}, not rerunning"
+                    )
+                    continue
+            yield mriqc_job_specs(layout, subject, session, args, type=pipe, modalities=modalities)
 
 def main():
 
     args = parse_args()
 
-    pybids_cache_path = os.path.join(args.bids_path, PYBIDS_CACHE_PATH)
-
-    layout = bids.BIDSLayout(
-        args.bids_path,
-        database_path=pybids_cache_path,
-        reset_database=args.force_reindex,
-        ignore=(
-            "code",
-            "stimuli",
-            "sourcedata",
-            "models",
-            re.compile(r"^\."),
-        )
-        + load_bidsignore(args.bids_path),
-    )
+    layout = bids_index.get_layout(args.bids_path, force_reindex=args.force_reindex)
 
     job_path = os.path.join(args.output_path, SLURM_JOB_DIR)
     if not os.path.exists(job_path):
@@ -254,11 +348,23 @@ def main():
             if not any([SLURM_JOB_DIR in l for l in f.readlines()]):
                 f.write(f"{SLURM_JOB_DIR}\n")
 
-    for job_file in run_mriqc(layout, args, args.preproc):
+    jobs = list(run_mriqc(layout, args, args.preproc))
+    if args.array and jobs:
+        job_file = write_array_job(jobs, args)
         if not args.no_submit:
-            submit_slurm_job(job_file)
+            slurm.submit_array_job(
+                job_file,
+                len(jobs),
+                os.path.join(args.output_path, SLURM_JOB_DIR),
+                max_concurrent=args.array_max_concurrent,
+            )
+    else:
+        for job_specs in jobs:
+            job_file = write_mriqc_job(job_specs, args)
+            if not args.no_submit:
+                submit_slurm_job(job_file)
 
-    datalad.api.save(glob.glob('code/*mriqc*.sh'))
+    datalad.api.save(glob.glob('code/*mriqc*.sh')+glob.glob('code/*mriqc*_manifest.tsv'))
     datalad.api.push(to='ria-beluga')
 
 if __name__ == "__main__":
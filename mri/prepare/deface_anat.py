@@ -1,17 +1,24 @@
 import os
+import sys
 import json
-import bids
+import hashlib
 import argparse
 from pathlib import Path
 import logging
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
 import nibabel as nb
 import numpy as np
 import scipy.ndimage
 import datalad.api
 from datalad.support.annexrepo import AnnexRepo
+from bids.layout import Query
 from deepbrain import Extractor
 import scipy.ndimage.morphology
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from mri.utils import nifti, bids_index
+
 from dipy.align.imaffine import (
     transform_centers_of_mass,
     AffineMap,
@@ -26,9 +33,20 @@ from dipy.align.transforms import (
     RigidIsoScalingTransform3D,
 )
 
-PYBIDS_CACHE_PATH = ".pybids_cache"
 MNI_PATH = "../../global/templates/MNI152_T1_1mm.nii.gz"
 MNI_MASK_PATH = "../../global/templates/MNI152_T1_1mm_brain.nii.gz"
+STREAMING_SLAB_SIZE = 16
+PREFETCH_JOBS = 4
+# bump when the derivation of the cached template assets changes
+TEMPLATE_CACHE_VERSION = 1
+TEMPLATE_CACHE_DIR = os.environ.get(
+    "DS_PREP_DEFACE_CACHE",
+    os.path.join(
+        os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")),
+        "ds_prep",
+        "deface_templates",
+    ),
+)
 
 
 def parse_args():
@@ -72,6 +90,39 @@ def parse_args():
         action="store_true",
         help="Output debug images in the current directory",
     )
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help="Read, mask and write series by z-slabs of single volumes to bound memory usage"
+        " (for large 4D/multi-echo series), original dtype and scaling are kept.",
+    )
+    parser.add_argument(
+        "--slab-size",
+        action="store",
+        type=int,
+        default=STREAMING_SLAB_SIZE,
+        help="number of z-slices read and written at once in --streaming mode",
+    )
+    parser.add_argument(
+        "--prefetch",
+        action="store",
+        type=int,
+        default=1,
+        help="number of upcoming sessions whose inputs are fetched in the background"
+        " while the current session is processed (0 to fetch synchronously)",
+    )
+    parser.add_argument(
+        "--prefetch-jobs",
+        action="store",
+        type=int,
+        default=PREFETCH_JOBS,
+        help="number of parallel annex transfers for the prefetch (datalad get -J)",
+    )
+    parser.add_argument(
+        "--drop-after",
+        action="store_true",
+        help="drop the fetched inputs of a session that were not modified once it is processed",
+    )
     parser.add_argument(
         "--ref-bids-filters",
         dest="ref_bids_filters",
@@ -86,6 +137,12 @@ def parse_args():
         type=_bids_filter,
         help="path to or inline json with pybids filters to select all images to deface",
     )
+    parser.add_argument(
+        "--template-cache-dir",
+        action="store",
+        default=TEMPLATE_CACHE_DIR,
+        help="folder where the derived template assets (defacemask...) are cached ($DS_PREP_DEFACE_CACHE)",
+    )
     parser.add_argument(
         "--debug",
         dest="debug_level",
@@ -97,7 +154,7 @@ def parse_args():
 
 
 def _filter_pybids_any(dct):
-    return {k: bids.layout.Query.ANY if v == "*" else v for k, v in dct.items()}
+    return {k: Query.ANY if v == "*" else v for k, v in dct.items()}
 
 
 def _bids_filter(json_str):
@@ -165,7 +222,7 @@ def output_debug_images(ref, moving, affine):
     logging.info(
         f"writing reference serie linearly warped to MNI template: {moving_reg_path}"
     )
-    nb.Nifti1Image(moving_reg, ref.affine).to_filename(moving_reg_path)
+    nifti.save(nb.Nifti1Image(moving_reg, ref.affine), moving_reg_path)
 
     ref_inv_path = moving.path.replace(
         f"_{moving_suffix}", f"_mod-{moving_suffix}_MNIlinreg"
@@ -179,7 +236,7 @@ def output_debug_images(ref, moving, affine):
     logging.info(
         f"writing MNI template image linearly warped to the reference serie: {ref_inv_path}"
     )
-    nb.Nifti1Image(ref_inv, moving_nb.affine).to_filename(ref_inv_path)
+    nifti.save(nb.Nifti1Image(ref_inv, moving_nb.affine), ref_inv_path)
 
 
 def warp_mask(tpl_mask, target, affine):
@@ -187,34 +244,172 @@ def warp_mask(tpl_mask, target, affine):
     warped_mask = scipy.ndimage.affine_transform(
         np.asanyarray(tpl_mask.dataobj).astype(np.int32),
         matrix,
-        output_shape=target.shape,
+        output_shape=target.shape[:3],
         mode="nearest",
     )
     return nb.Nifti1Image(warped_mask, target.affine)
 
 
+def write_masked_serie_streaming(in_path, out_path, mask, slab_size=STREAMING_SLAB_SIZE):
+    """Apply a 3D mask to a (3D or 4D) NIfTI serie one z-slab at a time.
+
+    Raw voxels are copied with the on-disk dtype, header and scaling untouched,
+    masked voxels are set to the raw value that scales back to 0. Only
+    `slab_size` slices of a single volume are held in memory. The output is
+    written atomically, so `in_path` and `out_path` can be the same file.
+    """
+    # read the raw header: the loaded image header has scaling and offset reset
+    with nb.openers.ImageOpener(in_path, "rb") as fobj:
+        header = nb.load(in_path).header_class.from_fileobj(fobj)
+    shape = header.get_data_shape()
+    nx, ny, nz = shape[:3]
+    n_vols = int(np.prod(shape[3:]))
+    dtype = header.get_data_dtype()
+    offset = header.get_data_offset()
+
+    slope, inter = header.get_slope_inter()
+    masked_value = 0
+    if slope is not None and inter:
+        masked_value = -inter / slope
+        if np.issubdtype(dtype, np.integer):
+            masked_value = np.clip(
+                np.round(masked_value), np.iinfo(dtype).min, np.iinfo(dtype).max
+            )
+    masked_value = np.asarray(masked_value, dtype=dtype)
+    mask = np.asanyarray(mask, dtype=bool)
+
+    with nb.openers.ImageOpener(in_path, "rb") as reader, nifti.open_atomic(
+        out_path
+    ) as writer:
+        header.copy().write_to(writer)
+        writer.write(b"\x00" * (offset - writer.tell()))
+        reader.seek(offset)
+        for _ in range(n_vols):
+            for z in range(0, nz, slab_size):
+                slab_shape = (nx, ny, min(slab_size, nz - z))
+                slab = np.frombuffer(
+                    reader.read(int(np.prod(slab_shape)) * dtype.itemsize), dtype=dtype
+                ).reshape(slab_shape, order="F")
+                slab = np.where(mask[:, :, z : z + slab_shape[2]], slab, masked_value)
+                writer.write(slab.tobytes(order="F"))
+
+
+def load_template_assets(mni_path, mni_mask_path, cache_dir=TEMPLATE_CACHE_DIR):
+    """Load template, template brain mask and extended defacemask from the cache.
+
+    The assets are derived once per template content and cache version, stored
+    as .npy files and loaded memory-mapped so that parallel workers start fast
+    and share the same pages.
+    """
+    stats = [os.stat(os.path.realpath(path)) for path in (mni_path, mni_mask_path)]
+    cache_key = hashlib.sha1(
+        json.dumps(
+            [TEMPLATE_CACHE_VERSION]
+            + [
+                # annexed files realpath basename is the content key
+                (os.path.basename(os.path.realpath(path)), st.st_size, st.st_mtime_ns)
+                for path, st in zip((mni_path, mni_mask_path), stats)
+            ]
+        ).encode()
+    ).hexdigest()
+    assets_dir = os.path.join(cache_dir, cache_key)
+
+    if not os.path.exists(assets_dir):
+        logging.info(f"building template assets cache in {assets_dir}")
+        tmpl_image = nb.load(mni_path)
+        tmpl_defacemask = generate_deface_ear_mask(tmpl_image)
+        assets = dict(
+            template=tmpl_image.get_fdata(),
+            template_mask=np.asanyarray(nb.load(mni_mask_path).dataobj),
+            template_affine=tmpl_image.affine,
+            defacemask=np.asanyarray(tmpl_defacemask.dataobj),
+            defacemask_affine=tmpl_defacemask.affine,
+        )
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_dir = f"{assets_dir}.{os.getpid()}.tmp"
+        os.makedirs(tmp_dir)
+        for name, array in assets.items():
+            np.save(os.path.join(tmp_dir, f"{name}.npy"), array)
+        try:
+            os.rename(tmp_dir, assets_dir)
+        except OSError:
+            # another worker populated the cache concurrently
+            for name in assets:
+                os.remove(os.path.join(tmp_dir, f"{name}.npy"))
+            os.rmdir(tmp_dir)
+
+    assets = {
+        name: np.load(os.path.join(assets_dir, f"{name}.npy"), mmap_mode="r")
+        for name in ["template", "template_mask", "defacemask"]
+    }
+    tmpl_affine = np.load(os.path.join(assets_dir, "template_affine.npy"))
+    defacemask_affine = np.load(os.path.join(assets_dir, "defacemask_affine.npy"))
+    return (
+        nb.Nifti1Image(assets["template"], tmpl_affine),
+        nb.Nifti1Image(assets["template_mask"], tmpl_affine),
+        nb.Nifti1Image(assets["defacemask"], defacemask_affine),
+    )
+
+
+class DataladPrefetcher(object):
+    """Fetch the files of upcoming sessions in a background `datalad get -J` stream.
+
+    `batches` is the ordered list of files lists needed by each session.
+    Calling `wait(idx)` blocks until the files of session `idx` are present
+    and queues the fetch of the next `lookahead` sessions.
+    """
+
+    def __init__(self, dataset_path, batches, lookahead=1, jobs=PREFETCH_JOBS):
+        self.dataset_path = dataset_path
+        self.batches = batches
+        self.lookahead = lookahead
+        self.jobs = jobs
+        # a single worker so that transfers are queued in sessions order
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._futures = {}
+
+    def _get(self, paths):
+        if not paths:
+            return
+        subprocess.run(
+            ["datalad", "get", "-J", str(self.jobs), "-d", self.dataset_path, "--"]
+            + paths,
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+
+    def wait(self, idx):
+        for next_idx in range(idx, min(idx + self.lookahead + 1, len(self.batches))):
+            if next_idx not in self._futures:
+                logging.debug(f"queuing prefetch of session #{next_idx}")
+                self._futures[next_idx] = self._executor.submit(
+                    self._get, self.batches[next_idx]
+                )
+        self._futures.pop(idx).result()
+
+    def drop(self, paths):
+        if paths:
+            logging.info(f"dropping {len(paths)} processed inputs")
+            datalad.api.drop(paths, dataset=self.dataset_path)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+
 def main():
 
     args = parse_args()
     logging.basicConfig(level=logging.getLevelName(args.debug_level.upper()))
 
-    pybids_cache_path = os.path.join(args.bids_path, PYBIDS_CACHE_PATH)
-
-    layout = bids.BIDSLayout(
-        args.bids_path,
-        database_path=pybids_cache_path,
-        reset_database=args.force_reindex,
-        index_metadata=False,
-        validate=False,
-    )
+    layout = bids_index.get_layout(args.bids_path, force_reindex=args.force_reindex)
 
     if args.datalad:
         annex_repo = AnnexRepo(args.bids_path)
 
     subject_list = (
-        args.participant_label if args.participant_label else bids.layout.Query.ANY
+        args.participant_label if args.participant_label else Query.ANY
     )
-    session_list = args.session_label if args.session_label else bids.layout.Query.ANY
+    session_list = args.session_label if args.session_label else Query.ANY
     filters = dict(
         subject=subject_list,
         session=session_list,
@@ -232,19 +427,79 @@ def main():
 
     mni_path = os.path.abspath(os.path.join(script_dir, MNI_PATH))
     mni_mask_path = os.path.abspath(os.path.join(script_dir, MNI_MASK_PATH))
-    # if the MNI template image is not available locally
-    if not os.path.exists(os.path.realpath(mni_path)):
-        datalad.api.get(mni_path, dataset=datalad.api.Dataset(script_dir + "/../../"))
-    tmpl_image = nb.load(mni_path)
-    tmpl_image_mask = nb.load(mni_mask_path)
-    tmpl_defacemask = generate_deface_ear_mask(tmpl_image)
+    # if the MNI template images are not available locally
+    for path in (mni_path, mni_mask_path):
+        if not os.path.exists(os.path.realpath(path)):
+            datalad.api.get(path, dataset=datalad.api.Dataset(script_dir + "/../../"))
+    tmpl_image, tmpl_image_mask, tmpl_defacemask = load_template_assets(
+        mni_path, mni_mask_path, cache_dir=args.template_cache_dir
+    )
     brain_xtractor = Extractor()
 
+    all_series_to_deface = []
     for ref_image in deface_ref_images:
-        subject = ref_image.entities["subject"]
-        session = ref_image.entities["session"]
+        series_to_deface = []
+        for filters in args.other_bids_filters:
+            series_to_deface.extend(
+                layout.get(
+                    extension=["nii", "nii.gz"],
+                    subject=ref_image.entities["subject"],
+                    session=ref_image.entities["session"],
+                    **filters,
+                )
+            )
+        all_series_to_deface.append(series_to_deface)
 
-        datalad.api.get(ref_image.path)
+    if args.datalad:
+        # single batched metadata query for all candidate series of the run
+        candidate_paths = list(
+            dict.fromkeys(serie.path for series in all_series_to_deface for serie in series)
+        )
+        series_metadata = {
+            os.path.normpath(p): m
+            for p, m in annex_repo.get_metadata(candidate_paths, batch=True)
+        }
+        repo_path = os.path.realpath(annex_repo.path)
+        restricted_paths = set()
+        for path in candidate_paths:
+            # resolve symlinked parents (eg. /project, /scratch) on both sides,
+            # but not the file itself, an annex symlink to its content
+            real_path = os.path.join(
+                os.path.realpath(os.path.dirname(path)), os.path.basename(path)
+            )
+            rel_path = os.path.relpath(real_path, repo_path)
+            if rel_path not in series_metadata:
+                logging.warning(f"skip {path} as no annex metadata was found for {rel_path}.")
+                continue
+            metadata = series_metadata[rel_path]
+            if metadata.get("distribution-restrictions") is None:
+                logging.info(
+                    f"skip {path} as there are no distribution restrictions metadata set."
+                )
+            else:
+                restricted_paths.add(path)
+        all_series_to_deface = [
+            [serie for serie in series if serie.path in restricted_paths]
+            for series in all_series_to_deface
+        ]
+        # unlock before making any change to avoid unwanted save
+        if restricted_paths:
+            annex_repo.unlock(sorted(restricted_paths))
+
+    prefetcher = DataladPrefetcher(
+        os.path.abspath(args.bids_path),
+        [
+            list(dict.fromkeys([ref_image.path] + [serie.path for serie in series]))
+            for ref_image, series in zip(deface_ref_images, all_series_to_deface)
+        ],
+        lookahead=args.prefetch,
+        jobs=args.prefetch_jobs,
+    )
+
+    for session_idx, (ref_image, series_to_deface) in enumerate(
+        zip(deface_ref_images, all_series_to_deface)
+    ):
+        prefetcher.wait(session_idx)
         ref_image_nb = ref_image.get_image()
 
         matrix_path = ref_image.path.replace(
@@ -273,37 +528,9 @@ def main():
         if args.debug_images:
             output_debug_images(tmpl_image, ref_image, ref2tpl_affine)
 
-        series_to_deface = []
-        for filters in args.other_bids_filters:
-            series_to_deface.extend(
-                layout.get(
-                    extension=["nii", "nii.gz"],
-                    subject=subject,
-                    session=session,
-                    **filters,
-                )
-            )
-
-
         for serie in series_to_deface:
-            if args.datalad:
-                if (
-                    next(annex_repo.get_metadata(serie.path))[1].get(
-                        "distribution-restrictions"
-                    )
-                    is None
-                ):
-                    logging.info(
-                        f"skip {serie.path} as there are no distribution restrictions metadata set."
-                    )
-                    continue
             logging.info(f"defacing {serie.path}")
 
-            datalad.api.get(serie.path)
-            # unlock before making any change to avoid unwanted save
-            if args.datalad:
-                annex_repo.unlock([serie.path for serie in series_to_deface])
-
             serie_nb = serie.get_image()
             warped_mask = warp_mask(tmpl_defacemask, serie_nb, ref2tpl_affine)
             if args.save_all_masks or serie == ref_image:
@@ -316,17 +543,38 @@ def main():
                         f"{warped_mask_path} already exists : will not overwrite, clean before rerun"
                     )
                 else:
-                    warped_mask.to_filename(warped_mask_path)
+                    nifti.save(warped_mask, warped_mask_path)
                     new_files.append(warped_mask_path)
 
-            masked_serie = nb.Nifti1Image(
-                np.asanyarray(serie_nb.dataobj) * np.asanyarray(warped_mask.dataobj),
-                serie_nb.affine,
-                serie_nb.header,
-            )
-            masked_serie.to_filename(serie.path)
+            if args.streaming:
+                write_masked_serie_streaming(
+                    serie.path,
+                    serie.path,
+                    np.asanyarray(warped_mask.dataobj) > 0,
+                    slab_size=args.slab_size,
+                )
+            else:
+                mask_data = np.asanyarray(warped_mask.dataobj)
+                masked_serie = nb.Nifti1Image(
+                    np.asanyarray(serie_nb.dataobj)
+                    * mask_data.reshape(mask_data.shape + (1,) * (serie_nb.ndim - 3)),
+                    serie_nb.affine,
+                    serie_nb.header,
+                )
+                nifti.save(masked_serie, serie.path)
             modified_files.append(serie.path)
 
+        if args.drop_after:
+            # modified series have to be kept until they are saved
+            prefetcher.drop(
+                [
+                    path
+                    for path in prefetcher.batches[session_idx]
+                    if path not in modified_files
+                ]
+            )
+    prefetcher.shutdown()
+
     if args.datalad and len(modified_files):
         logging.info("saving files and metadata changes in datalad")
         annex_repo.set_metadata(
@@ -2,7 +2,6 @@ import sys, os
 import shutil, stat
 import pathlib
 import re, fnmatch
-from bids import BIDSLayout
 from bids.layout import Query
 import json
 import logging
@@ -12,38 +11,12 @@ import datetime
 from operator import itemgetter
 from heudiconv.utils import json_dumps_pretty
 
-PYBIDS_CACHE_PATH = ".pybids_cache"
-
-def _load_bidsignore_(bids_root):
-    """Load .bidsignore file from a BIDS dataset, returns list of regexps"""
-    bids_root = pathlib.Path(bids_root)
-    bids_ignore_path = bids_root / ".bidsignore"
-    if bids_ignore_path.exists():
-        import re
-        import fnmatch
-
-        bids_ignores = bids_ignore_path.read_text().splitlines()
-        return tuple(
-            [
-                re.compile(fnmatch.translate(bi))
-                for bi in bids_ignores
-                if len(bi) and bi.strip()[0] != "#"
-            ]
-        )
-    return tuple()
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from mri.utils import bids_index
 
 def fill_b0_meta(bids_path, participant_label=None, session_label=None, force_reindex=False, match_strategy='before', sloppy=False, **kwargs):
     path = os.path.abspath(bids_path)
-    pybids_cache_path = os.path.join(path, PYBIDS_CACHE_PATH)
-
-    layout = BIDSLayout(
-        path,
-        database_path=pybids_cache_path,
-        reset_database=force_reindex,
-        validate=False,
-        ignore=_load_bidsignore_(path),
-        index_metadata=True,
-    )
+    layout = bids_index.get_layout(path, force_reindex=force_reindex)
     extra_filters = {}
     if participant_label:
         extra_filters["subject"] = participant_label
@@ -279,15 +252,7 @@ def get_candidate_fmaps(layout, epi, match_shim=True, sloppy=0, non_fmap=True):
 
 def fill_intended_for(bids_path, participant_label=None, session_label=None, force_reindex=False, match_strategy='before', sloppy=False, **kwargs):
     path = os.path.abspath(bids_path)
-    pybids_cache_path = os.path.join(path, PYBIDS_CACHE_PATH)
-
-    layout = BIDSLayout(
-        path,
-        database_path=pybids_cache_path,
-        reset_database=force_reindex,
-        validate=False,
-        ignore=_load_bidsignore_(path),
-    )
+    layout = bids_index.get_layout(path, force_reindex=force_reindex)
     extra_filters = {}
     if participant_label:
         extra_filters["subject"] = participant_label
@@ -0,0 +1,270 @@
+"""Shared pybids index of a BIDS dataset, built once per dataset commit.
+
+The SQLite database is stored in `<bids_root>/.pybids_cache/<git HEAD>`, built
+with the same ignore rules for all tools (pybids defaults + .bidsignore) and
+with metadata indexed, then loaded read-only by fmriprep.py, mriqc.py,
+fill_intended_for.py and deface_anat.py. Jobs get a copy relocated to the
+path of the dataset in their clone, that is passed to fMRIPrep/MRIQC with
+`--bids-database-dir`. They copy it from a snapshot taken next to their
+scripts when generated, as the shared index of a version can be pruned or
+rebuilt while they are queued. Derivatives datasets (eg. fMRIPrep outputs) are
+indexed with the pybids derivatives entities.
+
+    python bids_index.py <bids_root> [--force-reindex]
+    python bids_index.py <bids_root> --relocate <index_path> <out_path> <new_root>
+"""
+import os
+import re
+import glob
+import json
+import time
+import shutil
+import sqlite3
+import fnmatch
+import pathlib
+import argparse
+import subprocess
+import logging
+
+PYBIDS_CACHE_PATH = ".pybids_cache"
+INDEX_FILENAME = "layout_index.sqlite"
+DEFAULT_IGNORE = ("code", "stimuli", "sourcedata", "models", re.compile(r"^\."))
+# number of dataset versions for which the index is kept
+KEEP_VERSIONS = 2
+
+# indexes built by this process, not rebuilt for each job of a dirty dataset
+_built_indexes = set()
+# snapshots taken by this process, one per index for all the jobs generated
+_job_snapshots = {}
+
+# run in jobs to get a copy of the index relocated to the dataset path in the clone
+relocate_index_cmd = (
+    "python3 {script} {bids_root} --relocate {index_path} {job_index_path} "
+    "{job_root}/{job_bids_path}\n"
+)
+
+
+def load_bidsignore(bids_root, mode="python"):
+    """Load .bidsignore file from a BIDS dataset, returns list of regexps"""
+    bids_ignore_path = pathlib.Path(bids_root) / ".bidsignore"
+    if bids_ignore_path.exists():
+        bids_ignores = bids_ignore_path.read_text().splitlines()
+        if mode == "python":
+            return tuple(
+                [
+                    re.compile(fnmatch.translate(bi))
+                    for bi in bids_ignores
+                    if len(bi) and bi.strip()[0] != "#"
+                ]
+            )
+        elif mode == "bash":
+            return [
+                f"m/{bi}/"
+                for bi in bids_ignores
+                if len(bi) and bi.strip()[0] != "#"
+            ]
+    return tuple()
+
+
+def dataset_version(bids_root):
+    """git HEAD commit of the dataset, suffixed with -dirty if the worktree has
+    uncommitted changes, None if not a git repository."""
+
+    def _git(*args):
+        return subprocess.run(
+            ["git", "-C", str(bids_root)] + list(args),
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+
+    try:
+        head = _git("rev-parse", "HEAD")
+        dirty = _git(
+            "status",
+            "--porcelain",
+            "--ignore-submodules",
+            "--",
+            ".",
+            f":(exclude){PYBIDS_CACHE_PATH}",
+        )
+    except subprocess.CalledProcessError:
+        return None
+    return f"{head}-dirty" if dirty else head
+
+
+def index_path(bids_root):
+    bids_root = os.path.realpath(bids_root)
+    return os.path.join(
+        bids_root, PYBIDS_CACHE_PATH, dataset_version(bids_root) or "worktree"
+    )
+
+
+def is_derivatives(bids_root):
+    description_path = os.path.join(bids_root, "dataset_description.json")
+    if not os.path.exists(description_path):
+        return False
+    with open(description_path) as fd:
+        return json.load(fd).get("DatasetType") == "derivative"
+
+
+def _layout(bids_root, database_path, reset_database=False):
+    import bids
+
+    return bids.BIDSLayout(
+        bids_root,
+        database_path=database_path,
+        reset_database=reset_database,
+        validate=False,
+        index_metadata=True,
+        ignore=DEFAULT_IGNORE + load_bidsignore(bids_root),
+        # derivatives entities (space, desc, ...) for fMRIPrep outputs
+        config=["bids", "derivatives"] if is_derivatives(bids_root) else None,
+    )
+
+
+def build_index(bids_root, force=False):
+    """Build the index of the current dataset version if it does not exist."""
+    bids_root = os.path.realpath(bids_root)
+    db_path = index_path(bids_root)
+    # the index of a dirty worktree cannot be trusted to be current
+    if os.path.exists(os.path.join(db_path, INDEX_FILENAME)) and not force:
+        if db_path in _built_indexes or not (
+            db_path.endswith("-dirty") or db_path.endswith("worktree")
+        ):
+            return db_path
+
+    logging.info(f"indexing {bids_root} in {db_path}")
+    tmp_path = f"{db_path}.{os.getpid()}.tmp"
+    _layout(bids_root, tmp_path, reset_database=True)
+    if os.path.exists(db_path):
+        shutil.rmtree(db_path)
+    try:
+        os.rename(tmp_path, db_path)
+    except OSError:
+        # another process built the same index concurrently
+        shutil.rmtree(tmp_path)
+    _built_indexes.add(db_path)
+
+    old_versions = sorted(
+        [
+            p
+            for p in glob.glob(os.path.join(bids_root, PYBIDS_CACHE_PATH, "*"))
+            if os.path.isdir(p) and not p.endswith(".tmp")
+        ],
+        key=os.path.getmtime,
+    )[:-KEEP_VERSIONS]
+    for old_version in old_versions:
+        shutil.rmtree(old_version, ignore_errors=True)
+    return db_path
+
+
+def get_layout(bids_root, force_reindex=False):
+    """BIDSLayout loaded from the index of the current dataset version."""
+    return _layout(
+        os.path.realpath(bids_root), build_index(bids_root, force=force_reindex)
+    )
+
+
+def relocate_index(db_path, out_path, old_root, new_root):
+    """Copy an index with all its paths moved from `old_root` to `new_root`."""
+    shutil.copytree(db_path, out_path, dirs_exist_ok=True)
+    con = sqlite3.connect(os.path.join(out_path, INDEX_FILENAME))
+    for (table,) in con.execute("SELECT name FROM sqlite_master WHERE type='table'"):
+        for col in con.execute(f"PRAGMA table_info({table})").fetchall():
+            if col[2].upper() in ("TEXT", "JSON") or col[2].upper().startswith("VARCHAR"):
+                con.execute(
+                    f"UPDATE {table} SET {col[1]} = REPLACE({col[1]}, ?, ?)",
+                    (str(old_root), str(new_root)),
+                )
+    con.commit()
+    con.close()
+
+
+def snapshot_index(bids_root, snapshot_dir):
+    """Copy of the current index of `bids_root` in `snapshot_dir`, returns its path.
+
+    Snapshots of a commit are shared by successive job generations, those of a
+    dirty worktree are timestamped as their content differs.
+    """
+    db_path = build_index(bids_root)
+    snapshot_dir = os.path.realpath(snapshot_dir)
+    key = (db_path, snapshot_dir)
+    if key in _job_snapshots:
+        return _job_snapshots[key]
+    name = os.path.basename(db_path)
+    if name.endswith("-dirty") or name == "worktree":
+        name += f"-{time.strftime('%Y%m%d%H%M%S')}-{os.getpid()}"
+    out_path = os.path.join(snapshot_dir, name)
+    if not os.path.exists(os.path.join(out_path, INDEX_FILENAME)):
+        os.makedirs(snapshot_dir, exist_ok=True)
+        # never saved in the dataset with the job scripts
+        with open(os.path.join(snapshot_dir, ".gitignore"), "w") as fd:
+            fd.write("*\n")
+        tmp_path = f"{out_path}.{os.getpid()}.tmp"
+        shutil.copytree(db_path, tmp_path)
+        try:
+            os.rename(tmp_path, out_path)
+        except OSError:
+            # another process took the same snapshot concurrently
+            shutil.rmtree(tmp_path)
+    _job_snapshots[key] = out_path
+    return out_path
+
+
+def job_index_cmd(
+    bids_root,
+    job_bids_path,
+    job_index_path="workdir/bids_db",
+    job_root="$PWD",
+    snapshot_dir=None,
+):
+    """Job script command relocating the index of `bids_root` at `job_index_path`.
+
+    The index is built if needed when the job is generated, `job_bids_path` is
+    the path of the dataset relative to the job working directory, which is
+    seen as `job_root` by the tool using the index. With `snapshot_dir` (the
+    job scripts folder) the job reads a snapshot of the index that stays
+    there until removed with the scripts, instead of the shared index.
+    """
+    if snapshot_dir:
+        index_path = snapshot_index(bids_root, snapshot_dir)
+    else:
+        index_path = build_index(bids_root)
+    return relocate_index_cmd.format(
+        script=os.path.abspath(__file__),
+        bids_root=os.path.realpath(bids_root),
+        index_path=index_path,
+        job_index_path=job_index_path,
+        job_bids_path=job_bids_path,
+        job_root=job_root,
+    )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        description="build the shared pybids index of a BIDS dataset for its current commit",
+    )
+    parser.add_argument("bids_path", help="BIDS dataset to index")
+    parser.add_argument(
+        "--force-reindex",
+        action="store_true",
+        help="Rebuild the index even if it exists for the current commit",
+    )
+    parser.add_argument(
+        "--relocate",
+        nargs=3,
+        metavar=("INDEX_PATH", "OUT_PATH", "NEW_ROOT"),
+        help="copy an existing index of bids_path to OUT_PATH, moving its paths to NEW_ROOT",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+    if args.relocate:
+        relocate_index(args.relocate[0], args.relocate[1], os.path.realpath(args.bids_path), args.relocate[2])
+    else:
+        print(build_index(args.bids_path, force=args.force_reindex))
@@ -0,0 +1,248 @@
+"""Memory-mapped access to the fMRIPrep derivatives timeseries.
+
+Loading a `desc-preproc_bold.nii.gz` or a `bold.dtseries.nii` with
+`get_fdata()` decompresses the whole run into a float64 array. Here each run
+is instead decompressed once, by chunks of volumes, into a float32 `.npy` of
+shape (n_volumes, n_voxels) in a cache folder, that is then memory-mapped:
+masked voxel or parcel timeseries and time windows are read from the cache
+without materializing whole runs. Volume voxels are in the NIfTI file order
+(Fortran order of the 3D grid), as returned by `load_mask`.
+
+Cache entries are named after the annex key of the run when annexed (the
+content hash), or its path, size and mtime otherwise, so that they are shared
+by the clones of a dataset and invalidated when the content changes. Runs are
+found through the shared pybids index of the derivatives dataset.
+
+    from mri.utils import bids_index, derivatives_reader as dr
+    layout = bids_index.get_layout(fmriprep_path)
+    runs = dr.find_runs(layout, "fsLR_den-91k", task="rest")
+    parcels = dr.map_runs(dr.parcel_timeseries, runs, labels=dr.load_labels(atlas))
+
+    python3 derivatives_reader.py cache <derivatives_path> [--space ...] [--jobs N]
+    python3 derivatives_reader.py evict [--max-size-gb N]
+"""
+import os
+import sys
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
+import nibabel as nb
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from mri.utils import bids_index, nifti
+
+TIMESERIES_CACHE_DIR = os.environ.get(
+    "DS_PREP_TIMESERIES_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "ds_prep", "timeseries"),
+)
+TIMESERIES_CACHE_MAX_SIZE_GB = 500
+CIFTI_SPACE = "fsLR_den-91k"
+READ_THREADS = 8
+
+
+def find_runs(layout, space=CIFTI_SPACE, **entities):
+    """Paths of the preprocessed bold runs in `space` (eg. MNI152NLin2009cAsym, fsLR_den-91k)."""
+    template, _, density = space.partition("_den-")
+    if density:
+        files = layout.get(
+            suffix="bold", space=template, extension=".dtseries.nii", **entities
+        )
+        return sorted(f.path for f in files if f"_den-{density}_" in f.filename)
+    files = layout.get(
+        suffix="bold",
+        space=template,
+        desc="preproc",
+        extension=[".nii", ".nii.gz"],
+        **entities,
+    )
+    return sorted(f.path for f in files)
+
+
+def cache_key(run_path):
+    real_path = os.path.realpath(run_path)
+    if f"{os.sep}annex{os.sep}objects{os.sep}" in real_path:
+        return os.path.basename(real_path)
+    st = os.stat(real_path)
+    key = f"{real_path}:{st.st_size}:{st.st_mtime_ns}".encode()
+    return f"{hashlib.sha1(key).hexdigest()}_{os.path.basename(run_path)}"
+
+
+def cache_path(run_path, cache_dir=TIMESERIES_CACHE_DIR):
+    return os.path.join(cache_dir, f"{cache_key(run_path)}.npy")
+
+
+def build_cache(run_path, cache_dir=TIMESERIES_CACHE_DIR):
+    """Decompress a run into its float32 cache entry if missing, returns its path."""
+    out_path = cache_path(run_path, cache_dir)
+    if os.path.exists(out_path):
+        return out_path
+    os.makedirs(cache_dir, exist_ok=True)
+    img = nb.load(run_path)
+    if run_path.endswith(".dtseries.nii"):
+        shape = img.shape
+    else:
+        shape = (img.shape[3], int(np.prod(img.shape[:3])))
+    tmp_path = f"{out_path}.{os.getpid()}.tmp"
+    try:
+        data = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32, shape=shape)
+        start = 0
+        for chunk in nifti.iter_volume_chunks(run_path):
+            data[start : start + len(chunk)] = chunk
+            start += len(chunk)
+        data.flush()
+        del data
+        os.replace(tmp_path, out_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return out_path
+
+
+def open_run(run_path, cache_dir=TIMESERIES_CACHE_DIR):
+    """Read-only memmap (n_volumes, n_voxels) of a run, cached on first access."""
+    path = build_cache(run_path, cache_dir)
+    # the mtime orders entries for eviction
+    os.utime(path)
+    return np.load(path, mmap_mode="r")
+
+
+def load_mask(mask):
+    """Boolean voxel mask of a NIfTI path (file order) or of an array."""
+    if isinstance(mask, str):
+        mask = np.asanyarray(nb.load(mask).dataobj).ravel(order="F")
+    return np.asarray(mask).ravel() > 0
+
+
+def load_labels(labels):
+    """Integer parcel labels per voxel/grayordinate of an atlas (NIfTI, dlabel/dscalar) or array."""
+    if isinstance(labels, str):
+        img = nb.load(labels)
+        if isinstance(img, nb.Cifti2Image):
+            labels = np.asanyarray(img.dataobj)[0]
+        else:
+            labels = np.asanyarray(img.dataobj).ravel(order="F")
+    return np.asarray(labels).ravel().astype(np.int64)
+
+
+def window(run_path, start=None, stop=None, cache_dir=TIMESERIES_CACHE_DIR):
+    """Volumes [start, stop) of a run, as a memmap view."""
+    return open_run(run_path, cache_dir)[start:stop]
+
+
+def masked_timeseries(
+    run_path, mask, start=None, stop=None, cache_dir=TIMESERIES_CACHE_DIR
+):
+    """Timeseries (n_volumes, n_mask_voxels) of the voxels in `mask`."""
+    data = open_run(run_path, cache_dir)[start:stop]
+    mask = load_mask(mask)
+    out = np.empty((data.shape[0], mask.sum()), dtype=np.float32)
+    for t in range(0, data.shape[0], nifti.CHUNK_VOLUMES):
+        out[t : t + nifti.CHUNK_VOLUMES] = data[t : t + nifti.CHUNK_VOLUMES][:, mask]
+    return out
+
+
+def parcel_timeseries(
+    run_path, labels, start=None, stop=None, cache_dir=TIMESERIES_CACHE_DIR
+):
+    """Mean timeseries (n_volumes, n_parcels) of the non-zero labels, in increasing order.
+
+    Returns the labels and the timeseries.
+    """
+    data = open_run(run_path, cache_dir)[start:stop]
+    labels = load_labels(labels)
+    order = np.argsort(labels, kind="stable")
+    sorted_labels = labels[order]
+    parcels, starts, counts = np.unique(sorted_labels, return_index=True, return_counts=True)
+    keep = parcels != 0
+    out = np.empty((data.shape[0], keep.sum()), dtype=np.float32)
+    for t in range(0, data.shape[0], nifti.CHUNK_VOLUMES):
+        chunk = data[t : t + nifti.CHUNK_VOLUMES][:, order]
+        sums = np.add.reduceat(chunk, starts, axis=1, dtype=np.float64)
+        out[t : t + nifti.CHUNK_VOLUMES] = (sums / counts)[:, keep]
+    return parcels[keep], out
+
+
+def map_runs(func, run_paths, max_workers=READ_THREADS, **kwargs):
+    """Apply `func(run_path, **kwargs)` to many runs in a thread pool, returns path -> result."""
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(lambda path: func(path, **kwargs), run_paths)
+        return dict(zip(run_paths, results))
+
+
+def evict(cache_dir=TIMESERIES_CACHE_DIR, max_size_gb=TIMESERIES_CACHE_MAX_SIZE_GB):
+    """Remove the least recently opened entries above `max_size_gb`."""
+    if not os.path.isdir(cache_dir):
+        return
+    entries = [
+        (entry.stat().st_mtime, entry.stat().st_size, entry.path)
+        for entry in os.scandir(cache_dir)
+        if entry.name.endswith(".npy")
+    ]
+    total = sum(e[1] for e in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_size_gb * 1024 ** 3:
+            break
+        # an entry memory-mapped by a reader stays valid until unmapped
+        os.remove(path)
+        total -= size
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        description="fill or evict the memory-mapped cache of fMRIPrep timeseries",
+    )
+    parser.add_argument("action", choices=["cache", "evict"])
+    parser.add_argument("derivatives_path", nargs="?", help="fmriprep derivatives dataset")
+    parser.add_argument(
+        "--cache-dir",
+        default=TIMESERIES_CACHE_DIR,
+        help="cache folder ($DS_PREP_TIMESERIES_CACHE)",
+    )
+    parser.add_argument(
+        "--space", nargs="+", default=[CIFTI_SPACE], help="output spaces to cache"
+    )
+    parser.add_argument(
+        "--participant-label",
+        nargs="+",
+        help="a space delimited list of participant identifiers to cache",
+    )
+    parser.add_argument("--task", nargs="+", help="tasks to cache, default to all")
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=nifti.available_cpus(),
+        help="runs decompressed in parallel",
+    )
+    parser.add_argument(
+        "--max-size-gb",
+        type=float,
+        default=TIMESERIES_CACHE_MAX_SIZE_GB,
+        help="cache size above which entries are evicted",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.action == "cache":
+        if not args.derivatives_path:
+            sys.exit("derivatives_path is required to cache runs")
+        layout = bids_index.get_layout(args.derivatives_path)
+        entities = {}
+        if args.participant_label:
+            entities["subject"] = args.participant_label
+        if args.task:
+            entities["task"] = args.task
+        run_paths = [p for space in args.space for p in find_runs(layout, space, **entities)]
+        with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            for path in executor.map(
+                build_cache, run_paths, [args.cache_dir] * len(run_paths)
+            ):
+                print(path)
+    evict(args.cache_dir, args.max_size_gb)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+"""Merge many job branches in a single commit through git plumbing.
+
+Instead of checking out and merging each branch, the changes of every branch
+since its merge base are applied as tree edits to a temporary index built
+from the target commit, and written as a single commit with all the branches
+as parents. Conflicts are resolved as with `git merge -X ours` at the file
+level: a path changed both in the target (or an earlier branch) and in the
+branch keeps the target version. Paths can be renamed or excluded on the fly.
+Only the files changed by the merge are then updated in the work tree, and
+the merged branches are deleted in bulk.
+
+    python3 git_merge.py --preset fmriprep [--remote ria-beluga] [--delete]
+    python3 git_merge.py --preset heudiconv --remote ria-sequoia --delete
+"""
+import os
+import re
+import sys
+import fnmatch
+import argparse
+import tempfile
+import subprocess
+import logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from mri.utils import git_tree
+
+NULL_SHA = "0" * 40
+FMRIPREP_BRANCH_RE = re.compile(r"^.mriprep_(?:study-[^_]+_)?(.+)\.job$")
+
+
+def fmriprep_report_rename(branch, path):
+    """Rename the subject report after the job, to avoid collisions between sessions."""
+    match = FMRIPREP_BRANCH_RE.match(branch.rsplit("/", 1)[-1])
+    if match and "/" not in path and fnmatch.fnmatch(path, "sub-*.html"):
+        return f"{match.group(1)}.html"
+    return path
+
+
+PRESETS = {
+    "fmriprep": dict(patterns=["?mriprep_*.job"], rename=fmriprep_report_rename, exclude=[]),
+    "heudiconv": dict(patterns=["p0?_*"], rename=None, exclude=[".heudiconv"]),
+}
+
+
+def git(repo_path, *args, env=None, input=None):
+    return subprocess.run(
+        ["git", "-C", str(repo_path)] + list(args),
+        check=True,
+        capture_output=True,
+        env=env,
+        input=input,
+    ).stdout
+
+
+def list_refs(repo_path, target):
+    """sha and whether it is merged in `target`, for all the branches."""
+    namespaces = ["refs/heads", "refs/remotes"]
+    merged = set(
+        git(repo_path, "for-each-ref", f"--merged={target}", "--format=%(refname)", *namespaces)
+        .decode()
+        .split()
+    )
+    out = git(repo_path, "for-each-ref", "--format=%(objectname) %(refname)", *namespaces)
+    return {
+        ref: (sha, ref in merged)
+        for sha, ref in (line.split(" ", 1) for line in out.decode().splitlines())
+    }
+
+
+def tree_entries(repo_path, commit):
+    """path -> (mode, sha) of all the entries of a commit tree."""
+    out = git(repo_path, "ls-tree", "-r", "-z", "--full-tree", commit)
+    entries = {}
+    for line in out.decode().split("\0"):
+        if line:
+            meta, path = line.split("\t", 1)
+            mode, _, sha = meta.split()
+            entries[path] = (mode, sha)
+    return entries
+
+
+def branch_changes(repo_path, base, branch):
+    """(path, (old mode, old sha), (new mode, new sha)) changed from base to branch."""
+    out = git(repo_path, "diff-tree", "-r", "-z", "--no-renames", base, branch).decode()
+    fields = out.split("\0")
+    changes = []
+    for meta, path in zip(fields[0::2], fields[1::2]):
+        if not meta.startswith(":"):
+            continue
+        old_mode, new_mode, old_sha, new_sha, _ = meta[1:].split()
+        changes.append((path, (old_mode, old_sha), (new_mode, new_sha)))
+    return changes
+
+
+def excluded(path, exclude):
+    return any(path == e or path.startswith(e.rstrip("/") + "/") for e in exclude)
+
+
+def merge_trees(repo_path, target, branches, rename=None, exclude=()):
+    """Apply the changes of `branches` on the tree of `target`.
+
+    Returns the edited entries (None for removed paths) and the conflicts
+    (path, branch) that kept the target version.
+    """
+    entries = tree_entries(repo_path, target)
+    # excluded paths are removed from the merged tree, as `git rm` did
+    edits = {path: None for path in entries if excluded(path, exclude)}
+    conflicts = []
+    null = ("000000", NULL_SHA)
+
+    for branch in branches:
+        base = git(repo_path, "merge-base", target, branch).decode().strip()
+        for path, old, new in branch_changes(repo_path, base, branch):
+            if excluded(path, exclude):
+                continue
+            dest = rename(branch, path) if rename else path
+            current = (edits[dest] if dest in edits else entries.get(dest)) or null
+            if current == new:
+                continue
+            if dest != path:
+                # renamed paths are new in the target, they never delete
+                if new == null:
+                    continue
+                old = null
+            if current != old:
+                # changed on our side since the branch forked: keep ours
+                conflicts.append((dest, branch))
+                continue
+            edits[dest] = None if new == null else new
+    return edits, conflicts
+
+
+def write_tree(repo_path, target, edits):
+    """Tree of `target` with `edits` applied, built in a temporary index."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        env = dict(os.environ, GIT_INDEX_FILE=os.path.join(tmp_dir, "index"))
+        git(repo_path, "read-tree", target, env=env)
+        index_info = "".join(
+            f"0 {NULL_SHA}\t{path}\0" if entry is None else f"{entry[0]} {entry[1]}\t{path}\0"
+            for path, entry in sorted(edits.items())
+        )
+        git(repo_path, "update-index", "-z", "--index-info", env=env, input=index_info.encode())
+        return git(repo_path, "write-tree", env=env).decode().strip()
+
+
+def merge_branches(
+    repo_path,
+    branches,
+    target="HEAD",
+    rename=None,
+    exclude=(),
+    message=None,
+    update_worktree=True,
+):
+    """Merge `branches` into `target` in a single commit, returns it (or None)."""
+    target_commit = git(repo_path, "rev-parse", "--verify", target).decode().strip()
+    refs = list_refs(repo_path, target_commit)
+    branches = [b for b in branches if not refs.get(b, (None, False))[1]]
+    if not branches:
+        logging.info("all branches already merged")
+        return None
+
+    edits, conflicts = merge_trees(repo_path, target_commit, branches, rename, exclude)
+    for path, branch in conflicts:
+        logging.warning(f"conflict on {path} from {branch}, keeping the target version")
+    tree = write_tree(repo_path, target_commit, edits)
+
+    message = message or f"merge {len(branches)} branches\n\n" + "\n".join(branches)
+    parents = [arg for b in [target_commit] + branches for arg in ("-p", b)]
+    commit = git(repo_path, "commit-tree", tree, *parents, "-m", message).decode().strip()
+
+    ref = git(repo_path, "rev-parse", "--symbolic-full-name", target).decode().strip() or target
+    head_ref = git(repo_path, "rev-parse", "--symbolic-full-name", "HEAD").decode().strip()
+    if update_worktree and ref in ["HEAD", head_ref]:
+        # only the files changed by the merge are written in the work tree
+        git(repo_path, "read-tree", "-m", "-u", target_commit, commit)
+    git(repo_path, "update-ref", "-m", "git_merge.py", ref, commit, target_commit)
+    logging.info(f"merged {len(branches)} branches in {commit}, {len(edits)} paths changed")
+    return commit
+
+
+def delete_branches(repo_path, branches, remote=None):
+    """Delete local branches and, if `remote` is given, the branches of `remote`, in bulk."""
+    local = [b[len("refs/heads/"):] for b in branches if b.startswith("refs/heads/")]
+    remote_prefix = f"refs/remotes/{remote}/"
+    remotes = [b[len(remote_prefix):] for b in branches if remote and b.startswith(remote_prefix)]
+    if local:
+        git(repo_path, "branch", "-D", *local)
+    if remotes:
+        git(repo_path, "push", remote, "--delete", *remotes)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        description="merge job branches in a single commit without checking them out",
+    )
+    parser.add_argument("--repo", default=".", help="repository to merge into")
+    parser.add_argument("--preset", choices=PRESETS, help="branch patterns, renames and exclusions")
+    parser.add_argument("--pattern", nargs="+", default=[], help="branch name patterns to merge")
+    parser.add_argument("--exclude", nargs="+", default=[], help="paths not to merge")
+    parser.add_argument("--target", default="HEAD", help="branch to merge into")
+    parser.add_argument(
+        "--remote", help="also merge the branches of this remote, matched by name"
+    )
+    parser.add_argument(
+        "--delete",
+        action="store_true",
+        help="delete the merged local branches",
+    )
+    parser.add_argument(
+        "--delete-remote",
+        action="store_true",
+        help="also delete the merged branches on the remote",
+    )
+    parser.add_argument(
+        "--no-worktree-update",
+        action="store_true",
+        help="only update the target ref, leaving the index and work tree as they are",
+    )
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+    preset = PRESETS.get(args.preset, dict(patterns=[], rename=None, exclude=[]))
+    patterns = preset["patterns"] + args.pattern
+    if not patterns:
+        sys.exit("no branch pattern given")
+
+    refs = git_tree.list_refs(args.repo, patterns, remotes=False)
+    if args.remote:
+        refs += [
+            ref
+            for ref in git_tree.list_refs(args.repo, patterns)
+            if ref.startswith(f"refs/remotes/{args.remote}/")
+        ]
+    # a branch both local and on the remote is merged once
+    shas = {}
+    all_refs = list_refs(args.repo, args.target)
+    for ref in refs:
+        shas.setdefault(all_refs[ref][0], ref)
+
+    merge_branches(
+        args.repo,
+        sorted(shas.values()),
+        target=args.target,
+        rename=preset["rename"],
+        exclude=preset["exclude"] + args.exclude,
+        update_worktree=not args.no_worktree_update,
+    )
+    if args.delete or args.delete_remote:
+        all_refs = list_refs(args.repo, args.target)
+        merged = [ref for ref in refs if all_refs[ref][1]]
+        delete_branches(args.repo, merged, args.remote if args.delete_remote else None)
+
+
+if __name__ == "__main__":
+    main()
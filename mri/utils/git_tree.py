@@ -0,0 +1,95 @@
+"""List and read the files committed on git branches without checking them out.
+
+Reads git objects only (trees, and blobs of the files not annexed), so it
+works on datasets where the annexed content is not present, on bare
+repositories and on remote-tracking job branches that are not merged yet.
+"""
+import fnmatch
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+LS_TREE_WORKERS = 8
+
+
+def git(repo_path, *args):
+    return subprocess.run(
+        ["git", "-C", str(repo_path)] + list(args),
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+
+
+def list_refs(repo_path, patterns, remotes=True):
+    """Local (and remote-tracking) branches whose name matches any of `patterns`."""
+    namespaces = ["refs/heads"] + (["refs/remotes"] if remotes else [])
+    refs = git(repo_path, "for-each-ref", "--format=%(refname)", *namespaces).split()
+    return [
+        ref
+        for ref in refs
+        if any(fnmatch.fnmatch(ref.rsplit("/", 1)[-1], p) for p in patterns)
+    ]
+
+
+def ls_tree(repo_path, ref, pathspecs=()):
+    """Paths of all the files committed in `ref`, under `pathspecs` literal prefixes."""
+    out = git(repo_path, "ls-tree", "-r", "-z", "--name-only", ref, "--", *pathspecs)
+    return [path for path in out.split("\0") if path]
+
+
+def existing_paths(repo_path, refs, pathspecs=(), max_workers=LS_TREE_WORKERS):
+    """Union of the files committed in any of `refs`, listed in parallel."""
+    paths = set()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for ref_paths in executor.map(
+            lambda ref: ls_tree(repo_path, ref, pathspecs), refs
+        ):
+            paths.update(ref_paths)
+    return paths
+
+
+def commit_paths(repo_path, ref):
+    """Paths changed by the last commit of `ref` (none for a merge commit)."""
+    out = git(repo_path, "diff-tree", "-r", "-z", "--no-commit-id", "--name-only", ref)
+    return [path for path in out.split("\0") if path]
+
+
+def ref_shas(repo_path, refs):
+    """Commit sha of each of `refs`."""
+    if not refs:
+        return {}
+    return dict(zip(refs, git(repo_path, "rev-parse", *refs).split()))
+
+
+def tree_blobs(repo_path, ref, pathspecs=()):
+    """path -> blob sha of the regular files committed in `ref` (annexed symlinks excluded)."""
+    out = git(repo_path, "ls-tree", "-r", "-z", ref, "--", *pathspecs)
+    blobs = {}
+    for line in out.split("\0"):
+        if line:
+            meta, path = line.split("\t", 1)
+            mode, obj_type, sha = meta.split()
+            if obj_type == "blob" and mode != "120000":
+                blobs[path] = sha
+    return blobs
+
+
+def read_blobs(repo_path, shas):
+    """sha -> content of blobs, read in a single `git cat-file --batch`."""
+    if not shas:
+        return {}
+    out = subprocess.run(
+        ["git", "-C", str(repo_path), "cat-file", "--batch"],
+        input="".join(f"{sha}\n" for sha in shas).encode(),
+        check=True,
+        capture_output=True,
+    ).stdout
+    blobs = {}
+    pos = 0
+    while pos < len(out):
+        header_end = out.index(b"\n", pos)
+        sha, _, size = out[pos:header_end].decode().split()
+        start = header_end + 1
+        blobs[sha] = out[start : start + int(size)]
+        pos = start + int(size) + 1
+    return blobs
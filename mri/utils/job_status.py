@@ -0,0 +1,431 @@
+"""Status of the SLURM jobs generated by fmriprep.py and mriqc.py.
+
+Jobs are listed from the scripts in `<derivatives>/code`: one job per
+individual script, per row of an array manifest and per job of a packed
+script. Their state is resolved from squeue, sacct, the `.out`/`.err` logs
+and the exit code logged by the scripts. A job has outputs if the last commit
+of its datalad branch (`<jobname>.job`, fetch the origin to see new ones)
+adds preprocessed data or reports, and it did not log a non-zero exit code.
+
+Timed-out and out-of-memory jobs can be resubmitted with escalated
+resources, the attempts are recorded in `code/job_status.json`.
+
+    python3 job_status.py <derivatives_path> [--resubmit] [--sacct-file dump]
+"""
+import os
+import re
+import csv
+import sys
+import glob
+import json
+import math
+import fnmatch
+import argparse
+import subprocess
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from mri.utils import slurm, git_tree
+
+SLURM_JOB_DIR = "code"
+STATUS_FILE = "job_status.json"
+SACCT_FORMAT = "JobID,JobName,State,ExitCode,Elapsed,MaxRSS"
+SQUEUE_FORMAT = "%i|%j|%T"
+SQUEUE_FIELDS = ["JobID", "JobName", "State"]
+# squeue header names of the SQUEUE_FORMAT fields
+SQUEUE_HEADERS = {"JOBID": "JobID", "NAME": "JobName", "STATE": "State"}
+
+# filenames committed by a job that produced its outputs (fMRIPrep, MRIQC)
+OUTPUT_PATTERNS = [
+    "*_desc-preproc_bold.nii.gz",
+    "*_bold.dtseries.nii",
+    "*_desc-preproc_T1w.nii.gz",
+    "sub-*.html",
+]
+
+# resources escalated when resubmitting jobs killed in these states
+ESCALATE = {"TIMEOUT": "time", "OUT_OF_MEMORY": "mem_per_cpu"}
+ESCALATION_FACTOR = 1.5
+MAX_ATTEMPTS = 3
+MAX_WALLTIME = 7 * 24 * 3600
+
+EXITCODE_RE = re.compile(r"^%s (\d+)" % re.escape(slurm.EXITCODE_LOG_PREFIX), re.M)
+LOG_STATES = [
+    ("TIMEOUT", re.compile(r"CANCELLED AT .* DUE TO TIME LIMIT")),
+    ("OUT_OF_MEMORY", re.compile(r"oom[-_]kill|Out Of Memory|MemoryError", re.I)),
+]
+
+
+class SlurmAdapter:
+    """sacct/squeue/sbatch calls, subclassed to replay dumps in dry runs."""
+
+    def sacct(self, start="now-30days"):
+        out = subprocess.run(
+            ["sacct", "--parsable2", f"--format={SACCT_FORMAT}", f"--starttime={start}"],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        return parse_parsable(out)
+
+    def squeue(self):
+        out = subprocess.run(
+            ["squeue", "-r", "-u", os.environ.get("USER", ""), "-o", SQUEUE_FORMAT],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        return parse_squeue(out)
+
+    def sbatch(self, args):
+        out = subprocess.run(
+            ["sbatch", "--parsable"] + args, check=True, capture_output=True, text=True
+        ).stdout
+        return out.strip().split(";")[0]
+
+
+class DumpSlurmAdapter(SlurmAdapter):
+    """Read sacct/squeue dumps and only print sbatch commands."""
+
+    def __init__(self, sacct_path, squeue_path=None):
+        self.sacct_path = sacct_path
+        self.squeue_path = squeue_path
+
+    def sacct(self, start=None):
+        with open(self.sacct_path) as fd:
+            return parse_parsable(fd.read())
+
+    def squeue(self):
+        if not self.squeue_path:
+            return []
+        with open(self.squeue_path) as fd:
+            return parse_squeue(fd.read())
+
+    def sbatch(self, args):
+        print("sbatch " + " ".join(args))
+        return None
+
+
+def parse_parsable(out):
+    lines = [l.split("|") for l in out.splitlines() if l.strip()]
+    return [dict(zip(lines[0], l)) for l in lines[1:]]
+
+
+def parse_squeue(out):
+    """Parse `squeue -r -u $USER -o SQUEUE_FORMAT` output, columns read by header name."""
+    lines = [l.split("|") for l in out.splitlines() if l.strip()]
+    if not lines:
+        return []
+    header = [SQUEUE_HEADERS.get(h.strip(), h.strip()) for h in lines[0]]
+    if not set(SQUEUE_FIELDS) <= set(header):
+        # dumped with --noheader
+        header, lines = SQUEUE_FIELDS, [SQUEUE_FIELDS] + lines
+    return [dict(zip(header, [v.strip() for v in l])) for l in lines[1:]]
+
+
+def _jobid_key(jobid):
+    base, _, task = jobid.partition("_")
+    return int(base), int(task) if task.isdigit() else -1
+
+
+def list_jobs(job_dir):
+    """Jobs generated in `job_dir`: dict jobname -> (script, array task index)."""
+    jobs = collections.OrderedDict()
+    for script in sorted(glob.glob(os.path.join(job_dir, "*.sh"))):
+        script_name = os.path.basename(script)[: -len(".sh")]
+        manifest_path = os.path.join(job_dir, f"{script_name}_manifest.tsv")
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as fd:
+                rows = list(csv.DictReader(fd, delimiter="\t"))
+            for idx, row in enumerate(rows):
+                jobs[row["jobname"]] = (script_name, idx)
+            continue
+        with open(script) as fd:
+            packed = re.findall(r"^export SLURM_JOB_NAME=(\S+)\.job$", fd.read(), re.M)
+        for jobname in packed or [script_name]:
+            jobs[jobname] = (script_name, None)
+    return jobs
+
+
+def log_paths(job_dir, jobname, script_name, task_idx):
+    """Logs of a job: array tasks log to <script>_<task>, others to <jobname>."""
+    prefix = jobname if task_idx is None else f"{script_name}_{task_idx}"
+    return [os.path.join(job_dir, f"{prefix}.{ext}") for ext in ("out", "err")]
+
+
+def read_logs(paths):
+    logs = ""
+    for path in paths:
+        if os.path.exists(path):
+            with open(path, errors="replace") as fd:
+                logs += fd.read()
+    return logs
+
+
+def accounting_records(adapter):
+    """Last submission of each (job name, array task) from sacct and squeue."""
+    rows = adapter.sacct()
+    # steps (batch, extern) hold the memory usage of their job
+    max_rss = collections.defaultdict(float)
+    for row in rows:
+        max_rss[row["JobID"].partition(".")[0]] = max(
+            max_rss[row["JobID"].partition(".")[0]], _rss_gb(row.get("MaxRSS"))
+        )
+
+    records = {}
+    for row in rows + [dict(r, queued=True) for r in adapter.squeue()]:
+        jobid = row["JobID"]
+        task = jobid.partition("_")[2] or None
+        if "." in jobid or (task and not task.isdigit()):
+            # job steps and pending tasks ranges, eg. 123_[4-9%50]
+            continue
+        key = (re.sub(r"\.job$", "", row["JobName"]), task)
+        prev = records.get(key)
+        if prev is None or row.get("queued") or _jobid_key(jobid) > _jobid_key(prev["JobID"]):
+            records[key] = dict(row, max_rss_gb=max_rss.get(jobid))
+    return records
+
+
+def _rss_gb(rss):
+    match = re.match(r"([\d.]+)([KMGT]?)", rss or "")
+    if not match:
+        return 0
+    units = {"": 1 / 1024 ** 3, "K": 1 / 1024 ** 2, "M": 1 / 1024, "G": 1, "T": 1024}
+    return float(match.group(1)) * units[match.group(2)]
+
+
+def job_state(record, logs, packed):
+    """State of a job from its accounting record and logs.
+
+    The exit code logged by a packed job takes precedence over the state of
+    the pack allocation.
+    """
+    if record and record.get("queued"):
+        return record["State"]
+    exitcodes = EXITCODE_RE.findall(logs)
+    if exitcodes and exitcodes[-1] == "0":
+        return "COMPLETED"
+    for state, pattern in LOG_STATES:
+        if pattern.search(logs):
+            return state
+    if exitcodes and (packed or not record):
+        return "FAILED"
+    if record:
+        return record["State"].split()[0]
+    return "UNKNOWN" if logs else "NOT_SUBMITTED"
+
+
+def branches_with_outputs(derivatives_path):
+    """Job branches whose last commit (the datalad run of the job) adds outputs."""
+    try:
+        refs = git_tree.list_refs(derivatives_path, ["*.job"])
+    except subprocess.CalledProcessError:
+        return set()
+
+    def has_outputs(ref):
+        return any(
+            fnmatch.fnmatch(os.path.basename(path), pattern)
+            for path in git_tree.commit_paths(derivatives_path, ref)
+            for pattern in OUTPUT_PATTERNS
+        )
+
+    with ThreadPoolExecutor(max_workers=git_tree.LS_TREE_WORKERS) as executor:
+        found = executor.map(has_outputs, refs)
+        return {ref.rsplit("/", 1)[-1] for ref, ok in zip(refs, found) if ok}
+
+
+def campaign_status(derivatives_path, adapter):
+    """List of the status of all the jobs generated in `derivatives_path`."""
+    job_dir = os.path.join(derivatives_path, SLURM_JOB_DIR)
+    records = accounting_records(adapter)
+    branches = branches_with_outputs(derivatives_path)
+    attempts = load_attempts(job_dir)
+
+    status = []
+    for jobname, (script_name, task_idx) in list_jobs(job_dir).items():
+        packed = task_idx is None and jobname != script_name
+        if packed:
+            record = records.get((script_name, None))
+        elif task_idx is not None:
+            record = records.get((script_name, str(task_idx)))
+        else:
+            record = records.get((jobname, None))
+        logs = read_logs(log_paths(job_dir, jobname, script_name, task_idx))
+        if packed:
+            # the pack logs hold the SLURM kill messages
+            logs += read_logs(log_paths(job_dir, script_name, script_name, None))
+        exitcodes = EXITCODE_RE.findall(logs)
+        status.append(
+            dict(
+                jobname=jobname,
+                script=script_name,
+                task=task_idx,
+                state=job_state(record, logs, packed),
+                jobid=record["JobID"] if record else None,
+                elapsed=record.get("Elapsed") if record else None,
+                max_rss_gb=round(record["max_rss_gb"] or 0, 1) if record else None,
+                # a branch pushed by an earlier failed run is not outputs
+                outputs=f"{jobname}.job" in branches
+                and not (exitcodes and exitcodes[-1] != "0"),
+                attempts=attempts.get(jobname, {}).get("attempts", 1 if record else 0),
+            )
+        )
+    return status
+
+
+def load_attempts(job_dir):
+    path = os.path.join(job_dir, STATUS_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as fd:
+        return json.load(fd)
+
+
+def save_attempts(job_dir, attempts):
+    with open(os.path.join(job_dir, STATUS_FILE), "w") as fd:
+        json.dump(attempts, fd, indent=2)
+
+
+def script_resources(script_path):
+    """Walltime (seconds) and memory per cpu (value, unit) requested by a script."""
+    with open(script_path) as fd:
+        script = fd.read()
+    time = re.search(r"^#SBATCH --time=(\S+)", script, re.M).group(1)
+    mem = re.search(r"^#SBATCH --mem-per-cpu=(\d+)([KMG]?)", script, re.M)
+    return dict(time=slurm.parse_walltime(time), mem_per_cpu=(int(mem.group(1)), mem.group(2)))
+
+
+def escalated_resources(resources, state, factor=ESCALATION_FACTOR):
+    resources = dict(resources)
+    if ESCALATE[state] == "time":
+        resources["time"] = min(int(math.ceil(resources["time"] * factor)), MAX_WALLTIME)
+    else:
+        value, unit = resources["mem_per_cpu"]
+        resources["mem_per_cpu"] = (int(math.ceil(value * factor)), unit)
+    return resources
+
+
+def resubmit(derivatives_path, status, adapter, max_attempts=MAX_ATTEMPTS):
+    """Resubmit timed-out and out-of-memory jobs with escalated resources.
+
+    Array tasks are resubmitted as a new array of the failed indices, with
+    sbatch options overriding the script requests. Packed jobs are only
+    resubmitted if the whole pack has to, otherwise they are left to be
+    regenerated by fmriprep.py, which skips the existing outputs.
+    """
+    job_dir = os.path.join(derivatives_path, SLURM_JOB_DIR)
+    attempts = load_attempts(job_dir)
+    submitted = False
+    to_resubmit = collections.defaultdict(list)
+    for job in status:
+        if job["state"] not in ESCALATE or job["outputs"]:
+            continue
+        if job["attempts"] >= max_attempts:
+            print(f"{job['jobname']}: {job['state']} after {job['attempts']} attempts, giving up")
+            continue
+        to_resubmit[job["script"]].append(job)
+
+    script_jobs = collections.Counter(j["script"] for j in status)
+    for script_name, jobs in to_resubmit.items():
+        script_path = os.path.join(job_dir, f"{script_name}.sh")
+        packed = jobs[0]["task"] is None and jobs[0]["jobname"] != script_name
+        if packed and len(jobs) < script_jobs[script_name]:
+            print(f"{script_name}: only part of the packed jobs failed, regenerate them")
+            continue
+
+        resources = script_resources(script_path)
+        for job in jobs:
+            last = attempts.get(job["jobname"], {}).get("resources")
+            if last:
+                resources = dict(
+                    time=max(resources["time"], last["time"]),
+                    mem_per_cpu=max(resources["mem_per_cpu"], tuple(last["mem_per_cpu"])),
+                )
+        for state in sorted({j["state"] for j in jobs}):
+            resources = escalated_resources(resources, state)
+
+        sbatch_args = [
+            f"--time={slurm.format_walltime(resources['time'])}",
+            "--mem-per-cpu=%d%s" % resources["mem_per_cpu"],
+        ]
+        if jobs[0]["task"] is not None:
+            log_prefix = os.path.join(job_dir, script_name)
+            sbatch_args += [
+                "--array=" + ",".join(str(j["task"]) for j in jobs),
+                f"--output={log_prefix}_%a.out",
+                f"--error={log_prefix}_%a.err",
+            ]
+        jobid = adapter.sbatch(sbatch_args + [script_path])
+        if jobid is None:
+            continue
+        submitted = True
+        for job in jobs:
+            attempts[job["jobname"]] = dict(
+                attempts=job["attempts"] + 1, resources=resources, jobid=jobid
+            )
+            print(f"{job['jobname']}: {job['state']}, resubmitted {' '.join(sbatch_args[:2])}")
+    if submitted:
+        save_attempts(job_dir, attempts)
+
+
+def print_status(status, fd=sys.stdout):
+    fields = ["jobname", "state", "attempts", "jobid", "elapsed", "max_rss_gb", "outputs"]
+    writer = csv.writer(fd, delimiter="\t", lineterminator="\n")
+    writer.writerow(fields)
+    for job in status:
+        writer.writerow(["" if job[f] is None else job[f] for f in fields])
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        description="state of the jobs generated by fmriprep.py/mriqc.py, resubmit the killed ones",
+    )
+    parser.add_argument("derivatives_path", help="derivatives dataset where jobs were generated")
+    parser.add_argument(
+        "--resubmit",
+        action="store_true",
+        help="resubmit timed-out and out-of-memory jobs with escalated resources",
+    )
+    parser.add_argument(
+        "--max-attempts",
+        type=int,
+        default=MAX_ATTEMPTS,
+        help="number of submissions after which a job is not resubmitted",
+    )
+    parser.add_argument(
+        "--state", nargs="+", help="only list the jobs in these states"
+    )
+    parser.add_argument(
+        "--sacct-file",
+        help=f"sacct dump (sacct --parsable2 --format={SACCT_FORMAT}) to use instead of"
+        " querying SLURM, resubmissions are then only printed",
+    )
+    parser.add_argument(
+        "--squeue-file",
+        help=f'squeue dump (squeue -r -u $USER -o "{SQUEUE_FORMAT}") used with --sacct-file',
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.sacct_file:
+        adapter = DumpSlurmAdapter(args.sacct_file, args.squeue_file)
+    else:
+        adapter = SlurmAdapter()
+    status = campaign_status(args.derivatives_path, adapter)
+    listed = [j for j in status if not args.state or j["state"] in args.state]
+    print_status(listed)
+    counts = collections.Counter(j["state"] for j in status)
+    print(
+        "# " + ", ".join(f"{state}: {count}" for state, count in counts.most_common()),
+        file=sys.stderr,
+    )
+    if args.resubmit:
+        resubmit(args.derivatives_path, status, adapter, max_attempts=args.max_attempts)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+"""Estimate the makespan of a campaign of jobs under cluster limits.
+
+The job list is the one generated in `<derivatives>/code` by fmriprep.py or
+mriqc.py (run them with --no-submit to plan a campaign). Runtimes are
+predicted with the model fitted by derivatives/fmriprep/resources.py from the
+`*_resources.json` job sizes, or are a fraction of the requested walltime.
+
+Jobs are scheduled first-come first-served on a pool of cores, with a cap on
+the number of running jobs and a queue wait that grows with the core-hours
+already used (a crude fairshare), for each strategy:
+
+- jobs: one job per script, as generated
+- array: same jobs, with the running tasks capped by the array throttle
+- pack: jobs packed by `--pack` in whole-node allocations
+- split: jobs split in groups of `--runs-per-job` runs
+
+    python3 makespan.py <derivatives_path> --cores 2000 --max-jobs 1000
+"""
+import os
+import re
+import sys
+import json
+import math
+import heapq
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from mri.utils import slurm, job_status
+
+STRATEGIES = ["jobs", "array", "pack", "split"]
+
+CLUSTER = dict(
+    cores=1000,
+    max_jobs=1000,
+    array_max_concurrent=slurm.ARRAY_MAX_CONCURRENT,
+    node_cpus=40,
+    # hours between a job being eligible and starting
+    queue_wait=0.5,
+    node_queue_wait=2.0,
+    # additional wait per 1000 core-hours already used by the campaign
+    fairshare_wait=0.05,
+)
+# part of the runtime that scales with the number of cpus (Amdahl)
+PARALLEL_FRACTION = 0.8
+# part of a func job runtime independent of the number of runs (inputs, anat)
+SPLIT_OVERHEAD_HOURS = 0.5
+# runtime as a fraction of the requested walltime when there is no model
+RUNTIME_FRACTION = 0.5
+
+
+def script_request(script_path):
+    with open(script_path) as fd:
+        script = fd.read()
+    cpus = int(re.search(r"^#SBATCH --cpus-per-task=(\d+)", script, re.M).group(1))
+    time = re.search(r"^#SBATCH --time=(\S+)", script, re.M).group(1)
+    return dict(cpus=cpus, hours=slurm.parse_walltime(time) / 3600)
+
+
+def predict_hours(model, features):
+    """Expected runtime from a resources.py model, without its safety margins."""
+    if not model or any(features.get(f) is None for f in model["features"]):
+        return None
+    x = [1.0] + [features[f] for f in model["features"]]
+    return max(sum(c * v for c, v in zip(model["targets"]["hours"]["coefs"], x)), 0.1)
+
+
+def load_jobs(derivatives_path, model=None, runtime_fraction=RUNTIME_FRACTION):
+    """Jobs generated in `derivatives_path` with their cpus, runtime and runs."""
+    job_dir = os.path.join(derivatives_path, job_status.SLURM_JOB_DIR)
+    jobs = []
+    for jobname, (script_name, task_idx) in job_status.list_jobs(job_dir).items():
+        request = script_request(os.path.join(job_dir, f"{script_name}.sh"))
+        features = {}
+        resources_path = os.path.join(job_dir, f"{jobname}_resources.json")
+        if os.path.exists(resources_path):
+            with open(resources_path) as fd:
+                resources = json.load(fd)
+            features = resources["features"]
+            request = dict(
+                cpus=resources["request"]["cpus"],
+                hours=slurm.parse_walltime(resources["request"]["time"]) / 3600,
+            )
+        hours = predict_hours(model, features)
+        jobs.append(
+            dict(
+                jobname=jobname,
+                cpus=request["cpus"],
+                hours=hours if hours else request["hours"] * runtime_fraction,
+                n_runs=features.get("n_runs") or 1,
+            )
+        )
+    return jobs
+
+
+def scale_runtime(hours, req_cpus, alloc_cpus, parallel_fraction=PARALLEL_FRACTION):
+    return hours * ((1 - parallel_fraction) + parallel_fraction * req_cpus / alloc_cpus)
+
+
+def strategy_jobs(jobs, strategy, pack=3, runs_per_job=2, node_cpus=CLUSTER["node_cpus"]):
+    """Jobs (cpus, hours, whole node) as submitted with `strategy`."""
+    if strategy in ["jobs", "array"]:
+        return [dict(cpus=j["cpus"], hours=j["hours"], node=False) for j in jobs]
+    if strategy == "pack":
+        packs = []
+        for start in range(0, len(jobs), pack):
+            packed = jobs[start : start + pack]
+            alloc = node_cpus // len(packed)
+            packs.append(
+                dict(
+                    cpus=node_cpus,
+                    hours=max(scale_runtime(j["hours"], j["cpus"], alloc) for j in packed),
+                    node=True,
+                )
+            )
+        return packs
+    if strategy == "split":
+        split = []
+        for job in jobs:
+            n_groups = int(math.ceil(job["n_runs"] / runs_per_job))
+            run_hours = max(job["hours"] - SPLIT_OVERHEAD_HOURS, 0) / job["n_runs"]
+            for group in range(n_groups):
+                group_runs = min(runs_per_job, job["n_runs"] - group * runs_per_job)
+                split.append(
+                    dict(
+                        cpus=job["cpus"],
+                        hours=SPLIT_OVERHEAD_HOURS + run_hours * group_runs,
+                        node=False,
+                    )
+                )
+        return split
+    raise ValueError(f"unknown strategy {strategy}")
+
+
+def simulate(jobs, cores, max_jobs, queue_wait, node_queue_wait, fairshare_wait):
+    """First-come first-served schedule, returns makespan and waits in hours.
+
+    A job is ready once enough cores and a running slot are free, and starts
+    after its queue wait, that grows with the core-hours used by the jobs
+    started before. Waits are counted from when the job is ready.
+    """
+    running = []  # heap of (end, cpus)
+    used_cores = 0
+    clock = 0.0
+    core_hours = 0.0
+    waits = []
+    makespan = 0.0
+    for job in jobs:
+        cpus = min(job["cpus"], cores)
+        while running and (used_cores + cpus > cores or len(running) >= max_jobs):
+            end, freed = heapq.heappop(running)
+            clock = max(clock, end)
+            used_cores -= freed
+        wait = (node_queue_wait if job["node"] else queue_wait) + fairshare_wait * core_hours / 1000
+        start = clock + wait
+        end = start + job["hours"]
+        heapq.heappush(running, (end, cpus))
+        used_cores += cpus
+        core_hours += cpus * job["hours"]
+        # wait from when the job is ready, not from the start of the campaign
+        waits.append(start - clock)
+        makespan = max(makespan, end)
+    return dict(
+        jobs=len(jobs),
+        makespan_h=makespan,
+        mean_wait_h=sum(waits) / len(waits) if waits else 0,
+        max_wait_h=max(waits) if waits else 0,
+        core_hours=core_hours,
+    )
+
+
+def compare_strategies(jobs, cluster, strategies=STRATEGIES, pack=3, runs_per_job=2):
+    results = {}
+    for strategy in strategies:
+        max_jobs = cluster["max_jobs"]
+        if strategy == "array":
+            max_jobs = min(max_jobs, cluster["array_max_concurrent"])
+        results[strategy] = simulate(
+            strategy_jobs(jobs, strategy, pack, runs_per_job, cluster["node_cpus"]),
+            cores=cluster["cores"],
+            max_jobs=max_jobs,
+            queue_wait=cluster["queue_wait"],
+            node_queue_wait=cluster["node_queue_wait"],
+            fairshare_wait=cluster["fairshare_wait"],
+        )
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        description="estimate the makespan of the generated jobs for several submission strategies",
+    )
+    parser.add_argument("derivatives_path", help="derivatives dataset where jobs were generated")
+    parser.add_argument(
+        "--resource-model", help="runtime model fitted by derivatives/fmriprep/resources.py"
+    )
+    parser.add_argument(
+        "--runtime-fraction",
+        type=float,
+        default=RUNTIME_FRACTION,
+        help="runtime as a fraction of the requested walltime for jobs the model cannot predict",
+    )
+    for key, value in CLUSTER.items():
+        parser.add_argument(
+            f"--{key.replace('_', '-')}", type=type(value), default=value
+        )
+    parser.add_argument("--pack", type=int, default=3, help="jobs per node for the pack strategy")
+    parser.add_argument(
+        "--runs-per-job", type=int, default=2, help="runs per job for the split strategy"
+    )
+    parser.add_argument("--strategies", nargs="+", choices=STRATEGIES, default=STRATEGIES)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    model = None
+    if args.resource_model:
+        with open(args.resource_model) as fd:
+            model = json.load(fd)
+    jobs = load_jobs(args.derivatives_path, model, args.runtime_fraction)
+    if not jobs:
+        sys.exit("no generated jobs found")
+    cluster = {key: getattr(args, key) for key in CLUSTER}
+    results = compare_strategies(jobs, cluster, args.strategies, args.pack, args.runs_per_job)
+    print("strategy\tjobs\tmakespan_h\tmean_wait_h\tmax_wait_h\tcore_hours")
+    for strategy, res in sorted(results.items(), key=lambda r: r[1]["makespan_h"]):
+        print(
+            f"{strategy}\t{res['jobs']}\t{res['makespan_h']:.1f}\t{res['mean_wait_h']:.1f}"
+            f"\t{res['max_wait_h']:.1f}\t{res['core_hours']:.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
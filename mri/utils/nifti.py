@@ -0,0 +1,220 @@
+"""NIfTI reading and writing helpers shared by the ds_prep tools.
+
+.nii.gz files are compressed by blocks in a thread pool (zlib releases the
+GIL) and written as a sequence of gzip members, which standard gunzip, python
+gzip and nibabel read transparently. Files are written to a temporary path
+and moved in place once complete. 4D images and dtseries are read by chunks
+of volumes, memory-mapped or decompressed as a stream.
+"""
+import os
+import io
+import gzip
+import time
+import zlib
+import argparse
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import nibabel as nb
+
+GZIP_BLOCK_SIZE = 1 << 20  # 1MiB of uncompressed data per gzip member
+GZIP_COMPRESSLEVEL = 6
+CHUNK_VOLUMES = 32
+
+
+def available_cpus():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def _gzip_member(data, compresslevel):
+    # wbits=31: zlib adds gzip header and trailer (crc32, size) to the stream
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+class ParallelGzipWriter(io.RawIOBase):
+    """Write-only file object compressing blocks as independent gzip members.
+
+    At most `2 * nthreads` blocks are in flight, so memory usage is bounded by
+    the block size whatever the size of the written image.
+    """
+
+    def __init__(
+        self,
+        fileobj,
+        compresslevel=GZIP_COMPRESSLEVEL,
+        nthreads=None,
+        block_size=GZIP_BLOCK_SIZE,
+    ):
+        self.fileobj = fileobj
+        self.compresslevel = compresslevel
+        self.block_size = block_size
+        self.nthreads = nthreads or available_cpus()
+        self._executor = ThreadPoolExecutor(max_workers=self.nthreads)
+        self._pending = []
+        self._buffer = bytearray()
+        self._pos = 0
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        # position in the uncompressed stream, as nibabel expects
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        # the stream is sequential: only allow padding forward with zeros
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence != io.SEEK_SET or offset < self._pos:
+            raise io.UnsupportedOperation("can only seek forward")
+        if offset > self._pos:
+            self.write(b"\x00" * (offset - self._pos))
+        return self._pos
+
+    def write(self, data):
+        data = memoryview(data).cast("B")
+        self._buffer += data
+        self._pos += len(data)
+        while len(self._buffer) >= self.block_size:
+            self._submit(bytes(self._buffer[: self.block_size]))
+            del self._buffer[: self.block_size]
+        return len(data)
+
+    def _submit(self, block):
+        self._pending.append(
+            self._executor.submit(_gzip_member, block, self.compresslevel)
+        )
+        while len(self._pending) > 2 * self.nthreads:
+            self.fileobj.write(self._pending.pop(0).result())
+
+    def flush(self):
+        if self._buffer:
+            self._submit(bytes(self._buffer))
+            self._buffer = bytearray()
+        while self._pending:
+            self.fileobj.write(self._pending.pop(0).result())
+        self.fileobj.flush()
+
+    def close(self):
+        if not self.closed:
+            self.flush()
+            self._executor.shutdown()
+        super().close()
+
+
+@contextlib.contextmanager
+def open_atomic(filename, compresslevel=GZIP_COMPRESSLEVEL, nthreads=None):
+    """Open `filename` for writing, parallel-gzipped if it ends with .gz.
+
+    Data goes to a hidden temporary file in the same folder that replaces
+    `filename` only if the block exits without error.
+    """
+    filename = str(filename)
+    tmp_path = os.path.join(
+        os.path.dirname(filename), f".partial_{os.getpid()}_{os.path.basename(filename)}"
+    )
+    try:
+        with open(tmp_path, "wb") as raw:
+            if filename.endswith(".gz"):
+                with ParallelGzipWriter(
+                    raw, compresslevel=compresslevel, nthreads=nthreads
+                ) as fobj:
+                    yield fobj
+            else:
+                yield raw
+        os.replace(tmp_path, filename)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def save(img, filename, compresslevel=GZIP_COMPRESSLEVEL, nthreads=None):
+    """Atomically write a nibabel single-file image (.nii/.nii.gz)."""
+    with open_atomic(filename, compresslevel=compresslevel, nthreads=nthreads) as fobj:
+        file_map = img.make_file_map({"image": fobj})
+        # keep the image file_map unchanged, to_file_map overwrites it
+        orig_file_map = img.file_map
+        img.to_file_map(file_map)
+        img.file_map = orig_file_map
+
+
+def iter_volume_chunks(img_path, chunk_volumes=CHUNK_VOLUMES):
+    """Scaled chunks (n_volumes, n_voxels) of a 4D NIfTI or a dtseries, voxels in file order.
+
+    Uncompressed files are memory-mapped, .nii.gz are decompressed once
+    sequentially, each volume being contiguous in the file.
+    """
+    img = nb.load(img_path)
+    cifti = img_path.endswith(".dtseries.nii")
+    proxy = img.dataobj
+    slope, inter = proxy.slope, proxy.inter
+    n_volumes = img.shape[0] if cifti else img.shape[3]
+
+    if img_path.endswith(".gz"):
+        n_voxels = int(np.prod(img.shape[:3]))
+        dtype = proxy.dtype
+        with gzip.open(img_path, "rb") as fd:
+            fd.seek(proxy.offset)
+            for start in range(0, n_volumes, chunk_volumes):
+                n = min(chunk_volumes, n_volumes - start)
+                raw = np.frombuffer(fd.read(n * n_voxels * dtype.itemsize), dtype=dtype)
+                yield raw.reshape(n, n_voxels).astype(np.float32) * slope + inter
+        return
+
+    raw = proxy.get_unscaled()  # memmap of the uncompressed data
+    for start in range(0, n_volumes, chunk_volumes):
+        if cifti:
+            chunk = raw[start : start + chunk_volumes]
+        else:
+            chunk = raw[..., start : start + chunk_volumes]
+            chunk = chunk.reshape(-1, chunk.shape[-1], order="F").T
+        yield np.asarray(chunk, dtype=np.float32) * slope + inter
+
+
+def benchmark(img_path, levels=range(1, 10), nthreads=None, out_dir="."):
+    """Print the write throughput and compression ratio per compression level."""
+    img = nb.load(img_path)
+    img = nb.Nifti1Image(np.asanyarray(img.dataobj), img.affine, img.header)
+    out_path = os.path.join(out_dir, "nifti_benchmark.nii.gz")
+    nbytes = img.dataobj.nbytes
+    print("level\tthreads\tseconds\tMB/s\tratio")
+    for threads in sorted({1, nthreads or available_cpus()}):
+        for level in levels:
+            start = time.perf_counter()
+            save(img, out_path, compresslevel=level, nthreads=threads)
+            elapsed = time.perf_counter() - start
+            print(
+                f"{level}\t{threads}\t{elapsed:.2f}\t{nbytes / elapsed / 1e6:.1f}"
+                f"\t{nbytes / os.path.getsize(out_path):.2f}"
+            )
+    os.remove(out_path)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        description="benchmark parallel gzip NIfTI writing throughput versus compression level",
+    )
+    parser.add_argument("img_path", help="NIfTI image to write")
+    parser.add_argument(
+        "--nthreads",
+        type=int,
+        help="number of compression threads, default to available cpus",
+    )
+    parser.add_argument(
+        "--levels",
+        type=int,
+        nargs="+",
+        default=list(range(1, 10)),
+        help="gzip compression levels to benchmark",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    benchmark(args.img_path, levels=args.levels, nthreads=args.nthreads)
@@ -0,0 +1,235 @@
+"""Node-local cache of annexed files shared by the jobs running on a node.
+
+Jobs clone the derivatives dataset in their own $SLURM_TMPDIR and each used to
+fetch the same templateflow templates and containers from the RIA store. This
+script keeps a single copy of each annex object per node, under
+`<cache_dir>/objects/<annex key>`: the first job that needs a key fetches it
+while holding a lock on that key, the other jobs wait for it then hardlink the
+object into their clone (copy if the cache is on another filesystem) and
+record it as present, without hashing or any network access.
+
+Objects are read-only and used in place, the least recently used objects that
+are not linked from a running job are evicted once the cache exceeds its size.
+
+    python3 node_cache.py get [-s remote] [--container name] [-- paths]
+    python3 node_cache.py evict [--max-size-gb N]
+"""
+import os
+import sys
+import fcntl
+import shutil
+import argparse
+import contextlib
+import subprocess
+import logging
+
+NODE_CACHE_DIR = os.environ.get(
+    "DS_PREP_NODE_CACHE",
+    os.path.join("/localscratch", os.environ.get("USER", ""), "ds_prep_cache"),
+)
+NODE_CACHE_MAX_SIZE_GB = 200
+GET_JOBS = 4
+
+
+def git(repo_path, *args):
+    return subprocess.run(
+        ["git", "-C", str(repo_path)] + list(args),
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+
+
+@contextlib.contextmanager
+def flock(lock_path):
+    with open(lock_path, "a") as fd:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+def container_image(dataset_path, container):
+    """Image path of a datalad container, `container` as given to containers-run."""
+    subds, _, name = container.rpartition("/")
+    subds = os.path.join(dataset_path, subds)
+    image = git(
+        subds, "config", "-f", ".datalad/config", f"datalad.containers.{name}.image"
+    ).strip()
+    return os.path.join(subds, image)
+
+
+def repo_paths(paths):
+    """Map the installed (sub)datasets containing or below `paths` to the
+    paths to get in each of them."""
+    repos = {}
+    for path in map(os.path.abspath, paths):
+        top = git(
+            path if os.path.isdir(path) else os.path.dirname(path),
+            "rev-parse",
+            "--show-toplevel",
+        ).strip()
+        repos.setdefault(top, []).append(os.path.relpath(path, top))
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                if root != path and ".git" in dirs + files:
+                    repos.setdefault(root, []).append(".")
+                # do not index the content of the git dirs
+                dirs[:] = [d for d in dirs if d != ".git"]
+    return repos
+
+
+def missing_keys(repo_path, paths):
+    """Annex keys of the files under `paths` whose content is not in the repo."""
+    out = git(
+        repo_path,
+        "annex",
+        "find",
+        "--not",
+        "--in=here",
+        "--format=${key}\\t${file}\\n",
+        "--",
+        *paths,
+    )
+    return dict(line.split("\t", 1) for line in out.splitlines() if line)
+
+
+def object_path(repo_path, key):
+    git_dir = os.path.join(repo_path, git(repo_path, "rev-parse", "--git-dir").strip())
+    hashdir = git(repo_path, "annex", "examinekey", "--format=${hashdirmixed}", key)
+    return os.path.join(git_dir, "annex", "objects", hashdir, key, key)
+
+
+def link_or_copy(src, dst):
+    tmp_path = f"{dst}.{os.getpid()}.tmp"
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        shutil.copyfile(src, tmp_path)
+        os.chmod(tmp_path, 0o444)
+    os.replace(tmp_path, dst)
+
+
+def get(paths, cache_dir=NODE_CACHE_DIR, source=None, jobs=GET_JOBS):
+    """`datalad get` the annexed `paths` (and subdatasets) through the node cache."""
+    objects_dir = os.path.join(cache_dir, "objects")
+    locks_dir = os.path.join(cache_dir, "locks")
+    os.makedirs(objects_dir, exist_ok=True)
+    os.makedirs(locks_dir, exist_ok=True)
+
+    # install the subdatasets only, their content goes through the cache
+    subprocess.run(
+        ["datalad", "get", "-n", "-r"] + (["-s", source] if source else []) + ["--"] + paths,
+        check=True,
+    )
+
+    for repo_path, rel_paths in sorted(repo_paths(paths).items()):
+        keys = missing_keys(repo_path, rel_paths)
+        if not keys:
+            continue
+        uuid = git(repo_path, "config", "annex.uuid").strip()
+
+        with contextlib.ExitStack() as locks:
+            # locks taken in a stable order to avoid deadlocks between jobs
+            for key in sorted(keys):
+                locks.enter_context(flock(os.path.join(locks_dir, f"{key}.lock")))
+
+            to_fetch = [
+                key for key in keys if not os.path.exists(os.path.join(objects_dir, key))
+            ]
+            if to_fetch:
+                logging.info(f"fetching {len(to_fetch)} files into the node cache")
+                subprocess.run(
+                    ["datalad", "get", "-J", str(jobs), "-d", repo_path]
+                    + (["-s", source] if source else [])
+                    + ["--"]
+                    + [os.path.join(repo_path, keys[k]) for k in to_fetch],
+                    check=True,
+                )
+                for key in to_fetch:
+                    link_or_copy(object_path(repo_path, key), os.path.join(objects_dir, key))
+
+            for key in sorted(set(keys) - set(to_fetch)):
+                cached_path = os.path.join(objects_dir, key)
+                obj_path = object_path(repo_path, key)
+                os.makedirs(os.path.dirname(obj_path), exist_ok=True)
+                link_or_copy(cached_path, obj_path)
+                git(repo_path, "annex", "setpresentkey", key, uuid, "1")
+            for key in keys:
+                # mtime is the last use, for LRU eviction
+                os.utime(os.path.join(objects_dir, key))
+        logging.info(
+            f"{repo_path}: {len(keys) - len(to_fetch)} files from node cache, {len(to_fetch)} fetched"
+        )
+
+
+def evict(cache_dir=NODE_CACHE_DIR, max_size_gb=NODE_CACHE_MAX_SIZE_GB):
+    """Remove least recently used objects not linked from a job above `max_size_gb`."""
+    objects_dir = os.path.join(cache_dir, "objects")
+    if not os.path.isdir(objects_dir):
+        return
+    with flock(os.path.join(cache_dir, "evict.lock")):
+        entries = []
+        for entry in os.scandir(objects_dir):
+            if entry.name.endswith(".tmp"):
+                continue
+            st = entry.stat()
+            entries.append((st.st_mtime, st.st_size, st.st_nlink, entry))
+        total = sum(e[1] for e in entries)
+        for mtime, size, nlink, entry in sorted(entries, key=lambda e: e[0]):
+            if total <= max_size_gb * 1024 ** 3:
+                break
+            if nlink > 1:
+                # hardlinked in a running job clone: removing it frees nothing
+                continue
+            with flock(os.path.join(cache_dir, "locks", f"{entry.name}.lock")):
+                # a job may have linked it since it was listed
+                if not os.path.exists(entry.path) or os.stat(entry.path).st_nlink > 1:
+                    continue
+                os.remove(entry.path)
+            total -= size
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        description="get annexed files through a node-local cache shared by jobs",
+    )
+    parser.add_argument("action", choices=["get", "evict"])
+    parser.add_argument("paths", nargs="*", help="paths to get, relative to the current dataset")
+    parser.add_argument(
+        "--cache-dir",
+        default=NODE_CACHE_DIR,
+        help="node-local cache folder ($DS_PREP_NODE_CACHE)",
+    )
+    parser.add_argument("-s", "--source", help="annex remote to fetch from")
+    parser.add_argument(
+        "--container",
+        action="append",
+        default=[],
+        help="datalad container (as given to containers-run) whose image to get",
+    )
+    parser.add_argument("-J", "--jobs", type=int, default=GET_JOBS)
+    parser.add_argument(
+        "--max-size-gb",
+        type=float,
+        default=NODE_CACHE_MAX_SIZE_GB,
+        help="size of the cache above which least recently used objects are evicted",
+    )
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+    if args.action == "get":
+        paths = args.paths + [container_image(".", c) for c in args.container]
+        if not paths:
+            sys.exit("nothing to get")
+        get(paths, cache_dir=args.cache_dir, source=args.source, jobs=args.jobs)
+    evict(cache_dir=args.cache_dir, max_size_gb=args.max_size_gb)
+
+
+if __name__ == "__main__":
+    main()
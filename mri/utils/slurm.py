@@ -0,0 +1,92 @@
+"""SLURM job arrays helpers shared by the derivatives jobs generators.
+
+A job array is a single script formatted with shell variables in place of the
+per-task job specs (eg. `${subject}`), plus a TSV manifest with one row of
+per-task values. Each task reads its row at runtime and renames itself after
+the job it replaces, so that logs, datalad branches and scratch copies keep
+the names of individual jobs.
+"""
+import os
+import csv
+import subprocess
+
+ARRAY_MAX_CONCURRENT = 50
+# logged by job scripts before exiting, parsed by job_status.py
+EXITCODE_LOG_PREFIX = "ds_prep exitcode:"
+
+array_task_header = """
+# resolve the parameters of this array task from the manifest
+task_params=$(sed -n "$((SLURM_ARRAY_TASK_ID + 2))p" {manifest_path})
+{task_variables}
+export SLURM_JOB_NAME="${{jobname}}.job"
+
+"""
+
+
+def write_job_exit(fd, exitcode_var):
+    """Log the exit code of a job script and exit with it."""
+    fd.write(f'echo "{EXITCODE_LOG_PREFIX} ${exitcode_var}"\n')
+    fd.write(f"exit ${exitcode_var} \n")
+
+
+def parse_walltime(walltime):
+    """SLURM [D-]H:M:S walltime to seconds."""
+    days = 0
+    if "-" in walltime:
+        days, walltime = walltime.split("-")
+    parts = [int(p) for p in walltime.split(":")]
+    return int(days) * 86400 + sum(p * 60 ** i for i, p in enumerate(reversed(parts)))
+
+
+def format_walltime(seconds):
+    return f"{seconds // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+def write_array_manifest(manifest_path, jobs, task_fields):
+    with open(manifest_path, "w", newline="") as fd:
+        writer = csv.writer(fd, delimiter="\t", lineterminator="\n")
+        writer.writerow(task_fields)
+        for job_specs in jobs:
+            writer.writerow(
+                ["" if job_specs[f] is None else job_specs[f] for f in task_fields]
+            )
+
+
+def array_job_specs(jobs, task_fields):
+    """Job specs of an array: per-task fields as shell variables, max resources."""
+    job_specs = dict(jobs[0])
+    job_specs.update({f: "${%s}" % f for f in task_fields})
+    for req in ["cpus", "mem_per_cpu", "omp_nthreads"]:
+        if req in job_specs:
+            job_specs[req] = max(j[req] for j in jobs)
+    if "time" in job_specs:
+        job_specs["time"] = format_walltime(
+            max(parse_walltime(j["time"]) for j in jobs)
+        )
+    return job_specs
+
+
+def write_array_task_header(fd, manifest_path, task_fields):
+    fd.write(
+        array_task_header.format(
+            manifest_path=manifest_path,
+            task_variables="\n".join(
+                f'{f}=$(echo "$task_params" | cut -f{i + 1})'
+                for i, f in enumerate(task_fields)
+            ),
+        )
+    )
+
+
+def submit_array_job(job_path, n_tasks, log_dir, max_concurrent=ARRAY_MAX_CONCURRENT):
+    """Submit `n_tasks` tasks of an array with at most `max_concurrent` running."""
+    log_prefix = os.path.join(log_dir, os.path.basename(job_path)[: -len(".sh")])
+    return subprocess.run(
+        [
+            "sbatch",
+            f"--array=0-{n_tasks - 1}%{max_concurrent}",
+            f"--output={log_prefix}_%a.out",
+            f"--error={log_prefix}_%a.err",
+            job_path,
+        ]
+    )